@@ -0,0 +1,5 @@
+"""
+Performance benchmarks, each module runs standalone from the src directory, e.g.
+
+    python -m benchmarks.bench_codec
+"""
@@ -0,0 +1,60 @@
+"""
+Benchmark of the active users listing with tens of thousands of users online: the whole set as /u replied
+before, against a page of the index, a prefix page and the count.
+
+It needs a running Redis server, the benchmark users active_* are added to the active users and removed.
+"""
+import argparse
+import statistics
+import time
+
+from utils.redis_manager import RedisServerManager
+
+
+def timed(func, repeat):
+    durations = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        reply = func()
+        durations.append((time.perf_counter() - start) * 1e3)
+    return statistics.mean(durations), len(reply)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-u', '--users', type=int, default=50_000)
+    parser.add_argument('-l', '--limit', type=int, default=100)
+    parser.add_argument('-r', '--repeat', type=int, default=50)
+    args = parser.parse_args()
+
+    manager = RedisServerManager()
+    client = manager._redis_client
+    usernames = [f"active_{i:06}" for i in range(args.users)]
+    pipeline = client.pipeline(transaction=False)
+    for username in usernames:
+        pipeline.sadd("active_users", username)
+        pipeline.zadd(manager.ACTIVE_USERS_INDEX, {username: 0})
+    pipeline.execute()
+
+    middle = usernames[args.users // 2]
+    cases = (
+        ('whole set', lambda: f"ACTIVE_USERS:{list(map(lambda x: x.decode(), manager.get_active_users()))}"),
+        ('first page', lambda: str(manager.scan_active_users('0', '', args.limit))),
+        ('middle page', lambda: str(manager.scan_active_users(f"({middle}", '', args.limit))),
+        ('prefix page', lambda: str(manager.scan_active_users('0', middle[:-2], args.limit))),
+        ('count', lambda: str(manager.count_active_users())),
+    )
+    print(f"{args.users:,} active users, pages of {args.limit}, mean over {args.repeat} calls")
+    print(f"{'':<12} {'ms':>8} {'reply bytes':>12}")
+    for name, func in cases:
+        elapsed, size = timed(func, args.repeat)
+        print(f"{name:<12} {elapsed:>8.3f} {size:>12,}")
+
+    pipeline = client.pipeline(transaction=False)
+    pipeline.srem("active_users", *usernames)
+    pipeline.zrem(manager.ACTIVE_USERS_INDEX, *usernames)
+    pipeline.execute()
+
+
+if __name__ == "__main__":
+    main()
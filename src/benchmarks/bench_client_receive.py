@@ -0,0 +1,78 @@
+"""
+Benchmark of the client receive path: messages read by ChatClient on asyncio streams against blocking recv calls
+sent to the default thread pool with run_in_executor, one hop by message, as the client did before.
+
+A local asyncio server sends the same number of messages to each client connection as fast as they are read, the
+clients all run on the event loop of the benchmark process. A waiting executor client holds a pool thread, keep
+them to a few hundred. No chat server or Redis is involved.
+"""
+import argparse
+import asyncio
+import time
+
+from services.client_side import ChatClient
+from utils.network_socket import NetworkSocket, encode_frame
+
+HOST = 'localhost'
+
+
+async def serve(port, messages, size):
+    frame = encode_frame('alice: ' + 'x' * size)
+
+    async def send(reader, writer):
+        for start in range(0, messages, 100):
+            writer.write(frame * min(100, messages - start))
+            await writer.drain()
+        writer.close()
+
+    return await asyncio.start_server(send, HOST, port)
+
+
+async def receive_streams(port, messages):
+    client = ChatClient(HOST, port)
+    await client.connect()
+    for _ in range(messages):
+        await client.receive()
+    await client.close()
+
+
+async def receive_executor(port, messages):
+    loop = asyncio.get_running_loop()
+    conn = NetworkSocket(HOST, port)
+    await loop.run_in_executor(None, conn.connect)
+    for _ in range(messages):
+        await loop.run_in_executor(None, conn.receive_data)
+    conn.close()
+
+
+async def run(receive, args):
+    server = await serve(args.port, args.messages, args.size)
+    cpu, start = time.process_time(), time.perf_counter()
+    await asyncio.gather(*(receive(args.port, args.messages) for _ in range(args.clients)))
+    elapsed, cpu = time.perf_counter() - start, time.process_time() - cpu
+    server.close()
+    await server.wait_closed()
+    return elapsed, cpu
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-c', '--clients', type=int, nargs='+', default=[1, 10, 100])
+    parser.add_argument('-m', '--messages', type=int, default=100_000, help="messages received in all, by run")
+    parser.add_argument('-s', '--size', type=int, default=100, help="message padding in bytes")
+    parser.add_argument('--port', type=int, default=12399)
+    args = parser.parse_args()
+
+    total = args.messages
+    print(f"{total:,} messages of {args.size} bytes by run, split between the clients")
+    print(f"{'clients':>7} {'receive':<12} {'messages/s':>11} {'CPU us / msg':>13}")
+    for clients in args.clients:
+        args.clients, args.messages = clients, total // clients
+        for name, receive in (('streams', receive_streams), ('executor', receive_executor)):
+            elapsed, cpu = asyncio.run(run(receive, args))
+            received = args.messages * clients
+            print(f"{clients:>7,} {name:<12} {received / elapsed:>11,.0f} {cpu / received * 1e6:>13.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,49 @@
+"""
+Microbenchmark of the request codecs: encode/decode cost and bytes on the wire, text format vs binary format
+"""
+import argparse
+import timeit
+
+from utils.network_socket import FRAME_HEADER
+from utils.protocol import TextCodec, BinaryCodec, UserIds
+from utils.redis_manager import hash_password
+
+USERNAME = 'alice'
+SESSION_TOKEN = '5f2b9c0e7d1a4e3b8c6f0a9d2e4b7c1f'
+MESSAGES = {
+    'short': '@bob hi',
+    'colon': '@bob meet at 10:30, room: B',
+    '1KB': '@bob ' + 'x' * 1024,
+}
+
+
+def bench(func, number):
+    """
+    :return: best time per call in nanoseconds
+    """
+    return min(timeit.repeat(func, number=number, repeat=5)) / number * 1e9
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-n', '--number', type=int, default=100_000, help="calls per measure")
+    args = parser.parse_args()
+
+    user_ids = UserIds()
+    user_ids.intern(USERNAME)
+    codecs = (TextCodec(user_ids), BinaryCodec(user_ids))
+    requests = {name: ('MESSAGE', USERNAME, SESSION_TOKEN, message) for name, message in MESSAGES.items()}
+    requests['login'] = ('LOGIN', USERNAME, hash_password('password'))
+
+    print(f"{'request':<8} {'codec':<7} {'bytes':>6} {'encode ns':>10} {'decode ns':>10}")
+    for name, request in requests.items():
+        for codec in codecs:
+            data = codec.encode_request(*request)
+            assert codec.decode_request(data) == list(request), (codec.name, name)
+            encode_ns = bench(lambda: codec.encode_request(*request), args.number)
+            decode_ns = bench(lambda: codec.decode_request(data), args.number)
+            print(f"{name:<8} {codec.name:<7} {FRAME_HEADER.size + len(data):>6} {encode_ns:>10.0f} {decode_ns:>10.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+"""
+Benchmark of the conversation cache of the desktop client: the time to switch to a conversation, shown from the
+in-memory LRU or read from the SQLite file, and the bytes of the SINCE delta asked for then, against the page of the
+latest messages the client asked for on every switch before.
+
+The conversations are saved in a temporary file as SINCE pages, the switches go through ChatWindow.on_user_clicked
+with a client recording the requests. No server is involved, run it with QT_QPA_PLATFORM=offscreen without a
+display.
+"""
+import argparse
+import json
+import statistics
+import sys
+import tempfile
+import time
+
+from PyQt5.QtWidgets import QApplication, QListWidgetItem
+
+from ui.conversation_cache import ConversationCache
+from ui.ui_chat_area import ChatWindow
+
+USERNAME = 'bench_user'
+
+
+class RecordingClient:
+    """
+    Stands for ClientChatGui, the requests are recorded and never answered
+    """
+
+    def __init__(self):
+        self.sent = []
+
+    def send_message(self, message: str):
+        self.sent.append(message)
+
+    def request(self, message: str, handler=None):
+        self.sent.append(message)
+
+
+def messages(target, start, count, size):
+    return [[message_id, target if message_id % 2 else USERNAME, 'x' * size, '2024-01-01T00:00:00.000000']
+            for message_id in range(start, start + count)]
+
+
+def timed_switches(app, window, targets):
+    durations = []
+    for target in targets:
+        start = time.perf_counter()
+        window.on_user_clicked(QListWidgetItem(target))
+        app.processEvents()
+        durations.append((time.perf_counter() - start) * 1e3)
+    return statistics.mean(durations)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-c', '--conversations', type=int, default=50)
+    parser.add_argument('-m', '--messages', type=int, default=2_000, help="messages saved by conversation")
+    parser.add_argument('-s', '--size', type=int, default=100, help="message text bytes")
+    parser.add_argument('-n', '--new', type=int, default=10, help="messages received since the last switch")
+    args = parser.parse_args()
+
+    app = QApplication(sys.argv)
+    ConversationCache.DIRECTORY = tempfile.mkdtemp()
+    targets = [f"user_{i}" for i in range(args.conversations)]
+    cache = ConversationCache.for_user(USERNAME)
+    start = time.perf_counter()
+    for number, target in enumerate(targets):
+        first_id = number * args.messages + 1
+        for page in range(0, args.messages, 100):
+            cache.add_since(target, messages(target, first_id + page, min(100, args.messages - page), args.size))
+    saved = time.perf_counter() - start
+    cache.close()
+    print(f"{args.conversations} conversations of {args.messages:,} messages saved, "
+          f"{saved / (args.conversations * args.messages) * 1e6:.1f} us by message")
+
+    window = ChatWindow(RecordingClient())
+    window.resize(600, 800)
+    window.show()
+    window.open_cache(USERNAME)
+    # the conversations read from the file last are the ones still in memory
+    from_file = timed_switches(app, window, targets)
+    from_memory = timed_switches(app, window, targets[-ConversationCache.MAX_CONVERSATIONS:])
+    window.close_cache()
+    print(f"switch from the file: {from_file:.2f} ms, from memory: {from_memory:.2f} ms, "
+          f"{ConversationCache.MAX_MESSAGES} messages shown")
+
+    target = targets[0]
+    since = "SINCE:" + json.dumps({'target': target, 'messages': messages(target, 1, args.new, args.size),
+                                   'after_id': args.new})
+    history = "HISTORY:" + json.dumps({'target': target,
+                                       'messages': messages(target, 1, ChatWindow.HISTORY_PAGE, args.size),
+                                       'before_id': 1})
+    print(f"reply on switch: SINCE of {args.new} new messages {len(since.encode()):,} bytes, "
+          f"HISTORY page of {ChatWindow.HISTORY_PAGE} messages {len(history.encode()):,} bytes")
+
+
+if __name__ == "__main__":
+    main()
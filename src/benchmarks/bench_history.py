@@ -0,0 +1,125 @@
+"""
+Benchmark of the history pages on a generated SQLite file growing to millions of messages: latest page and deep
+page of a busy room and of a busy conversation read by keyset, against the same deep page read with OFFSET.
+
+A tenth of the messages are posts of the lobby room and a twentieth the conversation between user_0 and user_1,
+the others are spread over the other rooms and users.
+"""
+import argparse
+import os
+import random
+import sqlite3
+import statistics
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+
+from models.db import Message
+from models.history import MessageHistory
+from models.message_writer import MessageWriter
+
+USERS = 1_000
+ROOMS = 100
+CHUNK = 100_000
+START = datetime(2024, 1, 1)
+
+
+def generate(path, start, stop):
+    """
+    Insert the messages start to stop, a millisecond apart
+    """
+    rng = random.Random(start)
+
+    def rows():
+        for i in range(start, stop):
+            timestamp = (START + timedelta(milliseconds=i)).strftime('%Y-%m-%d %H:%M:%S.%f')
+            draw = rng.random()
+            if draw < 0.1:
+                yield 1, rng.randint(1, USERS), None, f"lobby {i}", timestamp
+            elif draw < 0.15:
+                sender = rng.randint(1, 2)
+                yield None, sender, 3 - sender, f"direct {i}", timestamp
+            elif draw < 0.6:
+                yield rng.randint(2, ROOMS), rng.randint(1, USERS), None, f"room {i}", timestamp
+            else:
+                yield None, rng.randint(3, USERS), rng.randint(3, USERS), f"direct {i}", timestamp
+
+    connection = sqlite3.connect(path)
+    connection.executemany("INSERT INTO messages (chatroom_id, sender_user_id, receiver_user_id, text, timestamp) "
+                           "VALUES (?, ?, ?, ?, ?)", rows())
+    connection.commit()
+    connection.close()
+
+
+def timed(func, repeat):
+    durations = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        durations.append((time.perf_counter() - start) * 1e3)
+    return statistics.mean(durations)
+
+
+def offset_page(engine, room_id, offset, limit):
+    with Session(engine) as session:
+        return session.execute(select(Message.id, Message.sender_user_id, Message.text, Message.timestamp)
+                               .where(Message.chatroom_id == room_id)
+                               .order_by(Message.timestamp.desc(), Message.id.desc())
+                               .offset(offset).limit(limit)).all()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-s', '--sizes', type=int, nargs='+', default=[100_000, 1_000_000, 3_000_000],
+                        help="table sizes measured, in messages")
+    parser.add_argument('-l', '--limit', type=int, default=50)
+    parser.add_argument('-r', '--repeat', type=int, default=200)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'history.db')
+        writer = MessageWriter(f"sqlite:///{path}")
+        connection = sqlite3.connect(path)
+        connection.executemany("INSERT INTO users (username, email, _password_hash) VALUES (?, ?, '')",
+                               ((f"user_{i}", f"user_{i}@localhost") for i in range(USERS)))
+        connection.executemany("INSERT INTO chatrooms (name) VALUES (?)",
+                               [('lobby',)] + [(f"room_{i}",) for i in range(1, ROOMS)])
+        connection.commit()
+        connection.close()
+        history = MessageHistory(writer.engine)
+
+        print(f"pages of {args.limit} messages, mean ms over {args.repeat} reads")
+        print(f"{'messages':>10} {'room latest':>12} {'room deep':>10} {'OFFSET deep':>12} "
+              f"{'direct latest':>14} {'direct deep':>12}")
+        size = 0
+        for target in args.sizes:
+            for start in range(size, target, CHUNK):
+                generate(path, start, min(start + CHUNK, target))
+            size = target
+            with Session(writer.engine) as session:
+                room_ids = session.scalars(select(Message.id).where(Message.chatroom_id == 1)
+                                           .order_by(Message.timestamp.desc(), Message.id.desc())).all()
+                direct_ids = session.scalars(select(Message.id).where(Message.chatroom_id.is_(None),
+                                                                      Message.sender_user_id.in_((1, 2)),
+                                                                      Message.receiver_user_id.in_((1, 2)))
+                                             .order_by(Message.timestamp.desc(), Message.id.desc())).all()
+            # pages halfway through the lobby and the conversation histories
+            depth = len(room_ids) // 2
+            room_before = room_ids[depth - 1]
+            direct_before = direct_ids[len(direct_ids) // 2 - 1]
+            results = (
+                timed(lambda: history.room('lobby', limit=args.limit), args.repeat),
+                timed(lambda: history.room('lobby', room_before, args.limit), args.repeat),
+                timed(lambda: offset_page(writer.engine, 1, depth, args.limit), max(1, args.repeat // 10)),
+                timed(lambda: history.conversation('user_0', 'user_1', limit=args.limit), args.repeat),
+                timed(lambda: history.conversation('user_0', 'user_1', direct_before, args.limit), args.repeat),
+            )
+            print(f"{size:>10,} {results[0]:>12.3f} {results[1]:>10.3f} {results[2]:>12.3f} "
+                  f"{results[3]:>14.3f} {results[4]:>12.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,300 @@
+"""
+Load test of the chat server: thousands of simulated clients log in, send direct messages to each other at a
+fixed rate, list the active users with /u and log out, over the real protocol. They are ChatClient instances, all
+on the event loop of the benchmark process.
+
+It reports the message throughput, the end-to-end delivery latency, the latency of the logins and /u replies,
+and the CPU time and memory of the server processes. The server runs in a child process started by the benchmark,
+against the local Redis server, or against an in-memory stand-in with --redis memory (needs fakeredis[lua]).
+With --workers, the child is a supervisor of as many server processes sharing the port and the local Redis.
+With --target, an already running server is loaded instead, its process is measured when --server-pid is given.
+
+    python -m benchmarks.bench_load --mode asyncio --clients 2000 --rate 1 --duration 30
+    python -m benchmarks.bench_load --mode asyncio --clients 2000 --rate 4 --duration 30 --workers 4
+"""
+import argparse
+import asyncio
+import functools
+import importlib.util
+import os
+import random
+import socket
+import statistics
+import subprocess
+import sys
+import time
+
+from services.client_side import ChatClient
+from utils.network_socket import read_frame
+from utils.redis_manager import RedisServerManager
+
+PASSWORD = 'password'
+USER_PREFIX = 'load_'
+
+
+def use_memory_redis():
+    """
+    Make the Redis connection pools of this process use an in-memory server
+    """
+    import fakeredis
+    import redis
+
+    redis.BlockingConnectionPool = functools.partial(redis.BlockingConnectionPool,
+                                                     connection_class=fakeredis.FakeConnection,
+                                                     server=fakeredis.FakeServer())
+
+
+def add_users(count, rounds):
+    manager = RedisServerManager()
+    for i in range(count):
+        manager.add_user(f"{USER_PREFIX}{i}", PASSWORD, rounds=rounds)
+
+
+def serve(args):
+    """
+    Server child process, the users are created before it listens
+    """
+    if args.redis == 'memory':
+        use_memory_redis()
+    add_users(args.clients, args.bcrypt_rounds)
+    from services.server import stop_on_terminate
+    stop_on_terminate()
+    if args.workers > 1:
+        from services.supervisor import Supervisor
+        Supervisor(serve_worker, args.workers, (args,)).run()
+    else:
+        serve_worker(None, args)
+
+
+def serve_worker(index, args):
+    """
+    Server process, alone or one of the workers of a supervisor
+    """
+    from services.async_server import AsyncChatServer, raise_open_files_limit
+    from services.server import ChatServer, stop_on_terminate
+    raise_open_files_limit()
+    stop_on_terminate()
+    with (AsyncChatServer if args.mode == 'asyncio' else ChatServer)(
+            'localhost', args.port, rate_limits={}, auth_workers=1 if index is not None else None,
+            reuse_port=index is not None) as server:
+        server.start_server()
+
+
+class ProcessStats:
+    """
+    CPU time and memory of a process and of its children, the workers and password checkers, read from /proc
+    """
+
+    def __init__(self, pid):
+        self.pid = pid
+        self.__ticks = os.sysconf('SC_CLK_TCK')
+
+    def pids(self, pid=None) -> list:
+        pid = pid or self.pid
+        pids = [pid]
+        try:
+            with open(f"/proc/{pid}/task/{pid}/children") as children:
+                for child in children.read().split():
+                    pids.extend(self.pids(int(child)))
+        except OSError:
+            pass
+        return pids
+
+    def cpu_time(self) -> float:
+        ticks = 0
+        for pid in self.pids():
+            try:
+                with open(f"/proc/{pid}/stat") as stat:
+                    # the command name may contain spaces, the fields are counted from its closing parenthesis
+                    fields = stat.read().rsplit(')', 1)[1].split()
+            except OSError:
+                continue
+            ticks += int(fields[11]) + int(fields[12])
+        return ticks / self.__ticks
+
+    def memory(self) -> dict:
+        memory = {'VmRSS': 0, 'VmHWM': 0}
+        for pid in self.pids():
+            try:
+                with open(f"/proc/{pid}/status") as status:
+                    values = dict(line.split(':', 1) for line in status)
+            except OSError:
+                continue
+            for name in memory:
+                memory[name] += int(values[name].split()[0]) // 1024
+        return memory
+
+
+class Stats:
+    def __init__(self):
+        self.latencies = {'login': [], 'delivery': [], '/u': []}
+        self.sent = 0
+        self.delivered = 0
+        self.errors = 0
+
+    def percentiles(self, name):
+        values = sorted(self.latencies[name])
+        if not values:
+            return None
+        return [values[min(len(values) - 1, int(len(values) * q))] * 1e3 for q in (0.5, 0.95, 0.99)] + \
+            [statistics.mean(values) * 1e3]
+
+
+async def read_frames(reader):
+    while True:
+        yield (await read_frame(reader)).decode()
+
+
+class SimulatedClient:
+    def __init__(self, index, peer, args, stats: Stats):
+        self.username = f"{USER_PREFIX}{index}"
+        self.peer = f"{USER_PREFIX}{peer}"
+        self.__args = args
+        self.__stats = stats
+        self.__client = None
+        # send times of the /u requests waiting for their reply
+        self.__user_lists = []
+
+    async def login(self, host, port):
+        self.__client = ChatClient(host, port)
+        await self.__client.connect()
+        start = time.perf_counter()
+        await self.__client.login(self.username, PASSWORD)
+        self.__stats.latencies['login'].append(time.perf_counter() - start)
+
+    async def receive(self):
+        try:
+            while message := await self.__client.receive():
+                sender, _, text = message.partition(': ')
+                if sender.startswith(USER_PREFIX):
+                    self.__stats.latencies['delivery'].append(time.perf_counter() - float(text.split(' ', 1)[0]))
+                    self.__stats.delivered += 1
+                elif message.startswith('ACTIVE_USERS'):
+                    self.__stats.latencies['/u'].append(time.perf_counter() - self.__user_lists.pop(0))
+                else:
+                    self.__stats.errors += 1
+        except ConnectionError:
+            pass
+
+    async def run(self, deadline):
+        interval = 1 / self.__args.rate
+        padding = 'x' * self.__args.size
+        # spread the clients over the first interval
+        await asyncio.sleep(random.random() * interval)
+        next_send = time.perf_counter()
+        while next_send < deadline:
+            if random.random() < self.__args.list_ratio:
+                self.__user_lists.append(time.perf_counter())
+                self.__client.send_message('/u')
+            else:
+                self.__client.send_message(f"@{self.peer} {time.perf_counter():.6f} {padding}")
+                self.__stats.sent += 1
+            await self.__client.drain()
+            next_send += interval
+            await asyncio.sleep(max(0.0, next_send - time.perf_counter()))
+
+    async def logout(self):
+        self.__client.logout()
+        await self.__client.close()
+
+
+async def load(args, host, port, stats: Stats, server: ProcessStats = None):
+    clients = [SimulatedClient(i, (i + 1) % args.clients, args, stats) for i in range(args.clients)]
+    for start in range(0, args.clients, 100):
+        await asyncio.gather(*(client.login(host, port) for client in clients[start:start + 100]))
+    receivers = [asyncio.create_task(client.receive()) for client in clients]
+
+    cpu_start, load_cpu_start, wall_start = server and server.cpu_time(), time.process_time(), time.perf_counter()
+    deadline = wall_start + args.duration
+    await asyncio.gather(*(client.run(deadline) for client in clients))
+    # wait for the messages in flight
+    while stats.delivered + stats.errors < stats.sent and time.perf_counter() < deadline + 5:
+        await asyncio.sleep(0.05)
+    wall = time.perf_counter() - wall_start
+    usage = {'wall': wall, 'load CPU': time.process_time() - load_cpu_start}
+    if server:
+        usage.update(server.memory(), **{'server CPU': server.cpu_time() - cpu_start})
+
+    await asyncio.gather(*(client.logout() for client in clients))
+    for receiver in receivers:
+        receiver.cancel()
+    return usage
+
+
+def wait_for_port(host, port, timeout=60):
+    deadline = time.perf_counter() + timeout
+    while True:
+        try:
+            socket.create_connection((host, port), timeout=1).close()
+            return
+        except OSError:
+            if time.perf_counter() > deadline:
+                raise
+            time.sleep(0.1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--mode', choices=('asyncio', 'threaded'), default='asyncio')
+    parser.add_argument('--redis', choices=('local', 'memory'), default='local')
+    parser.add_argument('--port', type=int, default=12398)
+    parser.add_argument('--target', help="host:port of a running server, its Redis must be the local one")
+    parser.add_argument('--server-pid', type=int, help="process of the --target server")
+    parser.add_argument('-c', '--clients', type=int, default=1000)
+    parser.add_argument('-r', '--rate', type=float, default=1.0, help="requests per second of each client")
+    parser.add_argument('-s', '--size', type=int, default=100, help="message padding in bytes")
+    parser.add_argument('-l', '--list-ratio', type=float, default=0.01, help="share of the requests being /u")
+    parser.add_argument('-d', '--duration', type=float, default=20.0, help="seconds")
+    parser.add_argument('-w', '--workers', type=int, default=1, help="server processes sharing the port")
+    parser.add_argument('--bcrypt-rounds', type=int, default=4, help="cost of the users password hashes, 0 for sha256")
+    parser.add_argument('--serve', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.workers > 1 and args.redis == 'memory':
+        parser.error("the in-memory Redis is not shared between the --workers processes")
+    if args.redis == 'memory' and importlib.util.find_spec('fakeredis') is None:
+        parser.error("the in-memory Redis needs fakeredis, pip install -r requirements-dev.txt")
+
+    if args.serve:
+        serve(args)
+        return
+
+    from services.async_server import raise_open_files_limit
+    raise_open_files_limit()
+    process = None
+    if args.target:
+        host, port = args.target.rsplit(':', 1)
+        port = int(port)
+        add_users(args.clients, args.bcrypt_rounds)
+        server = ProcessStats(args.server_pid) if args.server_pid else None
+    else:
+        host, port = 'localhost', args.port
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join(path for path in sys.path if path))
+        process = subprocess.Popen([sys.executable, '-m', 'benchmarks.bench_load', '--serve', *sys.argv[1:]],
+                                   env=env, stdout=subprocess.DEVNULL)
+        server = ProcessStats(process.pid)
+    try:
+        wait_for_port(host, port)
+        stats = Stats()
+        usage = asyncio.run(load(args, host, port, stats, server))
+    finally:
+        if process:
+            process.terminate()
+            process.wait()
+
+    print(f"{args.mode if process else args.target} server, {args.workers} process(es), {args.redis} Redis, "
+          f"{args.clients} clients, {args.rate:g} requests/s each, {args.size} bytes padding, {args.duration:g} s")
+    print(f"messages: {stats.sent:,} sent, {stats.delivered:,} delivered, {stats.errors:,} errors, "
+          f"{stats.delivered / usage['wall']:,.0f} delivered/s")
+    print(f"{'latency ms':<12} {'p50':>9} {'p95':>9} {'p99':>9} {'mean':>9}")
+    for name in stats.latencies:
+        values = stats.percentiles(name)
+        if values:
+            print(f"{name:<12} " + ' '.join(f"{value:>9.2f}" for value in values))
+    if server:
+        print(f"server: CPU {usage['server CPU'] / usage['wall']:.0%}, RSS {usage['VmRSS']} MiB, "
+              f"peak RSS {usage['VmHWM']} MiB (sum of the processes)")
+    print(f"load generator: CPU {usage['load CPU'] / usage['wall']:.0%}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,165 @@
+"""
+Benchmark of a reconnect storm: all the users log in at once, as after a server restart, while two logged-in
+users keep exchanging messages.
+
+It reports the logins per second, the login latency, the AUTH_BUSY replies (the client retries after a short
+pause) and the delivery latency of the messages before and during the storm, for the password checks done in
+worker processes or in the request loop (--auth-workers 0). The server runs in a child process started by the
+benchmark, its users are created with bcrypt hashes of --bcrypt-rounds cost.
+
+    python -m benchmarks.bench_login_storm --redis memory --users 200 --auth-workers 0
+    python -m benchmarks.bench_login_storm --redis memory --users 200 --auth-workers 1
+"""
+import argparse
+import asyncio
+import os
+import random
+import subprocess
+import sys
+import time
+
+from benchmarks.bench_load import use_memory_redis, wait_for_port, read_frames, PASSWORD
+from utils.credentials import hash_credential
+from utils.network_socket import FRAME_HEADER, encode_frame
+from utils.protocol import TextCodec
+from utils.redis_manager import RedisServerManager, hash_password
+
+USER_PREFIX = 'storm_'
+CHATTERS = ('storm_chatter_a', 'storm_chatter_b')
+codec = TextCodec()
+
+
+def serve(args):
+    """
+    Server child process, the users are created before it listens
+    """
+    if args.redis == 'memory':
+        use_memory_redis()
+    manager = RedisServerManager()
+    # one bcrypt hash for all, hashing each user would take longer than the storm
+    password_hash = hash_credential(hash_password(PASSWORD), args.bcrypt_rounds)
+    for username in [f"{USER_PREFIX}{i}" for i in range(args.users)] + list(CHATTERS):
+        manager._redis_client.hset(f"user:{username}", mapping={"password_hash": password_hash})
+    from services.async_server import AsyncChatServer, raise_open_files_limit
+    from services.server import ChatServer, stop_on_terminate
+    raise_open_files_limit()
+    stop_on_terminate()
+    with (AsyncChatServer if args.mode == 'asyncio' else ChatServer)(
+            'localhost', args.port, auth_workers=args.auth_workers, max_pending_logins=args.max_pending,
+            rate_limits={}) as server:
+        server.start_server()
+
+
+def percentiles(values):
+    values = sorted(values)
+    if not values:
+        return '-'
+    return ' '.join(f"{values[min(len(values) - 1, int(len(values) * q))] * 1e3:>9.1f}" for q in (0.5, 0.99, 1.0))
+
+
+async def login(host, port, username, busy: list):
+    """
+    Log a user in, retrying while the server is busy
+    :return: reader, writer and session token
+    """
+    reader, writer = await asyncio.open_connection(host, port)
+    while True:
+        writer.write(encode_frame(codec.encode_request('LOGIN', username, hash_password(PASSWORD))))
+        header = await reader.readexactly(FRAME_HEADER.size)
+        response = (await reader.readexactly(FRAME_HEADER.unpack(header)[0])).decode()
+        if response.startswith('SESSION_START'):
+            return reader, writer, response.split(':')[1]
+        if not response.startswith('AUTH_BUSY'):
+            raise RuntimeError(f"{username} login failed: {response}")
+        busy.append(username)
+        await asyncio.sleep(0.05 + random.random() * 0.05)
+
+
+async def chat(host, port, interval, latencies: dict, phase: list):
+    """
+    Chatter a sends timestamped messages to chatter b, the delivery latencies are recorded by phase
+    """
+    _, writer, session_token = await login(host, port, CHATTERS[0], [])
+    reader, receiver, _ = await login(host, port, CHATTERS[1], [])
+
+    async def receive():
+        async for message in read_frames(reader):
+            sender, _, text = message.partition(': ')
+            if sender == CHATTERS[0]:
+                latencies[phase[0]].append(time.perf_counter() - float(text))
+
+    receiving = asyncio.create_task(receive())
+    try:
+        while True:
+            writer.write(encode_frame(codec.encode_request('MESSAGE', CHATTERS[0], session_token,
+                                                           f"@{CHATTERS[1]} {time.perf_counter():.6f}")))
+            await asyncio.sleep(interval)
+    finally:
+        receiving.cancel()
+        writer.close()
+        receiver.close()
+
+
+async def storm(args, host, port):
+    latencies = {'before': [], 'storm': []}
+    phase = ['before']
+    chatting = asyncio.create_task(chat(host, port, args.interval, latencies, phase))
+    await asyncio.sleep(args.warmup)
+
+    phase[0] = 'storm'
+    busy, login_latencies = [], []
+
+    async def timed_login(username):
+        start = time.perf_counter()
+        _, writer, _ = await login(host, port, username, busy)
+        login_latencies.append(time.perf_counter() - start)
+        return writer
+
+    start = time.perf_counter()
+    writers = await asyncio.gather(*(timed_login(f"{USER_PREFIX}{i}") for i in range(args.users)))
+    elapsed = time.perf_counter() - start
+    chatting.cancel()
+    for writer in writers:
+        writer.close()
+    return latencies, login_latencies, busy, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--mode', choices=('asyncio', 'threaded'), default='asyncio')
+    parser.add_argument('--redis', choices=('local', 'memory'), default='local')
+    parser.add_argument('--port', type=int, default=12397)
+    parser.add_argument('-u', '--users', type=int, default=200, help="users logging in at once")
+    parser.add_argument('--bcrypt-rounds', type=int, default=10)
+    parser.add_argument('--auth-workers', type=int, help="password check processes, 0 checks in the request loop")
+    parser.add_argument('--max-pending', type=int, default=256, help="password checks over which AUTH_BUSY")
+    parser.add_argument('--interval', type=float, default=0.02, help="seconds between the chatter messages")
+    parser.add_argument('--warmup', type=float, default=2.0, help="seconds of messages before the storm")
+    parser.add_argument('--serve', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve:
+        serve(args)
+        return
+
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(path for path in sys.path if path))
+    process = subprocess.Popen([sys.executable, '-m', 'benchmarks.bench_login_storm', '--serve', *sys.argv[1:]],
+                               env=env, stdout=subprocess.DEVNULL)
+    try:
+        wait_for_port('localhost', args.port, timeout=600)
+        latencies, login_latencies, busy, elapsed = asyncio.run(storm(args, 'localhost', args.port))
+    finally:
+        process.terminate()
+        process.wait()
+
+    workers = 'request loop' if args.auth_workers == 0 else f"{args.auth_workers or 'default'} worker(s)"
+    print(f"{args.mode} server, password checks in {workers}, {args.users} users, bcrypt cost {args.bcrypt_rounds}")
+    print(f"logins: {args.users / elapsed:.1f}/s, all done in {elapsed:.2f} s, {len(busy)} AUTH_BUSY replies")
+    print(f"{'latency ms':<20} {'p50':>9} {'p99':>9} {'max':>9} {'count':>7}")
+    print(f"{'login':<20} {percentiles(login_latencies)} {len(login_latencies):>7}")
+    for name, values in latencies.items():
+        print(f"{'message ' + name:<20} {percentiles(values)} {len(values):>7}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+"""
+Benchmark of the messages persistence on a SQLite file: one commit per message, as a delivery writing through to
+the database would do, against the write-behind MessageWriter with several batch sizes.
+
+For the write-behind writer, "write" is the time spent by the delivery per message and "persisted" the rate at
+which the messages reach the database, stop included.
+"""
+import argparse
+import os
+import tempfile
+import time
+
+from sqlalchemy import func, insert, select
+from sqlalchemy.orm import Session
+
+from models.db import User, Message
+from models.message_writer import MessageWriter
+
+USERS = 100
+
+
+def write_through(url, count):
+    writer = MessageWriter(url)
+    with Session(writer.engine) as session:
+        session.execute(insert(User), [{'username': f"user_{i}", 'email': f"user_{i}@localhost",
+                                        '_password_hash': ''} for i in range(USERS)])
+        session.commit()
+        start = time.perf_counter()
+        for i in range(count):
+            session.execute(insert(Message), {'sender_user_id': i % USERS + 1, 'receiver_user_id': (i + 1) % USERS + 1,
+                                              'text': f"message {i}"})
+            session.commit()
+        return time.perf_counter() - start
+
+
+def write_behind(url, count, batch_size):
+    writer = MessageWriter(url, batch_size=batch_size)
+    writer.start()
+    start = time.perf_counter()
+    for i in range(count):
+        writer.write(f"user_{i % USERS}", f"message {i}", receiver=f"user_{(i + 1) % USERS}")
+    write_time = time.perf_counter() - start
+    writer.stop()
+    persist_time = time.perf_counter() - start
+    with Session(writer.engine) as session:
+        assert session.scalar(select(func.count(Message.id))) == count == writer.written
+    return write_time, persist_time
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-n', '--messages', type=int, default=100_000)
+    parser.add_argument('--write-through', type=int, default=2_000, help="messages committed one by one")
+    parser.add_argument('-b', '--batch-sizes', type=int, nargs='+', default=[100, 1_000, 10_000])
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        def url(name):
+            return f"sqlite:///{os.path.join(directory, name)}.db"
+
+        elapsed = write_through(url('write_through'), args.write_through)
+        print(f"{'':<24} {'write us/msg':>14} {'persisted msg/s':>16}")
+        print(f"{'commit per message':<24} {elapsed / args.write_through * 1e6:>14.1f} "
+              f"{args.write_through / elapsed:>16,.0f}")
+        for batch_size in args.batch_sizes:
+            write_time, persist_time = write_behind(url(f"batch_{batch_size}"), args.messages, batch_size)
+            print(f"{f'write-behind batch {batch_size}':<24} {write_time / args.messages * 1e6:>14.1f} "
+                  f"{args.messages / persist_time:>16,.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+"""
+Benchmark of the metrics overhead on the hot path: a direct message request served by ChatServer._handle_request,
+one request out of REQUEST_SAMPLE timed and observed in the request latency histogram, against the same request
+going through the same steps (envelope, connection rate limit, decoding, handler) without instrumentation.
+A sample of 1 times every request.
+
+No socket is involved, the connections only record what is sent to them. It needs a running Redis server for
+the logins, the benchmark users metrics_* are created and deleted.
+"""
+import argparse
+import time
+
+from services.server import ChatServer
+from utils.protocol import TextCodec, BinaryCodec, decode_correlated
+from utils.redis_manager import RedisServerManager, hash_password
+
+PASSWORD = 'password'
+codec = TextCodec()
+
+
+class RecordingConnection:
+    def __init__(self):
+        self.last = b''
+
+    def sendall(self, data: bytes):
+        self.last = data
+
+
+def login(server, username):
+    conn = RecordingConnection()
+    server._handle_request(conn, codec.encode_request('LOGIN', username, hash_password(PASSWORD)))
+    # frame header, then SESSION_START:<token>:<uid>
+    return conn, conn.last[4:].decode().split(':')[1]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-n', '--requests', type=int, default=10_000, help="requests by round")
+    parser.add_argument('-r', '--rounds', type=int, default=30)
+    parser.add_argument('-s', '--samples', type=int, nargs='+', default=[1, ChatServer.REQUEST_SAMPLE],
+                        help="one request timed out of")
+    args = parser.parse_args()
+
+    manager = RedisServerManager()
+    for username in ('metrics_a', 'metrics_b'):
+        manager.add_user(username, PASSWORD, rounds=0)
+    servers = {}
+    for sample in args.samples:
+        server = type('SampledServer', (ChatServer,), {'REQUEST_SAMPLE': sample})('localhost', 0, rate_limits={})
+        conn, session_token = login(server, 'metrics_a')
+        login(server, 'metrics_b')
+        servers[sample] = server, conn, codec.encode_request('MESSAGE', 'metrics_a', session_token,
+                                                             '@metrics_b hello')
+
+    def bare_dispatch(server, conn, data, decoder=BinaryCodec()):
+        if server._ChatServer__rate_limited_request(conn, server._connection_limits, conn, 'connection'):
+            return
+        command, *request_args = decoder.decode_request(data)
+        server._ChatServer__requests[command](conn, *request_args)
+
+    def bare_request(server, conn, request):
+        # the calls of _handle_request without the metrics
+        _, data = decode_correlated(request)
+        bare_dispatch(server, conn, data)
+
+    def instrumented_request(server, conn, request):
+        server._handle_request(conn, request)
+
+    results = {}
+    # interleaved rounds, so both see the same machine noise
+    for _ in range(args.rounds):
+        for sample, (server, conn, request) in servers.items():
+            for name, func in (('without', bare_request), ('with', instrumented_request)):
+                start = time.perf_counter()
+                for _ in range(args.requests):
+                    func(server, conn, request)
+                results.setdefault((sample, name), []).append((time.perf_counter() - start) / args.requests)
+
+    print(f"direct message request, mean by round of {args.requests:,}, over {args.rounds} rounds, in us")
+    print(f"{'sample':>6} {'metrics':<8} {'best':>8} {'median':>8}")
+    for (sample, name), values in results.items():
+        values.sort()
+        print(f"{sample:>6} {name:<8} {values[0] * 1e6:>8.2f} {values[len(values) // 2] * 1e6:>8.2f}")
+    for sample in servers:
+        overheads = [results[sample, 'with'][i] / results[sample, 'without'][i] - 1 for i in (0, args.rounds // 2)]
+        print(f"overhead, one request timed out of {sample}: {overheads[0]:+.1%} best, {overheads[1]:+.1%} median")
+
+    for username in ('metrics_a', 'metrics_b'):
+        manager.end_session(username)
+        manager.delete_user(username)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+"""
+Benchmark of the delivery of the offline messages on login: the time for the server to drain 10,000 messages
+queued while a user was logged out, the frames written and the Redis round-trips, by messages read at once
+(ChatServer.OFFLINE_BATCH). A batch of 1 stands for a write and a cursor update by message.
+
+The messages are queued and the user logs in through ChatServer._handle_request, no socket is involved. It needs
+a running Redis server, the benchmark users drain_* are created and deleted.
+"""
+import argparse
+import time
+
+from services.server import ChatServer
+from utils.protocol import TextCodec
+from utils.redis_manager import RedisServerManager, hash_password
+
+PASSWORD = 'password'
+SENDER, RECEIVER = 'drain_sender', 'drain_receiver'
+codec = TextCodec()
+
+
+class RecordingConnection:
+    def __init__(self):
+        self.last = b''
+        self.writes = 0
+        self.bytes = 0
+
+    def sendall(self, data: bytes):
+        self.last = data
+        self.writes += 1
+        self.bytes += len(data)
+
+
+class CountingRedis:
+    """
+    Count the round-trips of the offline messages delivery
+    """
+
+    def __init__(self, manager: RedisServerManager):
+        self.round_trips = 0
+        for name in ('offline_messages', 'ack_offline_messages'):
+            setattr(manager, name, self.__counted(getattr(manager, name)))
+
+    def __counted(self, func):
+        def counted(*args):
+            self.round_trips += 1
+            return func(*args)
+        return counted
+
+
+def login(server, username):
+    conn = RecordingConnection()
+    server._handle_request(conn, codec.encode_request('LOGIN', username, hash_password(PASSWORD)))
+    return conn
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-m', '--messages', type=int, default=10_000, help="messages queued")
+    parser.add_argument('-s', '--size', type=int, default=100, help="message text bytes")
+    parser.add_argument('-b', '--batches', type=int, nargs='+', default=[1, 100, 1000, 10_000])
+    args = parser.parse_args()
+
+    manager = RedisServerManager()
+    for username in (SENDER, RECEIVER):
+        manager.add_user(username, PASSWORD, rounds=0)
+
+    print(f"{args.messages:,} offline messages of {args.size} bytes")
+    print(f"{'batch':>7} {'drain ms':>9} {'us / msg':>9} {'frames':>7} {'round-trips':>12} {'KiB sent':>9}")
+    for batch in args.batches:
+        server = type('DrainServer', (ChatServer,), {'OFFLINE_BATCH': batch})(
+            'localhost', 0, rate_limits={}, offline_limit=args.messages)
+        sender = login(server, SENDER)
+        session_token = sender.last[4:].decode().split(':')[1]
+        text = 'x' * args.size
+        for _ in range(args.messages):
+            server._handle_request(sender, codec.encode_request('MESSAGE', SENDER, session_token,
+                                                                f"@{RECEIVER} {text}"))
+
+        counts = CountingRedis(server._redis)
+        start = time.perf_counter()
+        receiver = login(server, RECEIVER)
+        elapsed = time.perf_counter() - start
+        # the SESSION_START reply is left out
+        print(f"{batch:>7,} {elapsed * 1e3:>9.1f} {elapsed / args.messages * 1e6:>9.2f} {receiver.writes - 1:>7,} "
+              f"{counts.round_trips:>12,} {receiver.bytes / 1024:>9.0f}")
+        for username in (SENDER, RECEIVER):
+            manager.end_session(username)
+
+    for username in (SENDER, RECEIVER):
+        manager.delete_user(username)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+"""
+Benchmark of the client requests: one request at a time, each waiting for its reply as ChatClient.login did, against
+many requests in flight on the same connection, matched to their reply by correlation id.
+
+A local asyncio server answers each correlated request after a random delay, a server and network latency of
+--delay ms on average, so the replies come back out of order. No chat server or Redis is involved.
+"""
+import argparse
+import asyncio
+import random
+import statistics
+import time
+
+from services.client_side import ChatClient
+from utils.network_socket import encode_frame, read_frame
+from utils.protocol import decode_correlated, encode_reply
+
+HOST = 'localhost'
+
+
+async def serve(port, delay):
+    async def answer(reader, writer):
+        loop = asyncio.get_running_loop()
+        try:
+            while True:
+                correlation_id, _ = decode_correlated(await read_frame(reader))
+                loop.call_later(random.uniform(0, 2 * delay), writer.write,
+                                encode_frame(encode_reply(correlation_id, 'OK')))
+        except asyncio.IncompleteReadError:
+            writer.close()
+
+    return await asyncio.start_server(answer, HOST, port)
+
+
+async def timed_request(client, latencies):
+    start = time.perf_counter()
+    await client.request('PING')
+    latencies.append(time.perf_counter() - start)
+
+
+async def run(args, in_flight):
+    server = await serve(args.port, args.delay / 1e3)
+    client = ChatClient(HOST, args.port)
+    await client.connect()
+    latencies = []
+    start = time.perf_counter()
+    for first in range(0, args.requests, in_flight):
+        await asyncio.gather(*(timed_request(client, latencies)
+                               for _ in range(min(in_flight, args.requests - first))))
+    elapsed = time.perf_counter() - start
+    await client.close()
+    server.close()
+    await server.wait_closed()
+    return elapsed, latencies
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-r', '--requests', type=int, default=2_000)
+    parser.add_argument('-d', '--delay', type=float, default=2.0, help="mean reply delay in ms")
+    parser.add_argument('-f', '--in-flight', type=int, nargs='+', default=[1, 10, 100],
+                        help="requests in flight at once, 1 is one at a time")
+    parser.add_argument('--port', type=int, default=12398)
+    args = parser.parse_args()
+
+    print(f"{args.requests:,} requests, replies after {args.delay} ms on average")
+    print(f"{'in flight':>9} {'requests/s':>11} {'p50 ms':>7} {'p99 ms':>7}")
+    for in_flight in args.in_flight:
+        elapsed, latencies = asyncio.run(run(args, in_flight))
+        percentiles = statistics.quantiles(latencies, n=100)
+        print(f"{in_flight:>9,} {args.requests / elapsed:>11,.0f} {percentiles[49] * 1e3:>7.2f} "
+              f"{percentiles[98] * 1e3:>7.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,52 @@
+"""
+Benchmark of the rate limits: the time to take a token from the in-process buckets and from the Redis ones shared
+by the nodes, and the memory the in-process buckets hold by active user.
+
+It needs a running Redis server for the Redis buckets, their keys rate_limit:bench:* expire by themselves.
+"""
+import argparse
+import time
+import tracemalloc
+
+from utils.rate_limit import RateLimiter, RedisRateLimiter
+from utils.redis_manager import RedisServerManager
+
+LIMITS = {'@': (10, 30), '/': (5, 20)}
+
+
+def time_acquire(limiter, users, requests):
+    start = time.perf_counter()
+    for i in range(requests):
+        limiter.acquire(f"bench:{i % users}", '@' if i % 4 else '/')
+    return (time.perf_counter() - start) / requests
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-u', '--users', type=int, default=100_000)
+    parser.add_argument('-r', '--requests', type=int, default=200_000)
+    parser.add_argument('--redis-requests', type=int, default=10_000)
+    args = parser.parse_args()
+
+    usernames = [f"bench:{i}" for i in range(args.users)]
+    tracemalloc.start()
+    limiter = RateLimiter(LIMITS)
+    before = tracemalloc.get_traced_memory()[0]
+    for username in usernames:
+        limiter.acquire(username, '@')
+        limiter.acquire(username, '/')
+    held = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    print(f"{args.users:,} active users, two request types each: {held / args.users:.0f} bytes by user")
+    for username in usernames:
+        limiter.forget(username)
+    print(f"buckets left after the users left: {len(limiter)}")
+
+    print(f"{'buckets':<12} {'us by request':>14}")
+    print(f"{'in process':<12} {time_acquire(RateLimiter(LIMITS), args.users, args.requests) * 1e6:>14.2f}")
+    redis_limiter = RedisRateLimiter(RedisServerManager(), LIMITS)
+    print(f"{'redis':<12} {time_acquire(redis_limiter, args.users, args.redis_requests) * 1e6:>14.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,122 @@
+"""
+Benchmark of the Redis work done by a login and a logout: round-trips and latency per operation, with the
+previous serial commands and with RedisServerManager start_session/end_session.
+
+Needs a running Redis server, the benchmark users user:bench_* are created and deleted.
+"""
+import argparse
+import json
+import statistics
+import time
+
+import redis
+
+from utils.redis_manager import RedisServerManager, hash_password
+
+PASSWORD_HASH = hash_password('password')
+CHANNEL = 'session_invalidation'
+
+
+class RoundTrips:
+    """
+    Count the commands or pipelines sent to Redis, one per round-trip
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.__send_packed_command = redis.Connection.send_packed_command
+
+    def __enter__(self):
+        counter = self
+
+        def send_packed_command(connection, *args, **kwargs):
+            counter.count += 1
+            return counter.__send_packed_command(connection, *args, **kwargs)
+
+        redis.Connection.send_packed_command = send_packed_command
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        redis.Connection.send_packed_command = self.__send_packed_command
+
+
+def serial_login(client, username):
+    """
+    Login as done before, authenticate, test and add active user, debug print of active users, session, notify
+    """
+    if client.hget(f"user:{username}", "password_hash").decode() != PASSWORD_HASH:
+        return False
+    if username not in client.smembers("active_users"):
+        client.sadd("active_users", username)
+    client.smembers("active_users")
+    client.set(username, json.dumps(json.dumps({'session_token': 'token'})), ex=1800)
+    client.publish(CHANNEL, username)
+    return True
+
+
+def serial_logout(client, username):
+    client.delete(username)
+    client.publish(CHANNEL, username)
+    client.srem("active_users", username)
+
+
+def pipelined_login(manager, username):
+    return manager.start_session(username, PASSWORD_HASH, json.dumps({'session_token': 'token'}), expiry=1800,
+                                 notify=(CHANNEL, username))
+
+
+def pipelined_logout(manager, username):
+    manager.end_session(username, notify=(CHANNEL, username))
+
+
+def run(name, login, logout, usernames):
+    latencies = {'login': [], 'logout': []}
+    round_trips = {'login': 0, 'logout': 0}
+    with RoundTrips() as counter:
+        for username in usernames:
+            for operation, func in (('login', login), ('logout', logout)):
+                count = counter.count
+                start = time.perf_counter()
+                func(username)
+                latencies[operation].append((time.perf_counter() - start) * 1e6)
+                round_trips[operation] += counter.count - count
+    results = []
+    for operation, values in latencies.items():
+        values.sort()
+        results.append(f"{name:<10} {operation:<7} {round_trips[operation] / len(usernames):>11.1f} "
+                       f"{statistics.mean(values):>9.0f} {values[len(values) // 2]:>9.0f} "
+                       f"{values[int(len(values) * .99)]:>9.0f}")
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=6379)
+    parser.add_argument('-n', '--number', type=int, default=2000, help="logins per run")
+    args = parser.parse_args()
+
+    manager = RedisServerManager(args.host, args.port)
+    usernames = [f"bench_{i}" for i in range(args.number)]
+    for username in usernames:
+        # sha256 stored hashes, compared by the script as before the password checks moved to workers
+        manager.add_user(username, 'password', rounds=0)
+    # load the script once, not measured
+    pipelined_login(manager, usernames[0])
+    pipelined_logout(manager, usernames[0])
+
+    try:
+        results = run('serial', lambda u: serial_login(manager._redis_client, u),
+                      lambda u: serial_logout(manager._redis_client, u), usernames)
+        results += run('pipelined', lambda u: pipelined_login(manager, u), lambda u: pipelined_logout(manager, u),
+                       usernames)
+    finally:
+        for username in usernames:
+            manager.delete_user(username)
+    print("latencies in microseconds")
+    print(f"{'mode':<10} {'op':<7} {'round-trips':>11} {'mean':>9} {'p50':>9} {'p99':>9}")
+    print('\n'.join(results))
+
+
+if __name__ == "__main__":
+    main()
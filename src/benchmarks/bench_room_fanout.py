@@ -0,0 +1,137 @@
+"""
+Benchmark of a room post fanned out to thousands of members: time until every member received it, and latency
+of a post in another room sent right after it.
+
+The server runs in this process, it needs a running Redis server. The benchmark users user:fanout_* are created
+and deleted. Each member holds a connection, so twice the members of file descriptors are needed.
+"""
+import argparse
+import selectors
+import statistics
+import threading
+import time
+
+from services.async_server import AsyncChatServer, raise_open_files_limit
+from services.server import ChatServer
+from utils.network_socket import NetworkSocket, encode_frame
+from utils.protocol import TextCodec
+from utils.redis_manager import RedisServerManager, hash_password
+
+PASSWORD = 'password'
+codec = TextCodec()
+
+
+def login(port, username):
+    client = NetworkSocket('localhost', port)
+    client.connect()
+    client.send_data(codec.encode_request('LOGIN', username, hash_password(PASSWORD)))
+    _, session_token, _ = client.receive_data().split(':')
+    return client, session_token
+
+
+def send(client, username, session_token, message):
+    client.send_data(codec.encode_request('MESSAGE', username, session_token, message))
+
+
+class Readers:
+    """
+    Read the members connections from one thread, counting the received bytes
+    """
+
+    def __init__(self, clients):
+        self.received = 0
+        self.__selector = selectors.DefaultSelector()
+        for client in clients:
+            client.sock.setblocking(False)
+            self.__selector.register(client.sock, selectors.EVENT_READ)
+        self.__stopped = False
+        self.__thread = threading.Thread(target=self.__read, daemon=True)
+        self.__thread.start()
+
+    def wait(self, size, timeout=60):
+        deadline = time.perf_counter() + timeout
+        while self.received < size:
+            if time.perf_counter() > deadline:
+                raise TimeoutError(f"Received {self.received} bytes out of {size}")
+            time.sleep(0.0005)
+        return time.perf_counter()
+
+    def stop(self):
+        self.__stopped = True
+        self.__thread.join()
+
+    def __read(self):
+        while not self.__stopped:
+            for key, _ in self.__selector.select(timeout=0.1):
+                self.received += len(key.fileobj.recv(65536))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--mode', choices=('asyncio', 'threaded'), default='asyncio')
+    parser.add_argument('--port', type=int, default=12399)
+    parser.add_argument('-m', '--members', type=int, default=5000)
+    parser.add_argument('-p', '--posts', type=int, default=20)
+    parser.add_argument('-s', '--size', type=int, default=200, help="post size in bytes")
+    args = parser.parse_args()
+
+    raise_open_files_limit()
+    manager = RedisServerManager()
+    usernames = [f"fanout_{i}" for i in range(args.members + 3)]
+    for username in usernames:
+        # sha256 stored hashes, the logins are not measured
+        manager.add_user(username, PASSWORD, rounds=0)
+    members, (poster, other_poster, other_member) = usernames[:args.members], usernames[args.members:]
+
+    server = (AsyncChatServer if args.mode == 'asyncio' else ChatServer)('localhost', args.port, rate_limits={})
+    with server:
+        threading.Thread(target=server.start_server, daemon=True).start()
+        time.sleep(0.5)
+        poster_client, poster_token = login(args.port, poster)
+        for request in ('/create big', '/create other', '/join big'):
+            send(poster_client, poster, poster_token, request)
+            poster_client.receive_data()
+        clients = []
+        for username in members:
+            client, session_token = login(args.port, username)
+            send(client, username, session_token, '/join big')
+            client.receive_data()
+            clients.append(client)
+        other_clients = []
+        for username in (other_poster, other_member):
+            client, session_token = login(args.port, username)
+            send(client, username, session_token, '/join other')
+            client.receive_data()
+            other_clients.append((client, session_token))
+        (other_client, other_token), (member_client, _) = other_clients
+
+        readers = Readers(clients)
+        text = 'x' * args.size
+        frame_size = len(encode_frame(f"#big {poster}: {text}"))
+        fan_out, other_room = [], []
+        for post in range(args.posts):
+            start = time.perf_counter()
+            send(poster_client, poster, poster_token, f"/post big {text}")
+            # a post in another room right behind the big one
+            send(other_client, other_poster, other_token, "/post other ping")
+            member_client.receive_data()
+            other_room.append((time.perf_counter() - start) * 1e3)
+            fan_out.append((readers.wait(frame_size * args.members * (post + 1)) - start) * 1e3)
+        readers.stop()
+
+        print(f"{args.mode} server, {args.members} members, {args.posts} posts of {args.size} bytes, in ms")
+        print(f"{'':<22} {'mean':>8} {'p50':>8} {'max':>8}")
+        for name, values in (('fan-out to all members', fan_out), ('other room post', other_room)):
+            values.sort()
+            print(f"{name:<22} {statistics.mean(values):>8.2f} {values[len(values) // 2]:>8.2f} {values[-1]:>8.2f}")
+        print(f"fan-out rate: {args.members / statistics.mean(fan_out) * 1e3:,.0f} deliveries/s")
+
+    for username in usernames:
+        manager.delete_user(username)
+        manager.leave_room('big', username)
+        manager.leave_room('other', username)
+    manager._redis_client.srem(manager.ROOMS, 'big', 'other')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+"""
+Benchmark of the session expiry sweeps with hundreds of thousands of sessions: the timer wheel of the server
+against a scan of all the session deadlines on each sweep.
+
+The sessions start spread over one expiry period, a share of them is renewed or logged out before expiring. The
+clock is simulated, a sweep runs each tick for two expiry periods. No Redis is involved.
+"""
+import argparse
+import random
+import time
+
+from utils.timer_wheel import TimerWheel
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def run_wheel(sessions, args):
+    clock = Clock()
+    wheel = TimerWheel(tick=1.0, clock=clock)
+    start = time.perf_counter()
+    for username, delay in sessions:
+        wheel.schedule(username, delay)
+    schedule = time.perf_counter() - start
+
+    sweeps, expired = [], 0
+    for tick in range(1, 2 * args.expiry + 1):
+        clock.now = tick
+        for username in renewed_or_ended(tick, args):
+            if username % 2:
+                wheel.schedule(username, args.expiry)
+            else:
+                wheel.cancel(username)
+        start = time.perf_counter()
+        expired += len(wheel.expired())
+        sweeps.append(time.perf_counter() - start)
+    return schedule, sweeps, expired
+
+
+def run_scan(sessions, args):
+    clock = Clock()
+    start = time.perf_counter()
+    deadlines = {username: clock.now + delay for username, delay in sessions}
+    schedule = time.perf_counter() - start
+
+    sweeps, expired = [], 0
+    for tick in range(1, min(2 * args.expiry, args.scan_ticks) + 1):
+        clock.now = tick
+        for username in renewed_or_ended(tick, args):
+            if username % 2:
+                deadlines[username] = clock.now + args.expiry
+            else:
+                deadlines.pop(username, None)
+        start = time.perf_counter()
+        gone = [username for username, deadline in deadlines.items() if deadline <= clock.now]
+        for username in gone:
+            del deadlines[username]
+        expired += len(gone)
+        sweeps.append(time.perf_counter() - start)
+    return schedule, sweeps, expired
+
+
+def renewed_or_ended(tick, args):
+    # the next users at each tick, the odd ones are renewed and the even ones log out
+    count = int(args.sessions * args.renew_ratio / args.expiry)
+    start = tick * count % args.sessions
+    return range(start, min(start + count, args.sessions))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-s', '--sessions', type=int, default=300_000)
+    parser.add_argument('-e', '--expiry', type=int, default=1800, help="session expiry in seconds")
+    parser.add_argument('--renew-ratio', type=float, default=0.1,
+                        help="share of the sessions renewed or ended by expiry period")
+    parser.add_argument('--scan-ticks', type=int, default=60, help="sweeps measured for the scan, it is slow")
+    args = parser.parse_args()
+
+    random.seed(1)
+    sessions = [(i, random.uniform(0, args.expiry)) for i in range(args.sessions)]
+    print(f"{args.sessions:,} sessions over {args.expiry} s, one sweep per second")
+    print(f"{'':<12} {'schedule us':>12} {'sweep mean us':>14} {'sweep max us':>13} {'expired':>9}")
+    for name, run in (('timer wheel', run_wheel), ('full scan', run_scan)):
+        schedule, sweeps, expired = run(sessions, args)
+        print(f"{name:<12} {schedule / args.sessions * 1e6:>12.2f} {sum(sweeps) / len(sweeps) * 1e6:>14.1f} "
+              f"{max(sweeps) * 1e6:>13.1f} {expired:>9,}")
+
+
+if __name__ == "__main__":
+    main()
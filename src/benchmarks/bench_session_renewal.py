@@ -0,0 +1,99 @@
+"""
+Benchmark of the Redis operations spent on the sliding session expiry, per 1,000 messages: an EXPIRE sent with
+each message against the batched renewal of the server, which touches the TTL of an active session at most once by
+renewal interval, all of them in one pipeline.
+
+The users send direct messages through ChatServer._handle_request at a fixed rate on a simulated clock, the
+renewals run every interval of it. No socket is involved. It needs a running Redis server, the benchmark users
+renew_* are created and deleted.
+"""
+import argparse
+
+from services.server import ChatServer
+from utils.protocol import TextCodec
+from utils.redis_manager import RedisServerManager, hash_password
+
+PASSWORD = 'password'
+codec = TextCodec()
+
+
+class RecordingConnection:
+    def __init__(self):
+        self.last = b''
+
+    def sendall(self, data: bytes):
+        self.last = data
+
+
+class CountingRedis:
+    """
+    Count the EXPIRE commands and the round-trips of the renewals
+    """
+
+    def __init__(self, manager: RedisServerManager):
+        self.expires = 0
+        self.round_trips = 0
+        self.__update_expiries = manager.update_expiries
+        manager.update_expiries = self.update_expiries
+
+    def update_expiries(self, keys, expiry):
+        self.expires += len(keys)
+        self.round_trips += 1
+        return self.__update_expiries(keys, expiry)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-u', '--users', type=int, default=500)
+    parser.add_argument('-m', '--message-interval', type=float, default=5.0,
+                        help="seconds between two messages of a user")
+    parser.add_argument('-d', '--duration', type=int, default=600, help="simulated seconds")
+    parser.add_argument('-i', '--renew-intervals', type=float, nargs='+', default=[10, 30, 60, 300])
+    args = parser.parse_args()
+
+    manager = RedisServerManager()
+    usernames = [f"renew_{i}" for i in range(args.users)]
+    for username in usernames:
+        manager.add_user(username, PASSWORD, rounds=0)
+
+    print(f"{args.users} users, a message every {args.message_interval:g} s each, {args.duration} s simulated")
+    print(f"{'renewal':<18} {'EXPIRE / 1k msg':>16} {'round-trips / 1k msg':>21} {'saved':>7}")
+    print(f"{'each message':<18} {1000:>16.1f} {1000:>21.1f} {'':>7}")
+    for renew_interval in args.renew_intervals:
+        server = ChatServer('localhost', 0, renew_interval=renew_interval, rate_limits={})
+        renew = server._ChatServer__renew_sessions
+        counts = CountingRedis(server._redis)
+        tokens = {}
+        for username in usernames:
+            conn = RecordingConnection()
+            server._handle_request(conn, codec.encode_request('LOGIN', username, hash_password(PASSWORD)))
+            tokens[username] = (conn, conn.last[4:].decode().split(':')[1])
+
+        messages = 0
+        # users spread over the message interval, the renewals run at each renewal interval
+        step = args.message_interval / args.users
+        next_renewal = renew_interval
+        for tick in range(int(args.duration / step)):
+            now = tick * step
+            if now >= next_renewal:
+                renew()
+                next_renewal += renew_interval
+            username = usernames[tick % args.users]
+            conn, session_token = tokens[username]
+            peer = usernames[(tick + 1) % args.users]
+            server._handle_request(conn, codec.encode_request('MESSAGE', username, session_token, f"@{peer} hi"))
+            messages += 1
+        renew()
+
+        expires = counts.expires * 1000 / messages
+        print(f"{f'every {renew_interval:g} s':<18} {expires:>16.1f} {counts.round_trips * 1000 / messages:>21.2f} "
+              f"{1 - expires / 1000:>7.1%}")
+        for username in usernames:
+            manager.end_session(username)
+
+    for username in usernames:
+        manager.delete_user(username)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+"""
+Benchmark of the chat transcript of the Qt client: messages appended one by one to a QTextEdit by setting again its
+whole text, as ChatWindow did, or with QTextEdit.append, against ChatWindow.append_messages and its TranscriptModel
+shown by a QListView, with the default scrollback ring and with a ring holding all the messages.
+
+The Qt events are processed every few messages, as the event loop would between received frames; the worst of
+these turns is the longest the window froze. The scroll time is the mean time to repaint the view at a random
+position once all the messages are in. Run it with QT_QPA_PLATFORM=offscreen without a display.
+"""
+import argparse
+import random
+import sys
+import time
+
+from PyQt5.QtWidgets import QApplication, QTextEdit
+
+from ui.transcript import TranscriptModel
+from ui.ui_chat_area import ChatWindow
+
+
+def set_text(widget, line):
+    text = widget.toPlainText()
+    widget.setText(f"{text}\n{line}" if text else line)
+
+
+def text_edit(append):
+    widget = QTextEdit()
+    widget.setReadOnly(True)
+    return widget, widget.verticalScrollBar(), lambda line: append(widget, line)
+
+
+def chat_window(scrollback):
+    window = ChatWindow(None, scrollback)
+    window.chatArea.show()
+    return window, window.messageDisplay.verticalScrollBar(), lambda line: window.append_messages([line])
+
+
+def run(app, widget, scrollbar, append, messages, every, scrolls):
+    widget.resize(600, 800)
+    widget.show()
+    app.processEvents()
+    worst, start = 0.0, time.perf_counter()
+    for start_batch in range(0, messages, every):
+        turn = time.perf_counter()
+        for i in range(start_batch, min(messages, start_batch + every)):
+            append(f"user_{i % 50}: message {i} " + 'x' * 40)
+        app.processEvents()
+        worst = max(worst, time.perf_counter() - turn)
+    elapsed = time.perf_counter() - start
+
+    scroll = time.perf_counter()
+    for _ in range(scrolls):
+        scrollbar.setValue(random.randint(scrollbar.minimum(), scrollbar.maximum()))
+        widget.repaint()
+    scroll = (time.perf_counter() - scroll) / scrolls
+    widget.close()
+    return elapsed, worst, scroll
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-m', '--messages', type=int, default=100_000)
+    parser.add_argument('--set-text-messages', type=int, default=2_000,
+                        help="messages of the setText run, quadratic")
+    parser.add_argument('-c', '--capacity', type=int, default=TranscriptModel.CAPACITY, help="ring capacity")
+    parser.add_argument('-e', '--every', type=int, default=100, help="messages between two Qt event turns")
+    parser.add_argument('-s', '--scrolls', type=int, default=200)
+    args = parser.parse_args()
+
+    app = QApplication(sys.argv)
+    runs = (
+        ('text edit setText', text_edit(set_text), args.set_text_messages),
+        ('text edit append', text_edit(QTextEdit.append), args.messages),
+        ('list view ring', chat_window(args.capacity), args.messages),
+        ('list view unbounded', chat_window(args.messages), args.messages),
+    )
+    print(f"{'transcript':<20} {'messages':>9} {'us / msg':>9} {'worst turn ms':>14} {'scroll ms':>10}")
+    for name, (widget, scrollbar, append), messages in runs:
+        elapsed, worst, scroll = run(app, widget, scrollbar, append, messages, args.every, args.scrolls)
+        print(f"{name:<20} {messages:>9,} {elapsed / messages * 1e6:>9.1f} {worst * 1e3:>14.1f} {scroll * 1e3:>10.2f}")
+
+
+if __name__ == "__main__":
+    main()
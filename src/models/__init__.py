@@ -1 +1,3 @@
 from .db import User, Message, Chatroom
+from .message_writer import MessageWriter, create_schema
+from .history import MessageHistory
@@ -1,7 +1,7 @@
 from datetime import datetime
 
 import bcrypt
-from sqlalchemy import Column, Integer, String, DateTime, ForeignKey
+from sqlalchemy import Column, Integer, String, DateTime, ForeignKey, Index
 from sqlalchemy.ext.declarative import declarative_base
 
 Base = declarative_base()
@@ -32,12 +32,17 @@ class Chatroom(Base):
     __tablename__ = 'chatrooms'
 
     id = Column(Integer, primary_key=True)
-    name = Column(String)
+    name = Column(String, unique=True)
     created_at = Column(DateTime, default=datetime.utcnow)
 
 
 class Message(Base):
     __tablename__ = 'messages'
+    __table_args__ = (
+        # keyset pagination of the history, newest first
+        Index('ix_messages_chatroom_history', 'chatroom_id', 'timestamp', 'id'),
+        Index('ix_messages_direct_history', 'sender_user_id', 'receiver_user_id', 'timestamp'),
+    )
 
     id = Column(Integer, primary_key=True)
     chatroom_id = Column(Integer, ForeignKey('chatrooms.id'))
@@ -0,0 +1,105 @@
+"""
+Module to page through the persisted chat messages
+"""
+from sqlalchemy import select, tuple_, union_all
+from sqlalchemy.orm import Session
+
+from .db import User, Chatroom, Message
+
+
+class MessageHistory:
+    """
+    Pages of the history of a room or of a conversation between two users, newest first.
+
+    A page starts right before the id of the oldest message of the previous page (keyset pagination): it is read
+    from the (chatroom_id, timestamp, id) or (sender_user_id, receiver_user_id, timestamp) index without counting
+    the rows skipped, so any page costs the same whatever the size of the table. Given an after_id instead, a page
+    holds the messages following it, oldest first, for a client catching up from the last message it has.
+    The messages still buffered by the MessageWriter are not listed yet.
+    """
+    DEFAULT_LIMIT = 50
+    MAX_LIMIT = 200
+
+    def __init__(self, engine):
+        self.__engine = engine
+
+    def room(self, room: str, before_id: int = None, limit: int = DEFAULT_LIMIT, after_id: int = None) -> list:
+        """
+        Page of the history of a room
+        :param room:
+        :param before_id: id of the oldest message of the previous page, latest messages when None
+        :param limit:
+        :param after_id: id of the last message known, the page follows it when given
+        :return: (id, sender, text, timestamp) tuples, newest first, oldest first after after_id
+        """
+        with Session(self.__engine) as session:
+            room_id = session.scalar(select(Chatroom.id).where(Chatroom.name == room).order_by(Chatroom.id))
+            if room_id is None:
+                return []
+            start = self.__start(session, before_id, after_id)
+            if start is False:
+                return []
+            query = self.__page(Message.chatroom_id == room_id, start=start, limit=limit).subquery()
+            return self.__with_senders(session, select(query), query, limit, start)
+
+    def conversation(self, username: str, other: str, before_id: int = None, limit: int = DEFAULT_LIMIT,
+                     after_id: int = None) -> list:
+        """
+        Page of the direct messages between two users
+        :param username:
+        :param other:
+        :param before_id: id of the oldest message of the previous page, latest messages when None
+        :param limit:
+        :param after_id: id of the last message known, the page follows it when given
+        :return: (id, sender, text, timestamp) tuples, newest first, oldest first after after_id
+        """
+        with Session(self.__engine) as session:
+            user_ids = dict(session.execute(
+                select(User.username, User.id).where(User.username.in_((username, other)))).all())
+            if username not in user_ids or other not in user_ids:
+                return []
+            start = self.__start(session, before_id, after_id)
+            if start is False:
+                return []
+            user_id, other_id = user_ids[username], user_ids[other]
+            # One index range per direction, each bounded by the page size
+            pages = [self.__page(Message.sender_user_id == user_id, Message.receiver_user_id == other_id,
+                                 start=start, limit=limit)]
+            if other_id != user_id:
+                pages.append(self.__page(Message.sender_user_id == other_id, Message.receiver_user_id == user_id,
+                                         start=start, limit=limit))
+            query = union_all(*(select(page.subquery()) for page in pages)).subquery()
+            return self.__with_senders(session, select(query), query, limit, start)
+
+    @staticmethod
+    def __start(session, before_id, after_id):
+        """
+        Position of the message a page starts before, or after
+        :return: (timestamp, id, after), None for the latest messages, False when the message does not exist
+        """
+        message_id = after_id if after_id is not None else before_id
+        if message_id is None:
+            return None
+        timestamp = session.scalar(select(Message.timestamp).where(Message.id == message_id))
+        return False if timestamp is None else (timestamp, message_id, after_id is not None)
+
+    def __page(self, *conditions, start, limit):
+        query = select(Message.id, Message.sender_user_id, Message.text, Message.timestamp).where(*conditions)
+        if start and start[2]:
+            query = query.where(tuple_(Message.timestamp, Message.id) > start[:2])
+            return query.order_by(Message.timestamp, Message.id).limit(self.__limit(limit))
+        if start:
+            query = query.where(tuple_(Message.timestamp, Message.id) < start[:2])
+        return query.order_by(Message.timestamp.desc(), Message.id.desc()).limit(self.__limit(limit))
+
+    def __with_senders(self, session, query, page, limit, start):
+        query = query.add_columns(User.username).join(User, User.id == page.c.sender_user_id)
+        if start and start[2]:
+            query = query.order_by(page.c.timestamp, page.c.id)
+        else:
+            query = query.order_by(page.c.timestamp.desc(), page.c.id.desc())
+        rows = session.execute(query.limit(self.__limit(limit)))
+        return [(row.id, row.username, row.text, row.timestamp) for row in rows]
+
+    def __limit(self, limit):
+        return max(1, min(limit, self.MAX_LIMIT))
@@ -0,0 +1,190 @@
+"""
+Module to persist the chat messages in the background
+"""
+import threading
+from collections import deque
+from datetime import datetime
+
+from sqlalchemy import create_engine, event, insert, select
+from sqlalchemy.dialects import mysql, postgresql, sqlite
+from sqlalchemy.orm import Session
+
+from .db import Base, User, Chatroom, Message
+from utils.logger import get_logger
+
+log = get_logger('message_writer')
+
+
+def _set_sqlite_pragmas(dbapi_connection, _):
+    cursor = dbapi_connection.cursor()
+    # Readers do not block the writer, commits do not wait for the disk sync of each transaction
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.close()
+
+
+def create_schema(engine):
+    """
+    Create the tables and the history indexes missing from a database
+    :param engine:
+    :return:
+    """
+    Base.metadata.create_all(engine)
+    # messages table created before the history indexes
+    for index in Message.__table__.indexes:
+        index.create(engine, checkfirst=True)
+
+
+def _insert_missing(engine, table):
+    """
+    Insert statement skipping the rows already there, inserted meanwhile by another process
+    :param engine:
+    :param table:
+    :return:
+    """
+    dialects = {'sqlite': sqlite, 'postgresql': postgresql}
+    if engine.dialect.name in dialects:
+        return dialects[engine.dialect.name].insert(table).on_conflict_do_nothing()
+    if engine.dialect.name in ('mysql', 'mariadb'):
+        return mysql.insert(table).prefix_with('IGNORE')
+    return insert(table)
+
+
+class MessageWriter:
+    """
+    Write-behind persistence of the chat messages.
+
+    write only appends the message to an in-memory buffer, a worker thread inserts the buffered messages in bulk
+    once batch_size of them are waiting or every flush_interval seconds, and once more when stopped. When the
+    buffer holds max_buffered messages, the database is not keeping up and new messages are dropped instead of
+    slowing down their delivery.
+    """
+
+    def __init__(self, url='sqlite:///chat.db', max_buffered=100_000, batch_size=1_000, flush_interval=1.0):
+        self.__engine = create_engine(url)
+        if self.__engine.dialect.name == 'sqlite':
+            event.listen(self.__engine, 'connect', _set_sqlite_pragmas)
+        create_schema(self.__engine)
+        self.__insert_user = _insert_missing(self.__engine, User)
+        self.__insert_room = _insert_missing(self.__engine, Chatroom)
+        self.__max_buffered = max_buffered
+        self.__batch_size = batch_size
+        self.__flush_interval = flush_interval
+        self.__buffer = deque()
+        self.__condition = threading.Condition()
+        self.__stopped = True
+        self.__worker = None
+        # database ids by username and room name, only used by the worker
+        self.__user_ids = {}
+        self.__room_ids = {}
+        self.written = 0
+        self.dropped = 0
+        self.flushes = 0
+
+    @property
+    def engine(self):
+        return self.__engine
+
+    def __len__(self):
+        return len(self.__buffer)
+
+    def start(self):
+        self.__stopped = False
+        self.__worker = threading.Thread(target=self.__run, daemon=True)
+        self.__worker.start()
+
+    def stop(self):
+        """
+        Flush the buffered messages and stop the worker
+        :return:
+        """
+        with self.__condition:
+            self.__stopped = True
+            self.__condition.notify()
+        if self.__worker:
+            self.__worker.join()
+
+    def write(self, sender: str, text: str, receiver: str = None, room: str = None) -> bool:
+        """
+        Buffer a delivered message, never waits on the database
+        :param sender:
+        :param text:
+        :param receiver: receiver of a direct message
+        :param room: room of a room post
+        :return: False when dropped
+        """
+        with self.__condition:
+            if self.__stopped or len(self.__buffer) >= self.__max_buffered:
+                self.dropped += 1
+                return False
+            self.__buffer.append((sender, receiver, room, text, datetime.utcnow()))
+            if len(self.__buffer) == self.__batch_size:
+                self.__condition.notify()
+        return True
+
+    def __run(self):
+        while True:
+            with self.__condition:
+                if not self.__stopped and len(self.__buffer) < self.__batch_size:
+                    self.__condition.wait(self.__flush_interval)
+                batch, self.__buffer = self.__buffer, deque()
+                stopped = self.__stopped
+            if batch:
+                self.__flush(batch)
+            if stopped:
+                return
+
+    def __flush(self, batch):
+        try:
+            with Session(self.__engine) as session, session.begin():
+                user_ids = self.__get_user_ids(session, {name for message in batch for name in message[:2] if name})
+                room_ids = self.__get_room_ids(session, {message[2] for message in batch if message[2]})
+                session.execute(insert(Message), [
+                    {'sender_user_id': user_ids[sender], 'receiver_user_id': user_ids.get(receiver),
+                     'chatroom_id': room_ids.get(room), 'text': text, 'timestamp': timestamp}
+                    for sender, receiver, room, text, timestamp in batch
+                ])
+        except Exception as e:
+            self.dropped += len(batch)
+            log.error("cannot persist messages count=%s reason=%r", len(batch), e)
+            return
+        # committed, the rows of the new ids exist
+        self.__user_ids.update(user_ids)
+        self.__room_ids.update(room_ids)
+        self.written += len(batch)
+        self.flushes += 1
+
+    def __get_user_ids(self, session, usernames):
+        """
+        Database ids of the users of a batch, the users only known by Redis are added to the users table, unless
+        another process added them meanwhile. The new ids are cached once the batch is committed.
+        """
+        user_ids = {username: self.__user_ids[username] for username in usernames if username in self.__user_ids}
+        missing = [username for username in usernames if username not in user_ids]
+        if missing:
+            user_ids.update(session.execute(
+                select(User.username, User.id).where(User.username.in_(missing))).all())
+            new_users = [{'username': username, 'email': f"{username}@localhost", '_password_hash': ''}
+                         for username in missing if username not in user_ids]
+            if new_users:
+                session.execute(self.__insert_user, new_users)
+                user_ids.update(session.execute(
+                    select(User.username, User.id).where(User.username.in_(missing))).all())
+        return user_ids
+
+    def __get_room_ids(self, session, rooms):
+        """
+        Database ids of the rooms of a batch, the rooms only known by Redis are added to the chatrooms table, unless
+        another process added them meanwhile. The new ids are cached once the batch is committed.
+        """
+        room_ids = {room: self.__room_ids[room] for room in rooms if room in self.__room_ids}
+        missing = [room for room in rooms if room not in room_ids]
+        if missing:
+            room_ids.update(session.execute(
+                select(Chatroom.name, Chatroom.id).where(Chatroom.name.in_(missing))).all())
+            new_rooms = [{'name': room} for room in missing if room not in room_ids]
+            if new_rooms:
+                session.execute(self.__insert_room, new_rooms)
+                room_ids.update(session.execute(
+                    select(Chatroom.name, Chatroom.id).where(Chatroom.name.in_(missing))).all())
+        return room_ids
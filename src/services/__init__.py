@@ -1,2 +1,4 @@
 from .client_side import ChatClient
 from .server import ChatServer
+from .async_server import AsyncChatServer
+from .supervisor import Supervisor
@@ -0,0 +1,211 @@
+"""
+Module to asyncio chat server, all the connections are served by a single event loop
+"""
+
+import asyncio
+import socket
+
+from src.utils import FrameBuffer, OutboundConfig, SpillFile, DISCONNECT, DROP, get_logger
+from src.models import MessageWriter
+from .server import ChatServer
+
+log = get_logger('async_server')
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows
+    resource = None
+
+
+def raise_open_files_limit():
+    """
+    Raise the soft limit of open file descriptors to the hard limit, each idle connection holds one descriptor
+    :return: the new soft limit, None when unknown
+    """
+    if resource is None:
+        return None
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if hard == resource.RLIM_INFINITY or soft < hard:
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+            soft = hard
+        except (ValueError, OSError):
+            pass
+    return soft
+
+
+class ClientProtocol(asyncio.BufferedProtocol):
+    """
+    Client connection served by the event loop, it exposes the socket API (sendall, close) used by the
+    request handlers and the commands, so both server engines share them.
+
+    The transport buffers the outbound data, it pauses the protocol over the high watermark and resumes it under
+    the low watermark, the outbound policy applies to the data sent while paused.
+    """
+
+    def __init__(self, server: 'AsyncChatServer', config: OutboundConfig):
+        self.__server = server
+        self.__frames = FrameBuffer()
+        self.__config = config
+        self.__paused = False
+        self.__spill = SpillFile()
+        self.dropped = 0
+        # user logged in on this connection, its session ends when the connection closes
+        self.username = None
+        self.transport = None
+
+    @property
+    def depth(self) -> int:
+        """
+        Bytes waiting to be sent
+        """
+        return self.transport.get_write_buffer_size() + len(self.__spill) if self.transport else 0
+
+    @property
+    def closed(self) -> bool:
+        """
+        Closed by either side, the data sent is dropped
+        """
+        return self.transport is None or self.transport.is_closing()
+
+    def connection_made(self, transport):
+        self.transport = transport
+        transport.set_write_buffer_limits(high=self.__config.high_watermark, low=self.__config.low_watermark)
+        log.info("connection from addr=%s", transport.get_extra_info('peername'))
+        self.__server.handle_connection_made(self)
+
+    def get_buffer(self, sizehint):
+        # The transport reads straight into the frame buffer
+        return self.__frames.get_buffer(sizehint)
+
+    def buffer_updated(self, nbytes):
+        self.__frames.buffer_updated(nbytes)
+        self.__server.handle_frames(self, self.__frames)
+
+    def pause_writing(self):
+        self.__paused = True
+
+    def resume_writing(self):
+        self.__paused = False
+        # write() pauses again synchronously when over the high watermark
+        while len(self.__spill) and not self.__paused:
+            self.transport.write(self.__spill.read())
+
+    def connection_lost(self, exc):
+        self.__spill.close()
+        self.__server.handle_connection_lost(self)
+
+    def sendall(self, data: bytes):
+        # Buffered by the transport, never blocks the event loop
+        if self.transport.is_closing():
+            return
+        if self.__paused or len(self.__spill):
+            if self.__config.policy == DISCONNECT:
+                log.warning("disconnecting slow consumer addr=%s", self.transport.get_extra_info('peername'))
+                self.transport.abort()
+            elif self.__config.policy == DROP:
+                self.dropped += 1
+            else:
+                self.__spill.append(data)
+            return
+        self.transport.write(data)
+
+    def close(self):
+        self.transport.close()
+
+
+class AsyncChatServer(ChatServer):
+    """
+    Chat server running all client connections on one asyncio event loop instead of one thread each,
+    an idle connection costs a protocol object and a socket instead of a thread stack
+    """
+    # connections written by a fan-out before giving the event loop back to the other connections
+    FAN_OUT_BATCH = 500
+
+    def __init__(self, *args, backlog=socket.SOMAXCONN, outbound: OutboundConfig = None,
+                 messages: MessageWriter = None, metrics_port=None, admins=(), auth_workers=None,
+                 max_pending_logins=256, renew_interval=60, rate_limits=None, global_rate_limits=False,
+                 reuse_port=False, offline_limit=1000):
+        super().__init__(*args, outbound=outbound, messages=messages, metrics_port=metrics_port, admins=admins,
+                         auth_workers=auth_workers, max_pending_logins=max_pending_logins,
+                         renew_interval=renew_interval, rate_limits=rate_limits,
+                         global_rate_limits=global_rate_limits, reuse_port=reuse_port, offline_limit=offline_limit)
+        self.__backlog = backlog
+        self.__server = None
+        self.__loop = None
+
+    def handle_frames(self, client_conn: ClientProtocol, frames: FrameBuffer):
+        """
+        Serve the requests completely received from a client connection
+        :param client_conn:
+        :param frames:
+        :return:
+        """
+        try:
+            for data in frames.messages():
+                self._handle_request(client_conn, data)
+                if client_conn.transport.is_closing():
+                    break
+        except (ConnectionAbortedError, ConnectionResetError):
+            log.warning("connection reset by client conn=%s", client_conn)
+            client_conn.close()
+        except Exception as e:
+            self._handle_error(client_conn, e)
+            client_conn.close()
+
+    def handle_connection_made(self, client_conn: ClientProtocol):
+        self._open_connections.inc()
+
+    def handle_connection_lost(self, client_conn: ClientProtocol):
+        """
+
+        :param client_conn:
+        :return:
+        """
+        log.info("connection closed conn=%s", client_conn)
+        self._connection_closed(client_conn)
+
+    def _fan_out(self, conns: list, frame: bytes, start=0):
+        # Write by batches, a large room does not hold the event loop
+        end = start + self.FAN_OUT_BATCH if self.__loop else len(conns)
+        for conn in conns[start:end]:
+            conn.sendall(frame)
+        if end < len(conns):
+            self.__loop.call_soon(self._fan_out, conns, frame, end)
+
+    def _call_soon(self, func, *args):
+        # Transports are not thread safe, run on the event loop once started
+        if self.__loop is None:
+            func(*args)
+        elif not self.__loop.is_closed():
+            # Once the loop is closed the connections are gone, until the subscriber stops
+            self.__loop.call_soon_threadsafe(func, *args)
+
+    def _when_done(self, future, func, *args):
+        # Never wait on the event loop, the other connections are served meanwhile
+        future.add_done_callback(lambda done: self._call_soon(func, *args, done))
+
+    async def serve_forever(self):
+        """
+        Serve client connections until cancelled
+        :return:
+        """
+        log.info("open files limit=%s", raise_open_files_limit())
+        self.__loop = asyncio.get_running_loop()
+        # Reuse the socket bound when entering the server context
+        self.__server = await self.__loop.create_server(lambda: ClientProtocol(self, self._outbound),
+                                                        sock=self._socket.sock, backlog=self.__backlog)
+        log.info("listening port=%s", self._socket.port)
+        async with self.__server:
+            await self.__server.serve_forever()
+
+    def start_server(self):
+        """
+
+        :return:
+        """
+        try:
+            asyncio.run(self.serve_forever())
+        except KeyboardInterrupt:
+            log.info("shutting down the server")
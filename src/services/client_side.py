@@ -1,35 +1,160 @@
 import asyncio
+import itertools
+import json
 from typing import Callable
 
 from PyQt5.QtCore import pyqtSignal, QObject
 
-from src.utils import NetworkSocket, async_receive_data, ainput, extract_command
+from src.utils import TextCodec, BinaryCodec, ainput, extract_command, encode_frame, read_frame, get_logger, \
+    setup_logging, encode_correlated, decode_reply
 from utils import hash_password
 from utils.exceptions import ClientAuthenticationError
 
+log = get_logger('client')
+
 
 class ChatClient:
+    """
+    Chat client on asyncio streams, its coroutines and methods run on the event loop holding the connection.
+    Writes are buffered by the transport and never block, drain waits for the server to catch up.
+
+    A reader task reads the frames: the replies to the requests sent with request resolve their future, matched by
+    correlation id, and the messages pushed by the server are queued for receive, up to MAX_QUEUED (the reader
+    then waits, and so does the server).
+    """
+    MAX_QUEUED = 10_000
     # FIXME: not good approach, that is how Qt signals are designed, try to find another solution
     #       PROB: the signal is shared with all instances
 
-    def __init__(self, *args):
+    def __init__(self, host='localhost', port=12345, binary=False):
         self.__session_token = None
         self.__username = None
-        self._socket = NetworkSocket(args) if args else NetworkSocket()
+        # sequence of the last offline message shown, a message sent again by a racing login is skipped
+        self.__offline_cursor = 0
+        self.host = host
+        self.port = port
+        self.__reader = None
+        self.__writer = None
+        self.__reader_task = None
+        # messages pushed by the server, and futures of the requests in flight by correlation id
+        self.__messages = None
+        self.__pending = {}
+        self.__correlation_ids = itertools.count(1)
+        # ask the server for the binary protocol when connecting
+        self.__binary = binary
+        self.__codec = TextCodec()
 
     @property
     def username(self):
         return self.__username
 
-    def connect(self):
+    async def connect(self):
+        """
+
+        :return:
+        """
+        self.__reader, self.__writer = await asyncio.open_connection(self.host, self.port)
+        self.__messages = asyncio.Queue(self.MAX_QUEUED)
+        self.__reader_task = asyncio.create_task(self.__read_frames())
+        if self.__binary:
+            await self.__negotiate_codec()
+
+    async def __read_frames(self):
+        """
+        Read the frames until the connection is closed, the requests still in flight then fail
+        :return:
+        """
+        try:
+            while True:
+                message = (await read_frame(self.__reader)).decode()
+                correlation_id, reply = decode_reply(message)
+                if correlation_id is None:
+                    if self.__messages.full():
+                        await self.__messages.put(message)
+                    else:
+                        self.__messages.put_nowait(message)
+                    continue
+                future = self.__pending.pop(correlation_id, None)
+                if future is None:
+                    log.debug("late reply dropped correlation_id=%s", correlation_id)
+                elif not future.done():
+                    future.set_result(reply)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            for future in self.__pending.values():
+                if not future.done():
+                    future.set_exception(ConnectionError("Connection closed"))
+            self.__pending.clear()
+            if not self.__messages.full():
+                self.__messages.put_nowait('')
+
+    async def __negotiate_codec(self):
+        """
+        Switch to the binary protocol if the server accepts it, keep the text one otherwise
+        :return:
+        """
+        if await self.request('HELLO', BinaryCodec.name) == f"HELLO:{BinaryCodec.name}":
+            self.__codec = BinaryCodec()
+
+    async def close(self):
+        """
+        Close the connection once the data written is sent
+        :return:
         """
+        writer, self.__writer = self.__writer, None
+        if writer is None:
+            return
+        writer.close()
+        try:
+            await writer.wait_closed()
+        except ConnectionError:
+            pass
+        self.__reader_task.cancel()
+        try:
+            await self.__reader_task
+        except asyncio.CancelledError:
+            pass
 
+    async def drain(self):
+        """
+        Wait until the data written is under the transport high watermark
         :return:
         """
-        self._socket.connect()
+        await self.__writer.drain()
 
-    def close(self):
-        self._socket.close()
+    async def receive(self) -> str:
+        """
+        Receive one whole message pushed by the server, or the reply to a request sent without request
+        :return: the message, empty string when the connection is closed
+        """
+        try:
+            return self.__messages.get_nowait()
+        except asyncio.QueueEmpty:
+            if self.__reader_task.done():
+                return ''
+        return await self.__messages.get()
+
+    async def request(self, command, *args, timeout=None) -> str:
+        """
+        Send a request in a correlation envelope and wait for its reply, the other requests sent meanwhile are in
+        flight at the same time
+        :param command:
+        :param args:
+        :param timeout: seconds
+        :return: the reply, OK when the server had nothing to answer
+        """
+        if self.__reader_task.done():
+            raise ConnectionError("Connection closed")
+        correlation_id = next(self.__correlation_ids)
+        future = asyncio.get_running_loop().create_future()
+        self.__pending[correlation_id] = future
+        self.__writer.write(encode_frame(encode_correlated(correlation_id,
+                                                           self.__codec.encode_request(command, *args))))
+        try:
+            return await asyncio.wait_for(future, timeout)
+        finally:
+            self.__pending.pop(correlation_id, None)
 
     def stop_tasks(self):
         raise NotImplementedError
@@ -38,7 +163,7 @@ class ChatClient:
         # FIXME: proper verification
         return self.__session_token is None
 
-    def login(self, username: str, password: str):
+    async def login(self, username: str, password: str):
         """
 
         :param username:
@@ -48,15 +173,16 @@ class ChatClient:
         # TODO for chat gui, use token instead of username
         if not self.is_auth():
             return
-        self._socket.send_data(f"LOGIN:{username}:{hash_password(password)}")
-        response = self._socket.receive_data()
+        response = await self.request('LOGIN', username, hash_password(password))
 
-        # response = await async_receive_data(self._socket)
         # TODO if not session token found, the unauthenticated
         if response.startswith("SESSION_START"):
-            self.__session_token = response.split(':')[1]
+            _, self.__session_token, user_id = response.split(':')
+            self.__codec.user_ids.register(username, int(user_id))
             if not self.__username:
                 self.__username = username
+        elif response.startswith("AUTH_BUSY"):
+            raise ClientAuthenticationError(message="Server busy, try again later")
         else:
             raise ClientAuthenticationError()
 
@@ -66,11 +192,11 @@ class ChatClient:
         :return:
         """
         if self.__session_token:
-            try:
-                self._socket.send_data(f"LOGOUT:{self.__username}:{self.__session_token}")
-                self.__session_token = None
-            except ConnectionResetError as _:
-                print('[WARNING] cannot logout from server, server unreached')
+            if self.__writer is None or self.__writer.is_closing():
+                log.warning("cannot logout from server, server unreached")
+                return
+            self.__send('LOGOUT', self.__username, self.__session_token)
+            self.__session_token = None
 
     def process_message(self, response: str):
         """
@@ -78,10 +204,20 @@ class ChatClient:
         :param response:
         :return:
         """
-        status, message = response.split(":")
+        status, _, message = response.partition(":")
         if status == "INVALID_SESSION":
             self.__session_token = None
             raise ClientAuthenticationError(message=message)
+        if status == "OFFLINE":
+            for sequence, text in json.loads(message)['messages']:
+                if sequence > self.__offline_cursor:
+                    self.__offline_cursor = sequence
+                    print(text)
+            return
+        if status == "RATE_LIMITED":
+            kind, _, retry_after = message.partition(":")
+            print(f"Too many {kind} requests, retry in {retry_after} s")
+            return
         # TODO Add message queue
         print(f"{status}: {message}")
 
@@ -89,15 +225,18 @@ class ChatClient:
         if self.is_auth():
             raise ClientAuthenticationError()
         try:
-            async for response in self.__receive_message():
-                if response:
-                    self.process_message(response)
-                    if func:
-                        func(response)
+            while True:
+                response = await self.receive()
+                if not response:
+                    log.info("connection closed by the server")
+                    return
+                self.process_message(response)
+                if func:
+                    func(response)
 
         except asyncio.CancelledError:
             # TODO Handle cancellation gracefully
-            print("[WARNING] Got CancelledError for receive_message coroutine")
+            log.debug("receive_message coroutine cancelled")
             raise
 
     def send_message(self, message: str):
@@ -105,41 +244,46 @@ class ChatClient:
 
         if self.is_auth():
             raise ClientAuthenticationError()
-        self.__send_message(message)
+        self.__send('MESSAGE', self.__username, self.__session_token, message)
 
-    def __send_message(self, message):
+    async def command(self, message: str, timeout=None) -> str:
         """
-
+        Send a chat message or a command and wait for its reply
         :param message:
-        :return:
+        :param timeout: seconds
+        :return: the reply, OK when the server had nothing to answer
         """
-        # TODO for chat gui, use token instead of username
-
-        self._socket.send_data(data=f"MESSAGE:{self.__username}:{self.__session_token}:{message}")
+        if self.is_auth():
+            raise ClientAuthenticationError()
+        return await self.request('MESSAGE', self.__username, self.__session_token, message, timeout=timeout)
 
-    async def __receive_message(self):
-        while True:
-            yield await async_receive_data(self._socket)
+    def __send(self, command, *args):
+        """
+        Write a request, buffered by the transport
+        :param command:
+        :param args:
+        :return:
+        """
+        self.__writer.write(encode_frame(self.__codec.encode_request(command, *args)))
 
 
 class ChatClientContext(ChatClient):
-    def __init__(self):
-        super().__init__()
+    def __init__(self, *args, binary=False):
+        super().__init__(*args, binary=binary)
         # F
         self.__task = set()
-        self.__loop = asyncio.get_event_loop()
 
     async def start_client(self):
         """
         Starts the chat client session.
         """
-        print(f"[INFO] Client chat session on {self._socket.host}:{self._socket.port}")
+        log.info("chat session host=%s port=%s", self.host, self.port)
 
         while True:
             try:
                 # Handle user authentication
                 if self.is_auth():
-                    self._authenticate_user()
+                    await self._authenticate_user()
                 else:
                     # Send and receive messages
                     await self._chat_session()
@@ -151,18 +295,17 @@ class ChatClientContext(ChatClient):
                 print("[INFO] Shutting down the client.")
                 break
             except Exception as e:
-                print(f"[ERROR] An unexpected error occurred: {e}")
+                log.error("unexpected error reason=%r", e)
                 break
 
-    def _authenticate_user(self):
+    async def _authenticate_user(self):
         """
         Handles user authentication.
         """
         print("[INFO] Please authenticate to continue.")
-        username = input("Username: ")
-        self.__username = username
-        password = input("Password: ")
-        self.login(username, password)
+        username = await ainput("Username: ")
+        password = await ainput("Password: ")
+        await self.login(username, password)
         print("[INFO] Authentication successful.")
 
     async def _chat_session(self):
@@ -182,7 +325,7 @@ class ChatClientContext(ChatClient):
                 message = await ainput()
             except asyncio.CancelledError:
                 # TODO Handle cancellation gracefully
-                print("[WARNING] Got CancelledError for send_message coroutine")
+                log.debug("send_message coroutine cancelled")
                 raise
             # FIXME LOGOUT request doesn't work properly
             cmd = extract_command(message)
@@ -192,6 +335,7 @@ class ChatClientContext(ChatClient):
                 except AttributeError:
                     pass
             self.send_message(message)
+            await self.drain()
 
     async def stop_tasks(self):
         """
@@ -199,32 +343,86 @@ class ChatClientContext(ChatClient):
         :return:
         """
         # Cancel all running asyncio tasks
-        print("[WARNING] Stopping current task and stopping event loop !")
+        log.debug("stopping the client tasks")
         for task in self.__task:
-            print(f"[DEBUG] Cancelling task: {task}")
+            log.debug("cancelling task=%s", task)
             task.cancel()
         await asyncio.gather(*self.__task, return_exceptions=True)
         self.__task.clear()
 
     async def __aenter__(self):
-        self.connect()
+        await self.connect()
         return self
 
     async def __aexit__(self, exc_type, exc_value, traceback):
-        if self._socket:
-            self.logout()
-            self.close()
-            print("[WARNING] Connection closed.")
-            await self.stop_tasks()
+        self.logout()
+        await self.close()
+        log.info("connection closed")
+        await self.stop_tasks()
 
 
 class ClientChatGui(QObject):
-    message_received = pyqtSignal()
-
-    def __init__(self):
+    """
+    Chat client of the Qt widgets: the client runs on the event loop of the asyncio thread, the widgets call it from
+    the Qt thread through these methods
+    """
+    # the message travels with the signal, the receiving slot runs later in the Qt thread
+    message_received = pyqtSignal(str)
+    # reply handler and reply of a request
+    reply_received = pyqtSignal(object, str)
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, *args, binary=False):
         super().__init__()
-        self.__chat_client = ChatClient()
-        self.current_message: str = ''
+        self.__loop = loop
+        self.__chat_client = ChatClient(*args, binary=binary)
+        self.reply_received.connect(self.__call_handler)
+
+    def run(self, coroutine, timeout=None):
+        """
+        Run a coroutine on the event loop and wait for its result
+        :param coroutine:
+        :param timeout: seconds
+        :return:
+        """
+        return asyncio.run_coroutine_threadsafe(coroutine, self.__loop).result(timeout)
+
+    def connect(self):
+        self.run(self.__chat_client.connect())
+
+    def login(self, username: str, password: str):
+        self.run(self.__chat_client.login(username, password))
+
+    def send_message(self, message: str):
+        self.__loop.call_soon_threadsafe(self.__chat_client.send_message, message)
+
+    def request(self, message: str, handler: Callable[[str], None] = None):
+        """
+        Send a chat message or a command without waiting, handler is called with its reply in the Qt thread
+        :param message:
+        :param handler:
+        :return:
+        """
+        future = asyncio.run_coroutine_threadsafe(self.__chat_client.command(message), self.__loop)
+        future.add_done_callback(lambda done: self.__replied(message, handler, done))
+
+    def __replied(self, message, handler, done):
+        if done.cancelled() or done.exception() is not None:
+            log.warning("request failed message=%r reason=%r", message, None if done.cancelled()
+                        else done.exception())
+        elif handler:
+            self.reply_received.emit(handler, done.result())
+
+    def __call_handler(self, handler, reply):
+        handler(reply)
+
+    def close(self, timeout=5.0):
+        """
+        Logout and close the connection
+        :param timeout: seconds
+        :return:
+        """
+        self.__loop.call_soon_threadsafe(self.__chat_client.logout)
+        self.run(self.__chat_client.close(), timeout)
 
     async def rcv_message(self):
         """
@@ -240,14 +438,10 @@ class ClientChatGui(QObject):
     def __send_message_signal(self, message: str):
         """
 
-        :param message:s
+        :param message:
         :return:
         """
-        print("[DEBUG] Message received")
-        self.current_message = message
-        # FIXME, why save current message, sned it with the signal
-        self.message_received.emit()
-        print("[DEBUG] Signal transferred !")
+        self.message_received.emit(message)
 
 
 if __name__ == "__main__":
@@ -256,7 +450,7 @@ if __name__ == "__main__":
             async with ChatClientContext() as server:
                 await server.start_client()
         except ConnectionRefusedError:
-            print("[WARNING] Server is unreachable")
+            log.warning("server is unreachable")
 
 
     # TODO Stop properly, ERROR encountered:
@@ -265,4 +459,5 @@ if __name__ == "__main__":
     #     asyncio.run(main())
     #   File "C:\ProgramData\Anaconda3\envs\chat_room\Lib\asyncio\runners.py", line 190, in run
     #     return runner.run(main)
+    setup_logging()
     asyncio.run(main())
@@ -3,29 +3,175 @@ Module to chat server
 """
 
 import json
+import logging
+import os
+import signal
+import socket
 import threading
+import time
+import uuid
+from concurrent.futures import Future, wait
+from contextvars import ContextVar, copy_context
 from functools import singledispatchmethod
 
-from src.utils import NetworkSocket, RedisServerManager, SlashMessage, AtMessage, \
-    parse_message, generate_session_token
+from src.utils import NetworkSocket, RedisServerManager, SlashMessage, AtMessage, BinaryCodec, UserIds, \
+    SessionCache, ClientConnection, OutboundConfig, RoomIndex, MetricsRegistry, MetricsServer, CredentialVerifier, \
+    TimerWheel, RateLimiter, RedisRateLimiter, encode_frame, parse_message, generate_session_token, get_logger, \
+    setup_logging, decode_correlated, encode_reply
+from src.models import MessageWriter, MessageHistory, create_schema
+
+log = get_logger('server')
+
+
+class _CorrelatedRequest:
+    """
+    Request sent in a correlation envelope, its replies echo the correlation id
+    """
+    __slots__ = ('conn', 'correlation_id', 'answered')
+
+    def __init__(self, conn, correlation_id: int):
+        self.conn = conn
+        self.correlation_id = correlation_id
+        # a reply was sent, or will be once the request completes
+        self.answered = False
+
+
+# correlated request being handled, None for a request without envelope
+_current_request = ContextVar('current_request', default=None)
 
 
 # TODO Accept requests
-#      coroutine to check login expiration, and delete users from active list (prob: when user token expired, user
-#      still have an active session
 #      Handle exceptions
 
 
+def stop_on_terminate():
+    """
+    Stop on SIGTERM like on Ctrl+C, the server context exits and stops the password check workers
+    :return:
+    """
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+
+
 class ChatServer:
+    # seconds a session token lives after the login or its last renewal
+    SESSION_EXPIRY = 1800
+    # seconds between two sweeps of the expired sessions, the precision of their expiry
+    SWEEP_INTERVAL = 1.0
+    # pub/sub channel of the sessions changed by a node, "<node id>:<username>" messages
+    SESSION_CHANNEL = 'session_invalidation'
+    # pub/sub channel of the room posts, "<node id>:<room>:<message>" messages
+    ROOMS_CHANNEL = 'rooms'
+    # pub/sub channel of the active users changes, "+<username>" or "-<username>" messages
+    PRESENCE_CHANNEL = 'presence'
+    # messages of a /history page when not given
+    HISTORY_LIMIT = MessageHistory.DEFAULT_LIMIT
+    # (requests by second, burst) of a connection, whatever its requests, and of a user by message type: '@' the
+    # direct messages, '/<command>' a command, '/' the other commands
+    RATE_LIMITS = {'connection': (50, 100), '@': (10, 30), '/': (5, 20), '/u': (1, 5), '/history': (2, 10),
+                   '/since': (2, 10)}
+    # offline messages read from Redis at once on login, and bytes of message text by OFFLINE frame
+    OFFLINE_BATCH = 1000
+    OFFLINE_FRAME_BYTES = 256 * 1024
+    # one request out of REQUEST_SAMPLE is timed, the clock reads cost about as much as a few percent of a request
+    REQUEST_SAMPLE = 16
 
-    def __init__(self, *args):
+    def __init__(self, *args, outbound: OutboundConfig = None, messages: MessageWriter = None, metrics_port=None,
+                 admins=(), auth_workers=None, max_pending_logins=256, renew_interval=60, rate_limits=None,
+                 global_rate_limits=False, reuse_port=False, offline_limit=1000):
         # TODO save token in redis with corresponding client address
         # TODO when internal error, updated redis next launch 
-        self._socket = NetworkSocket(args) if args else NetworkSocket()
+        self._socket = NetworkSocket(*args) if args else NetworkSocket()
+        # listen on a port shared with other processes, the workers of a supervisor
+        self.__reuse_port = reuse_port
+        # clients outbound queues watermarks and slow consumer policy
+        self._outbound = outbound or OutboundConfig()
+        # write-behind history of the delivered messages, not persisted when None
+        self._messages = messages
+        self._history = MessageHistory(messages.engine) if messages is not None else None
         # Initialize Redis client
         self._redis = RedisServerManager()
         # clients register
         self.__clients = {}
+        # messages kept by offline user until its next login, the oldest are dropped, 0 keeps none
+        self.__offline_limit = offline_limit
+        # local users the active users changes are pushed to
+        self.__presence_subscribers = set()
+        # local members of the chat rooms
+        self._rooms = RoomIndex()
+        # node id, to ignore own session invalidations
+        self._node_id = uuid.uuid4().hex
+        # session tokens cache, message requests are validated without Redis round-trip
+        self._sessions = SessionCache(self.__load_session, ttl=self.SESSION_EXPIRY)
+        # Redis pub/sub thread
+        self.__subscriber = None
+        # session deadlines of the local users, swept by one thread
+        self._expiry = TimerWheel(tick=self.SWEEP_INTERVAL)
+        self.__sweeper = None
+        self.__stopping = threading.Event()
+        # users active since the last renewal, their session expiry slides by batches every renew_interval seconds
+        self.__renew_interval = renew_interval
+        self.__active_users = set()
+        self.__active_lock = threading.Lock()
+        # token buckets of the connections, and of the users shared by the nodes when global_rate_limits is set
+        rate_limits = self.RATE_LIMITS if rate_limits is None else rate_limits
+        self._connection_limits = RateLimiter({kind: limit for kind, limit in rate_limits.items()
+                                               if kind == 'connection'})
+        self._user_limits = RedisRateLimiter(self._redis, rate_limits) if global_rate_limits \
+            else RateLimiter(rate_limits)
+        # user ids sent by binary protocol clients
+        self._user_ids = UserIds()
+        # decodes binary requests and falls back to text ones
+        self.__codec = BinaryCodec(self._user_ids)
+        # users allowed to read the server stats
+        self.__admins = set(admins)
+        self.__metrics_port = metrics_port
+        self.__metrics_server = None
+        self._metrics = MetricsRegistry()
+        # sampled requests, the message requests are labeled by the chat command they ran
+        self.__request_seconds = self._metrics.histogram('request_seconds', "Time serving a request",
+                                                         ('request', 'command'), sample=self.REQUEST_SAMPLE)
+        # requests left before the next timed one
+        self.__unsampled = self.REQUEST_SAMPLE
+        self.__request_errors = self._metrics.counter('request_errors_total',
+                                                      "Requests failed with an unexpected error")
+        self.__invalid_sessions = self._metrics.counter('invalid_sessions_total',
+                                                        "Messages refused for an invalid session token")
+        self.__rate_limited = self._metrics.counter('rate_limited_total', "Requests refused over their rate limit",
+                                                    ('type',))
+        self._open_connections = self._metrics.gauge('open_connections', "Open client connections")
+        self._metrics.gauge('clients', "Logged-in clients", lambda: len(self.__clients))
+        self._metrics.gauge('outbound_queued_bytes', "Bytes waiting to be sent to the clients",
+                            lambda: sum(self.queue_depths().values()))
+        self._metrics.gauge('session_cache_size', "Cached session tokens", lambda: len(self._sessions))
+        self._metrics.counter('session_cache_hits_total', "Session cache hits", function=lambda: self._sessions.hits)
+        self._metrics.counter('session_cache_misses_total', "Session cache misses",
+                              function=lambda: self._sessions.misses)
+        self._metrics.gauge('messages_buffered', "Messages waiting to be persisted",
+                            lambda: len(self._messages) if self._messages is not None else 0)
+        self._metrics.gauge('redis_rtt_seconds', "Redis PING round-trip time, measured when read",
+                            self._redis.round_trip_time)
+        # password checks in worker processes, off the request loop
+        self._credentials = CredentialVerifier(auth_workers, max_pending_logins, self._metrics.histogram(
+            'credential_queue_seconds', "Time a password check waited for a worker"))
+        self._metrics.gauge('credential_checks_pending', "Password checks queued or running",
+                            lambda: self._credentials.pending)
+        self.__expired_sessions = self._metrics.counter('sessions_expired_total', "Sessions ended by their expiry")
+        self.__renewed_sessions = self._metrics.counter('sessions_renewed_total', "Session expiries slid by activity")
+        self.__offline_stored = self._metrics.counter('offline_messages_stored_total',
+                                                      "Messages kept for offline users")
+        self.__offline_delivered = self._metrics.counter('offline_messages_delivered_total',
+                                                         "Offline messages delivered on login")
+        self._metrics.gauge('sessions_scheduled', "Local sessions waiting for their expiry", lambda: len(self._expiry))
+        self._metrics.counter('logins_refused_total', "Logins refused over the pending password checks limit",
+                              function=lambda: self._credentials.refused)
+        # request handlers by command
+        self.__requests = {
+            'HELLO': self.__hello_request,
+            'LOGIN': self.__login_request,
+            'MESSAGE': self.__message_request,
+            'LOGOUT': self.__logout_request,
+        }
+        self.__request_observers = {}
 
     @singledispatchmethod
     def handle_message(self, *args):
@@ -40,70 +186,177 @@ class ChatServer:
     def _(self, message_wrapper: SlashMessage, client_conn, username, *args: object):
         # Handling SlashMessage
         # Get appropriate command
-        result = message_wrapper.get_command()
+        command = message_wrapper.get_command()
         # Execute command
-        result = result.execute(redis=self._redis, server_chat_obj=self) if result else "Nothing to do !"
+        result = command.execute(redis=self._redis, server_chat_obj=self, username=username,
+                                 args=message_wrapper.args) if command else "Nothing to do !"
         # Send back message to current user
-        self._socket.send_data(result, client_conn) if isinstance(result, str) else result(client_conn, username, None)
+        if isinstance(result, str):
+            self.__reply(client_conn, result)
+        elif result:
+            result(client_conn, username, None)
+        return type(command).__name__ if command else None
 
     @handle_message.register
     def _(self, message_wrapper: AtMessage, client_conn, username, *args: object):
         # Handling AtMessage
         recipient, message = parse_message(message_wrapper.message)
         if recipient and message:
-            message_wrapper.command.execute(username, recipient, self.__clients, message)
+            if not message_wrapper.command.execute(username, recipient, self.__clients, message,
+                                                   self.__route_message):
+                self.__reply(client_conn, "NOT_FOUND: No user found !")
+            elif self._messages is not None:
+                self._messages.write(username, message, receiver=recipient)
         else:
-            self._socket.send_data('WRONG_ENTRY:No message to send.', client_conn)
+            self.__reply(client_conn, 'WRONG_ENTRY:No message to send.')
+        return type(message_wrapper.command).__name__
 
     def __message_request(self, *args):
         """
 
         :param args:
-        :return:
+        :return: name of the command run
         """
         client_conn, username, user_token, message = args
-        hashed_password = self._redis.get_data(username)
         # Check if valid user token
-        if hashed_password and hashed_password.get('session_token') == user_token:
+        if self._sessions.get(username) == user_token:
+            kind = message.partition(' ')[0] if message.startswith('/') else message[:1]
+            if kind.startswith('/') and kind not in self._user_limits.limits:
+                kind = '/'
+            if self.__rate_limited_request(client_conn, self._user_limits, username, kind):
+                return
+            with self.__active_lock:
+                self.__active_users.add(username)
             if message.startswith('/'):
                 message_wrapper = SlashMessage(message)
             elif message.startswith('@'):
                 message_wrapper = AtMessage(message)
             else:
                 # Default handler if no specific type matches
-                self._socket.send_data('UNKNOWN_ENTRY:Unknown message type.', client_conn)
+                self.__reply(client_conn, 'UNKNOWN_ENTRY:Unknown message type.')
                 return
-            self.handle_message(message_wrapper, client_conn, username)
+            return self.handle_message(message_wrapper, client_conn, username)
         else:
-            self._socket.send_data('INVALID_SESSION:Token expired', client_conn)
-
-    def __login(self, *args):
+            self.__invalid_sessions.inc()
+            self.__reply(client_conn, 'INVALID_SESSION:Token expired')
 
-        client_conn, username, password_hash = args
-        if not self._redis.login(username, password_hash):
-            self._socket.send_data(f'AUTH_FAILED:{username}', client_conn)
+    def __rate_limited_request(self, client_conn, limiter: RateLimiter, key, kind) -> bool:
+        """
+        Take a token for a request, the client is told when to retry if there is none left
+        :param client_conn:
+        :param limiter:
+        :param key: user or connection
+        :param kind: request type
+        :return: True when the request is refused
+        """
+        retry_after = limiter.acquire(key, kind)
+        if not retry_after:
             return False
-        print(f'[DEBUG] All active users : {self._redis.get_active_users()}')
-
+        self.__rate_limited.labels(kind).inc()
+        self.__reply(client_conn, f'RATE_LIMITED:{kind}:{retry_after:.3f}')
         return True
 
+    def __reply(self, client_conn, message: str):
+        """
+        Send the reply to the request being handled, with its correlation id when it has one
+        :param client_conn:
+        :param message:
+        :return:
+        """
+        request = _current_request.get()
+        if request is not None and request.conn is client_conn:
+            request.answered = True
+            message = encode_reply(request.correlation_id, message)
+        self._socket.send_data(message, client_conn)
+
     def __login_request(self, *args):
         """
 
         :param args:
         :return:
         """
-        client_conn, username, _ = args
-        if not self.__login(*args):
-            return False
-        # check if user session in active_users
+        client_conn, username, password_hash = args
+        stored_hash = self._redis.get_password_hash(username)
+        if stored_hash is None:
+            self.__reply(client_conn, f'AUTH_FAILED:{username}')
+            return
+        check = self._credentials.verify(password_hash, stored_hash)
+        if check is None:
+            # Too many logins being checked, the client retries later
+            self.__reply(client_conn, f'AUTH_BUSY:{username}')
+            return
+        request = _current_request.get()
+        if request is not None:
+            # answered once the password is checked, in a copy of the request context
+            request.answered = True
+        self._when_done(check, copy_context().run, self.__open_session, client_conn, username, stored_hash)
+
+    def __open_session(self, client_conn, username, stored_hash, check: Future):
+        """
+        Open the session of a user once its password is checked
+        :param client_conn:
+        :param username:
+        :param stored_hash: password hash the password was checked against
+        :param check: future of the password check
+        :return:
+        """
+        if check.cancelled() or check.exception() is not None:
+            log.error("password check failed user=%s reason=%r", username, None if check.cancelled()
+                      else check.exception())
+            self.__reply(client_conn, f'AUTH_FAILED:{username}')
+            return
+        if not check.result():
+            log.warning("auth failed user=%s, wrong password", username)
+            self.__reply(client_conn, f'AUTH_FAILED:{username}')
+            return
+        if getattr(client_conn, 'closed', False):
+            # Dropped while its password was checked, _connection_closed found no user to log out
+            log.info("login abandoned user=%s conn=%s", username, client_conn)
+            return
         session_token = generate_session_token()
-        # 30 minutes expiry
-        self._redis.set_data(username, json.dumps({'session_token': session_token}), expiry=1800)
-        # Send session token to auth request user
-        self._socket.send_data(f'SESSION_START:{session_token}', client_conn)
+        # Add to active users and open a 30 minutes session in one round-trip, unless the password changed meanwhile
+        rooms = self._redis.start_session(username, stored_hash, json.dumps({'session_token': session_token}),
+                                          expiry=self.SESSION_EXPIRY, node_id=self._node_id,
+                                          notify=self.__session_changed(username), presence=self.PRESENCE_CHANNEL)
+        if rooms is None:
+            self.__reply(client_conn, f'AUTH_FAILED:{username}')
+            return
+        for room in rooms:
+            self._rooms.add(room, username)
+        self._sessions.invalidate(username)
+        self._sessions.put(username, session_token, self.SESSION_EXPIRY)
+        # Send session token and user id to auth request user
+        self.__reply(client_conn, f'SESSION_START:{session_token}:{self._user_ids.intern(username)}')
         # Save user connection
         self.__clients[username] = client_conn
+        client_conn.username = username
+        self._expiry.schedule(username, self.SESSION_EXPIRY)
+        self.__deliver_offline(username, client_conn)
+
+    def __deliver_offline(self, username, client_conn):
+        """
+        Send the messages kept while a user was offline, many by OFFLINE frame, and move its delivery cursor after
+        each batch: a login racing on another node or the next one does not send them again
+        :param username:
+        :param client_conn:
+        :return:
+        """
+        while True:
+            messages = self._redis.offline_messages(username, self.OFFLINE_BATCH)
+            if not messages:
+                return
+            frame, size = [], 0
+            for sequence, message in messages:
+                if frame and size + len(message) > self.OFFLINE_FRAME_BYTES:
+                    self._socket.send_data("OFFLINE:" + json.dumps({'messages': frame}), client_conn)
+                    frame, size = [], 0
+                frame.append([sequence, message])
+                size += len(message)
+            self._socket.send_data("OFFLINE:" + json.dumps({'messages': frame}), client_conn)
+            self._redis.ack_offline_messages(username, messages[-1][0], self.OFFLINE_BATCH)
+            self.__offline_delivered.inc(len(messages))
+            if len(messages) < self.OFFLINE_BATCH:
+                return
 
     def __logout_request(self, *args):
         """
@@ -115,43 +368,433 @@ class ChatServer:
         try:
             client_conn, username, _ = args
         except ValueError:
-            print('[WARNING] No logout action needed')
+            log.debug("no logout action needed conn=%s", args[0] if args else None)
             return
-        print(f"[INFO] Logging out client {username}: {client_conn}")
-        # Remove user session token
-        self._redis.delete_data(username)
-        # Logout from active sessions
-        self._redis.logout(username)
+        log.info("logout user=%s conn=%s", username, client_conn)
+        # Remove user session token and logout from active sessions
+        self._expiry.cancel(username)
+        self._sessions.invalidate(username)
+        self._user_limits.forget(username)
+        self._redis.end_session(username, node_id=self._node_id, notify=self.__session_changed(username),
+                                presence=self.PRESENCE_CHANNEL)
         # Remove current user server session
-        del self.__clients[username]
-        print(f"[DEBUG] User {username} logged out")
+        self._rooms.remove_user(username)
+        self.__presence_subscribers.discard(username)
+        # gone already when the session expired
+        self.__clients.pop(username, None)
+        log.debug("logged out user=%s", username)
+
+    def __sweep(self):
+        """
+        Expire the sessions past their deadline every SWEEP_INTERVAL, until the server stops
+        :return:
+        """
+        last_renewal = time.monotonic()
+        while not self.__stopping.wait(self.SWEEP_INTERVAL):
+            if time.monotonic() - last_renewal >= self.__renew_interval:
+                last_renewal = time.monotonic()
+                try:
+                    self.__renew_sessions()
+                except Exception as e:
+                    log.error("cannot renew sessions reason=%r", e)
+            usernames = self._expiry.expired()
+            if not usernames:
+                continue
+            try:
+                self.__expire_sessions(usernames)
+            except Exception as e:
+                log.error("cannot expire sessions count=%s reason=%r", len(usernames), e)
+                # Try again on the next sweep, unless logged in again meanwhile
+                for username in usernames:
+                    if username not in self._expiry:
+                        self._expiry.schedule(username, self.SWEEP_INTERVAL)
+
+    def __renew_sessions(self):
+        """
+        Slide the expiry of the sessions active since the last renewal, in one round-trip: a session TTL is
+        touched at most once by renewal interval, whatever the messages sent
+        :return:
+        """
+        with self.__active_lock:
+            usernames, self.__active_users = self.__active_users, set()
+        if not usernames:
+            return
+        renewed = self._redis.update_expiries(list(usernames), self.SESSION_EXPIRY)
+        for username in renewed:
+            self._expiry.schedule(username, self.SESSION_EXPIRY)
+        self.__renewed_sessions.inc(len(renewed))
+
+    def __expire_sessions(self, usernames):
+        """
+        Remove the users whose session key expired from active users, in one round-trip, and drop them locally.
+        The sessions renewed or started again are scheduled at their Redis expiry.
+        :param usernames: users past their local deadline
+        :return:
+        """
+        alive = self._redis.expire_sessions(usernames, node_id=self._node_id, notify=self.__session_changed,
+                                            presence=self.PRESENCE_CHANNEL)
+        for username, ttl in alive.items():
+            if ttl >= 0 and username not in self._expiry:
+                self._expiry.schedule(username, ttl)
+        expired = [username for username in usernames if username not in alive]
+        if expired:
+            self.__expired_sessions.inc(len(expired))
+            self._call_soon(self.__drop_sessions, expired)
+
+    def __drop_sessions(self, usernames):
+        """
+        Forget the local users whose session expired, their connection stays open to log in again
+        :param usernames:
+        :return:
+        """
+        for username in usernames:
+            if username in self._expiry:
+                # Logged in again since the session expired
+                continue
+            client_conn = self.__clients.pop(username, None)
+            self._sessions.invalidate(username)
+            self._user_limits.forget(username)
+            self._rooms.remove_user(username)
+            self.__presence_subscribers.discard(username)
+            if client_conn is not None:
+                self._socket.send_data('INVALID_SESSION:Session expired', client_conn)
+            log.info("session expired user=%s", username)
+
+    def __load_session(self, username):
+        """
+        Load a session token from Redis, on session cache miss
+        :param username:
+        :return: session token and its seconds to live
+        """
+        session, ttl = self._redis.get_data_ttl(username)
+        return (session.get('session_token') if session else None), ttl
+
+    def __session_changed(self, username):
+        """
+        Notification making the other nodes drop their cached session of a user
+        :param username:
+        :return: channel and message to publish
+        """
+        return self.SESSION_CHANNEL, f"{self._node_id}:{username}"
+
+    def __on_session_invalidated(self, message: str):
+        """
+        Drop the cached session changed by another node
+        :param message:
+        :return:
+        """
+        node_id, _, username = message.partition(':')
+        if node_id != self._node_id:
+            self._sessions.invalidate(username)
+
+    def __route_message(self, receiver, message):
+        """
+        Publish a message to the node holding the receiver connection, or keep it until the receiver logs in
+        :param receiver:
+        :param message:
+        :return: True when routed or kept
+        """
+        routed = self._redis.route_message(receiver, message, self._node_id, self.__offline_limit)
+        if routed == RedisServerManager.STORED:
+            self.__offline_stored.inc()
+        return bool(routed)
+
+    def __on_routed_message(self, data: str):
+        """
+        Deliver a message routed by another node, called from the subscriber thread
+        :param data: "<receiver>:<message>"
+        :return:
+        """
+        receiver, _, message = data.partition(':')
+        self._call_soon(self.__deliver, receiver, message)
+
+    def __deliver(self, receiver, message):
+        conn_receiver = self.__clients.get(receiver)
+        if conn_receiver and not getattr(conn_receiver, 'closed', False):
+            self._socket.send_data(message, conn_receiver)
+        else:
+            # Gone meanwhile, routed again to its new node or kept
+            self.__route_message(receiver, message)
+
+    def create_room(self, username, room) -> bool:
+        """
+        Create a chat room, its creator joins it
+        :param username:
+        :param room:
+        :return: False when the room already exists
+        """
+        if not self._redis.create_room(room):
+            return False
+        return self.join_room(username, room)
+
+    def join_room(self, username, room) -> bool:
+        """
+
+        :param username:
+        :param room:
+        :return: False when the room does not exist
+        """
+        if not self._redis.join_room(room, username):
+            return False
+        self._rooms.add(room, username)
+        return True
+
+    def leave_room(self, username, room):
+        """
+
+        :param username:
+        :param room:
+        :return:
+        """
+        self._redis.leave_room(room, username)
+        self._rooms.remove(room, username)
+
+    def post_room(self, username, room, text) -> bool:
+        """
+        Send a message to the members of a room, it is encoded once for all of them
+        :param username: sender, member of the room
+        :param room:
+        :param text:
+        :return: False when the sender is not a member of the room
+        """
+        if not self._rooms.is_member(room, username):
+            return False
+        message = f"#{room} {username}: {text}"
+        self.__fan_out_room(room, encode_frame(message), username)
+        # The other nodes deliver it to their members
+        self._redis.publish(self.ROOMS_CHANNEL, f"{self._node_id}:{room}:{message}")
+        if self._messages is not None:
+            self._messages.write(username, text, room=room)
+        return True
+
+    def room_history(self, username, room, before_id=None, limit=HISTORY_LIMIT, after_id=None):
+        """
+        Page of the persisted posts of a room, newest first, or oldest first after after_id
+        :param username: member of the room
+        :param room:
+        :param before_id: id of the oldest message of the previous page
+        :param limit:
+        :param after_id: id of the last message the client has
+        :return: (id, sender, text, timestamp) tuples, None when the user is not a member of the room
+        """
+        if not self._rooms.is_member(room, username):
+            return None
+        return self._history.room(room, before_id, limit, after_id) if self._history else []
+
+    def conversation_history(self, username, other, before_id=None, limit=HISTORY_LIMIT, after_id=None):
+        """
+        Page of the persisted direct messages between two users, newest first, or oldest first after after_id
+        :param username:
+        :param other:
+        :param before_id: id of the oldest message of the previous page
+        :param limit:
+        :param after_id: id of the last message the client has
+        :return: (id, sender, text, timestamp) tuples
+        """
+        return self._history.conversation(username, other, before_id, limit, after_id) if self._history else []
+
+    def __fan_out_room(self, room, frame: bytes, sender=None):
+        conns = [self.__clients.get(member) for member in self._rooms.members(room) if member != sender]
+        self._fan_out([conn for conn in conns if conn], frame)
+
+    def __on_room_message(self, data: str):
+        """
+        Deliver a room post of another node to the local members, called from the subscriber thread
+        :param data: "<node id>:<room>:<message>"
+        :return:
+        """
+        node_id, room, message = data.split(':', 2)
+        if node_id != self._node_id:
+            self._call_soon(self.__fan_out_room, room, encode_frame(message))
+
+    def subscribe_presence(self, username) -> list:
+        """
+        Push the active users changes to a user until it logs out
+        :param username:
+        :return: snapshot of the active users, taken after subscribing so no change is missed
+        """
+        self.__presence_subscribers.add(username)
+        return sorted(user.decode() for user in self._redis.get_active_users())
+
+    def __on_presence_changed(self, data: str):
+        """
+        Push an active users change to the local subscribers, called from the subscriber thread
+        :param data: "+<username>" or "-<username>"
+        :return:
+        """
+        event = 'PRESENCE_JOIN' if data.startswith('+') else 'PRESENCE_LEAVE'
+        self._call_soon(self.__fan_out_presence, encode_frame(f"{event}:{data[1:]}"))
+
+    def __fan_out_presence(self, frame: bytes):
+        conns = [self.__clients.get(username) for username in tuple(self.__presence_subscribers)]
+        self._fan_out([conn for conn in conns if conn], frame)
+
+    def _fan_out(self, conns: list, frame: bytes):
+        """
+        Write the same frame to many connections
+        :param conns:
+        :param frame:
+        :return:
+        """
+        for conn in conns:
+            conn.sendall(frame)
+
+    def _call_soon(self, func, *args):
+        """
+        Run a callback from a background thread in the context serving the connections
+        :param func:
+        :param args:
+        :return:
+        """
+        func(*args)
+
+    def _when_done(self, future: Future, func, *args):
+        """
+        Call func with args and the future once it is done, the connection thread waits for it
+        :param future:
+        :param func:
+        :param args:
+        :return:
+        """
+        wait((future,))
+        func(*args, future)
+
+    def __hello_request(self, *args):
+        """
+        Protocol negotiation, answer with the codec the client may use on this connection
+        :param args:
+        :return:
+        """
+        client_conn, codec_name = args
+        codec_name = codec_name if codec_name == BinaryCodec.name else 'text'
+        self.__reply(client_conn, f'HELLO:{codec_name}')
+
+    def queue_depths(self) -> dict:
+        """
+        Bytes waiting to be sent to each logged-in client
+        :return:
+        """
+        return {username: conn.depth for username, conn in list(self.__clients.items())}
+
+    def stats(self, username):
+        """
+        Metrics and queues of the server
+        :param username:
+        :return: None when the user is not an admin
+        """
+        if username not in self.__admins:
+            return None
+        depths = self.queue_depths()
+        return {
+            'metrics': self._metrics.snapshot(),
+            'session_cache': self._sessions.stats(),
+            # deepest outbound queues, in bytes
+            'queue_depths': dict(sorted(depths.items(), key=lambda item: item[1], reverse=True)[:10]),
+            'messages': {'written': self._messages.written, 'dropped': self._messages.dropped}
+            if self._messages is not None else None,
+        }
+
+    def _handle_request(self, client_conn, data: bytes):
+        """
+        Call the request handler matching the request command, shared by all server engines
+        :param client_conn: client connection, anything exposing sendall and close, and closed when it has it
+        :param data: raw request, text or binary encoded, in a correlation envelope or not
+        :return:
+        """
+        try:
+            correlation_id, data = decode_correlated(data)
+        except ValueError as e:
+            # no id to answer with, the reply is sent without envelope
+            log.debug("wrong entry conn=%s reason=%s", client_conn, e)
+            self._socket.send_data('WRONG_ENTRY:Malformed correlation id.', client_conn)
+            return
+        if correlation_id is None:
+            self.__dispatch(client_conn, data)
+            return
+        request = _CorrelatedRequest(client_conn, correlation_id)
+        token = _current_request.set(request)
+        try:
+            self.__dispatch(client_conn, data)
+        finally:
+            _current_request.reset(token)
+        if not request.answered:
+            self._socket.send_data(encode_reply(correlation_id, 'OK'), client_conn)
+
+    def __dispatch(self, client_conn, data: bytes):
+        if self.__rate_limited_request(client_conn, self._connection_limits, client_conn, 'connection'):
+            return
+        try:
+            command, *args = self.__codec.decode_request(data)
+        except ValueError as e:
+            log.debug("wrong entry conn=%s reason=%s", client_conn, e)
+            self.__reply(client_conn, 'WRONG_ENTRY:Malformed request.')
+            return
+        request_method = self.__requests.get(command)
+        # Call appropriate method
+        if request_method:
+            # racing threads may time a request more or less, a countdown gone below 0 still times the next one
+            self.__unsampled -= 1
+            if self.__unsampled > 0:
+                request_method(client_conn, *args)
+                return
+            self.__unsampled = self.REQUEST_SAMPLE
+            start = time.perf_counter()
+            # message requests return the chat command they ran
+            command_name = request_method(client_conn, *args) or command
+            elapsed = time.perf_counter() - start
+            observe = self.__request_observers.get(command_name)
+            if observe is None:
+                observe = self.__request_observer(command, command_name)
+            observe(elapsed)
+
+    def __request_observer(self, command, command_name):
+        labels = (command, '') if command_name == command else (command, command_name)
+        return self.__request_observers.setdefault(command_name, self.__request_seconds.labels(*labels).observe)
+
+    def _handle_error(self, client_conn, error: Exception):
+        """
+        Handle an unexpected error raised while serving a client
+        :param client_conn:
+        :param error:
+        :return:
+        """
+        # TODO send internal error to user
+        self.__request_errors.inc()
+        log.error("request failed conn=%s reason=%r", client_conn, error)
+        # logout current client session
+        self.__logout_request(client_conn)
 
     def handle_client(self, client_conn):
+        self._open_connections.inc()
         try:
-            while True:
-                data: str = self._socket.receive_data(client_conn)
-                if not data:
-                    print(f"[WARNING] Closing client connection: {client_conn}")
-                    break
-
-                command, *args = data.split(':')
-                # FIXME: getattr not cool, if refactoring, the code needs to be maintained
-                request_method = getattr(self, f"_{self.__class__.__name__}__{command.lower()}_request")
-                # Call appropriate method
-                if request_method:
-                    request_method(client_conn, *args)
+            for data in self._socket.receive_messages(client_conn, raw=True):
+                self._handle_request(client_conn, data)
+            log.info("connection closed conn=%s", client_conn)
         except (ConnectionAbortedError, ConnectionResetError):
-            print("[WARNING] Client forcibly closed the connection.")
+            log.warning("connection reset by client conn=%s", client_conn)
         except Exception as e:
-            # TODO send internal error to user
-            print(f"[ERROR] Error happened when trying to handle client requests. REASON {e}")
-            # logout current client session
-            self.__logout_request(client_conn)
+            self._handle_error(client_conn, e)
         finally:
 
             # Close current user session
             self._socket.close(client_conn)
-            print(f'[DEBUG] All active users : {self._redis.get_active_users()}')
+            self._connection_closed(client_conn)
+            if log.isEnabledFor(logging.DEBUG):
+                log.debug("active users=%s", self._redis.get_active_users())
+
+    def _connection_closed(self, client_conn):
+        """
+        Forget a closed connection, shared by all server engines
+        :param client_conn:
+        :return:
+        """
+        self._open_connections.dec()
+        self._connection_limits.forget(client_conn)
+        username = getattr(client_conn, 'username', None)
+        if username is not None and self.__clients.get(username) is client_conn:
+            # Dropped without logout, its messages are kept until the next login instead of sent to a dead socket
+            log.info("connection lost user=%s", username)
+            self.__logout_request(client_conn, username, None)
 
     def start_server(self):
         """
@@ -159,18 +802,20 @@ class ChatServer:
         :return:
         """
         try:
-
+            log.info("listening port=%s", self._socket.port)
             while True:
                 # TODO consider taking into account the client address too, in redis for
                 #      robust authentication and data persistence
-                print("[INFO] Server is listening on port 5000")
                 client_conn, addr = self._socket.accept_connection()
-                print(f"[INFO] connection from {addr}")
+                log.info("connection from addr=%s", addr)
+                client_conn = ClientConnection(client_conn, addr, self._outbound)
                 client_thread = threading.Thread(target=self.handle_client, args=(client_conn,))
                 client_thread.start()
+        except KeyboardInterrupt:
+            log.info("shutting down the server")
         except Exception as e:
             # TODO make specific errors
-            print()
+            log.error("accept loop stopped reason=%r", e)
 
     def __enter__(self):
         """
@@ -178,8 +823,24 @@ class ChatServer:
         :return:
         """
 
-        print("[INFO] Starting server, Binding and listening ....")
-        self._socket.bind_and_listen()
+        log.info("starting server host=%s port=%s", self._socket.host, self._socket.port)
+        self._socket.bind_and_listen(self.__reuse_port)
+        self._credentials.start()
+        self.__stopping.clear()
+        self.__sweeper = threading.Thread(target=self.__sweep, daemon=True)
+        self.__sweeper.start()
+        if self._messages is not None:
+            self._messages.start()
+        if self.__metrics_port is not None:
+            self.__metrics_server = MetricsServer(self._metrics, self._socket.host, self.__metrics_port)
+            self.__metrics_server.start()
+            log.info("metrics url=http://%s:%s/metrics", self._socket.host, self.__metrics_server.port)
+        self.__subscriber = self._redis.subscribe({
+            self.SESSION_CHANNEL: self.__on_session_invalidated,
+            f"{self._redis.NODE_CHANNEL_PREFIX}{self._node_id}": self.__on_routed_message,
+            self.ROOMS_CHANNEL: self.__on_room_message,
+            self.PRESENCE_CHANNEL: self.__on_presence_changed,
+        })
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
@@ -190,10 +851,119 @@ class ChatServer:
         :param exc_tb:
         :return:
         """
-        print("[WARNING] Closing connection ...")
+        log.info("stopping server")
         self._socket.close()
+        if self.__subscriber:
+            self.__subscriber.stop()
+        self.__stopping.set()
+        if self.__sweeper:
+            self.__sweeper.join()
+        if self.__metrics_server:
+            self.__metrics_server.stop()
+        self._credentials.stop()
+        log.info("session cache stats=%s", self._sessions.stats())
+        if self._messages is not None:
+            # Persist the buffered messages before leaving
+            self._messages.stop()
+            log.info("messages persisted=%s dropped=%s", self._messages.written, self._messages.dropped)
 
 
-if __name__ == "__main__":
-    with ChatServer() as server:
+def serve(mode='asyncio', host='localhost', port=12345, database=None, **kwargs):
+    """
+    Run a server until interrupted
+    :param mode: asyncio or threaded
+    :param host:
+    :param port:
+    :param database: SQLAlchemy URL of the messages history, not persisted when empty
+    :param kwargs: server keyword arguments
+    :return:
+    """
+    server_cls = ChatServer
+    if mode == 'asyncio':
+        from src.services.async_server import AsyncChatServer as server_cls
+
+    with server_cls(host, port, messages=MessageWriter(database) if database else None, **kwargs) as server:
         server.start_server()
+
+
+def serve_worker(index, options: dict):
+    """
+    Worker process of a supervisor, serving on the port shared with the other workers until terminated
+    :param index: worker index, its metrics are served on metrics_port + index
+    :param options: serve arguments and log_level
+    :return:
+    """
+    setup_logging(options.pop('log_level', None))
+    stop_on_terminate()
+    if options.get('metrics_port') is not None:
+        options['metrics_port'] += index
+    log.info("worker index=%s pid=%s", index, os.getpid())
+    serve(reuse_port=True, **options)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Realtime chat server")
+    parser.add_argument('--mode', choices=('asyncio', 'threaded'), default='asyncio',
+                        help="asyncio: single event loop, threaded: one thread per connection")
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=12345,
+                        help="nodes sharing the same Redis route messages to each other, whatever their port")
+    parser.add_argument('--outbound-policy', choices=OutboundConfig.POLICIES, default='drop',
+                        help="data sent to a client over the high watermark is dropped, disconnects the client "
+                             "or is spilled to disk until the client catches up")
+    parser.add_argument('--high-watermark', type=int, default=256 * 1024, help="outbound queue bytes")
+    parser.add_argument('--low-watermark', type=int, default=64 * 1024, help="outbound queue bytes")
+    parser.add_argument('--metrics-port', type=int, help="serve the Prometheus metrics on this port")
+    parser.add_argument('--admin', action='append', default=[], help="user allowed to run /stats, repeatable")
+    parser.add_argument('--database', default='sqlite:///chat.db',
+                        help="SQLAlchemy URL of the messages history, empty to not persist the messages")
+    parser.add_argument('--auth-workers', type=int,
+                        help="password check processes, all the CPUs but one by default, "
+                             "0 checks them in the request loop")
+    parser.add_argument('--max-pending-logins', type=int, default=256,
+                        help="password checks queued or running over which logins are refused with AUTH_BUSY")
+    parser.add_argument('--renew-interval', type=float, default=60,
+                        help="seconds between two renewals of the active sessions expiry")
+    parser.add_argument('--no-rate-limits', action='store_true', help="do not limit the requests rate")
+    parser.add_argument('--global-rate-limits', action='store_true',
+                        help="limit the users requests across the nodes, in Redis, rather than on each node")
+    parser.add_argument('--offline-limit', type=int, default=1000,
+                        help="messages kept by offline user until its next login, 0 to answer NOT_FOUND instead")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="server processes sharing the port, restarted when they stop, SO_REUSEPORT platforms only")
+    parser.add_argument('--log-level', choices=('DEBUG', 'INFO', 'WARNING', 'ERROR'),
+                        help="CHAT_LOG_LEVEL or INFO when not given")
+    cli_args = parser.parse_args()
+    setup_logging(cli_args.log_level)
+    stop_on_terminate()
+
+    server_options = dict(
+        mode=cli_args.mode, host=cli_args.host, port=cli_args.port, database=cli_args.database,
+        outbound=OutboundConfig(cli_args.high_watermark, cli_args.low_watermark, cli_args.outbound_policy),
+        metrics_port=cli_args.metrics_port, admins=cli_args.admin, auth_workers=cli_args.auth_workers,
+        max_pending_logins=cli_args.max_pending_logins, renew_interval=cli_args.renew_interval,
+        rate_limits={} if cli_args.no_rate_limits else None, global_rate_limits=cli_args.global_rate_limits,
+        offline_limit=cli_args.offline_limit)
+    if cli_args.workers > 1:
+        if not hasattr(socket, 'SO_REUSEPORT'):
+            parser.error("--workers needs SO_REUSEPORT, not available on this platform")
+        from sqlalchemy import create_engine
+        from sqlalchemy.engine import make_url
+        from src.services.supervisor import Supervisor
+
+        if cli_args.database:
+            if make_url(cli_args.database).get_backend_name() == 'sqlite':
+                parser.error("--workers needs a database accepting concurrent writers, not SQLite, "
+                             "give another --database or '' to not persist the messages")
+            # created once, the workers do not race on it
+            engine = create_engine(cli_args.database)
+            create_schema(engine)
+            engine.dispose()
+        if cli_args.auth_workers is None:
+            # the CPUs left by the servers, shared between them
+            server_options['auth_workers'] = max(1, ((os.cpu_count() or 1) - cli_args.workers) // cli_args.workers)
+        Supervisor(serve_worker, cli_args.workers, (dict(server_options, log_level=cli_args.log_level),)).run()
+    else:
+        serve(**server_options)
@@ -0,0 +1,115 @@
+"""
+Module to run the chat server in many processes
+"""
+import multiprocessing
+import time
+from multiprocessing.connection import wait
+
+from src.utils import get_logger
+
+log = get_logger('supervisor')
+
+
+class Supervisor:
+    """
+    Run a server in worker processes listening on the same port, one Python interpreter each, and start again the
+    ones that stop. The workers share the sessions, the presence and the message routing through Redis, like nodes.
+    """
+    # seconds a worker must run to be restarted at once when it stops, the ones stopping sooner are restarted
+    # later and later, up to MAX_RESTART_DELAY
+    MIN_UPTIME = 5.0
+    MAX_RESTART_DELAY = 30.0
+
+    def __init__(self, target, workers: int, args=(), stop_timeout=10.0):
+        """
+        :param target: worker function, called with the worker index and args in the worker process
+        :param workers: worker processes
+        :param args: picklable arguments of the target
+        :param stop_timeout: seconds the workers have to stop before being killed
+        """
+        if workers < 1:
+            raise ValueError("A supervisor needs one worker at least")
+        self.__target = target
+        self.__workers = workers
+        self.__args = args
+        self.__stop_timeout = stop_timeout
+        # fresh interpreters, the workers do not inherit the threads or the Redis connections of the supervisor
+        self.__context = multiprocessing.get_context('spawn')
+        # process, start time and restart delay by worker index
+        self.__processes = {}
+        self.__started = {}
+        self.__delays = {}
+        self.restarts = 0
+
+    @property
+    def pids(self) -> list:
+        return [process.pid for process in self.__processes.values()]
+
+    def __start(self, index):
+        process = self.__context.Process(target=self.__target, args=(index, *self.__args),
+                                         name=f"chat-worker-{index}")
+        process.start()
+        self.__processes[index] = process
+        self.__started[index] = time.monotonic()
+        log.info("worker started index=%s pid=%s", index, process.pid)
+
+    def __restart_delay(self, index) -> float:
+        """
+        Seconds before restarting a stopped worker, doubled each time it stops before MIN_UPTIME
+        :param index:
+        :return:
+        """
+        if time.monotonic() - self.__started[index] >= self.MIN_UPTIME:
+            delay = 0.0
+        else:
+            delay = min(max(1.0, 2 * self.__delays.get(index, 0.0)), self.MAX_RESTART_DELAY)
+        self.__delays[index] = delay
+        return delay
+
+    def run(self):
+        """
+        Start the workers and restart the stopped ones until interrupted, then stop them all
+        :return:
+        """
+        for index in range(self.__workers):
+            self.__start(index)
+        # restart time by stopped worker index
+        restarts = {}
+        try:
+            while True:
+                timeout = max(0.0, min(restarts.values()) - time.monotonic()) if restarts else None
+                sentinels = {process.sentinel: index for index, process in self.__processes.items()
+                             if index not in restarts}
+                for sentinel in wait(list(sentinels), timeout):
+                    index = sentinels[sentinel]
+                    process = self.__processes[index]
+                    process.join()
+                    delay = self.__restart_delay(index)
+                    log.error("worker stopped index=%s pid=%s exitcode=%s restart_in=%.1f", index, process.pid,
+                              process.exitcode, delay)
+                    restarts[index] = time.monotonic() + delay
+                now = time.monotonic()
+                for index in [index for index, when in restarts.items() if when <= now]:
+                    del restarts[index]
+                    self.restarts += 1
+                    self.__start(index)
+        except KeyboardInterrupt:
+            log.info("stopping workers count=%s", len(self.__processes))
+        finally:
+            self.stop()
+
+    def stop(self):
+        """
+        Terminate the workers, they leave their server context, and kill the ones still running after stop_timeout
+        :return:
+        """
+        for process in self.__processes.values():
+            if process.is_alive():
+                process.terminate()
+        deadline = time.monotonic() + self.__stop_timeout
+        for process in self.__processes.values():
+            process.join(max(0.0, deadline - time.monotonic()))
+            if process.is_alive():
+                log.warning("worker killed pid=%s", process.pid)
+                process.kill()
+                process.join()
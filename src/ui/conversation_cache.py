@@ -0,0 +1,175 @@
+"""
+Module to cache the conversations of the desktop client, on disk and in memory
+"""
+import os
+import sqlite3
+from collections import OrderedDict
+
+
+def transcript_lines(messages, username: str) -> list:
+    """
+    Lines of the transcript, the messages of the user start with Me
+    :param messages: (sender, text) pairs
+    :param username: user logged in
+    :return:
+    """
+    return [f"{'Me' if sender == username else sender}: {text}" for sender, text in messages]
+
+
+class Conversation:
+    """
+    Latest messages of a conversation: the saved ones, with their server id, then the ones received or sent since
+    the last sync, not saved by the server yet as far as the client knows
+    """
+
+    def __init__(self, rows: list):
+        # (id, sender, text, timestamp), oldest first
+        self.rows = rows
+        # (sender, text), oldest first
+        self.pending = []
+
+    @property
+    def last_id(self):
+        return self.rows[-1][0] if self.rows else None
+
+    def lines(self, username: str) -> list:
+        return transcript_lines([row[1:3] for row in self.rows] + self.pending, username)
+
+
+class ConversationCache:
+    """
+    Messages of the conversations of a user, saved in a SQLite file so they are shown at once when a conversation is
+    opened, the client then only asks the server for the messages following the last id it has.
+
+    The latest messages of the recently opened conversations stay in memory, up to max_conversations (least recently
+    used ones are evicted). The file only holds contiguous runs of the server history: pages read backward from the
+    latest message and deltas read forward from the last id, so an older page can be read from the file before
+    asking the server.
+    """
+    DIRECTORY = os.path.join(os.path.expanduser('~'), '.chat_app')
+    MAX_CONVERSATIONS = 20
+    MAX_MESSAGES = 500
+
+    def __init__(self, path: str, max_conversations=MAX_CONVERSATIONS, max_messages=MAX_MESSAGES):
+        """
+        :param path: SQLite file
+        :param max_conversations: conversations kept in memory
+        :param max_messages: latest messages kept in memory by conversation
+        """
+        self.__max_conversations = max_conversations
+        self.__max_messages = max_messages
+        self.__conversations = OrderedDict()
+        self.__db = sqlite3.connect(path)
+        self.__db.execute("PRAGMA journal_mode=WAL")
+        self.__db.execute("PRAGMA synchronous=NORMAL")
+        self.__db.execute("CREATE TABLE IF NOT EXISTS messages (conversation TEXT NOT NULL, id INTEGER NOT NULL, "
+                          "sender TEXT NOT NULL, text TEXT NOT NULL, timestamp TEXT NOT NULL, "
+                          "PRIMARY KEY (conversation, id)) WITHOUT ROWID")
+        self.hits = 0
+        self.misses = 0
+
+    @classmethod
+    def for_user(cls, username: str, **kwargs):
+        """
+        Cache of a user in DIRECTORY
+        :param username:
+        :return:
+        """
+        os.makedirs(cls.DIRECTORY, exist_ok=True)
+        return cls(os.path.join(cls.DIRECTORY, f"{username}.db"), **kwargs)
+
+    def __len__(self):
+        return len(self.__conversations)
+
+    def close(self):
+        self.__db.close()
+
+    def open(self, target: str) -> Conversation:
+        """
+        Get a conversation, its latest messages are read from the file on a miss
+        :param target: other user
+        :return:
+        """
+        conversation = self.__conversations.get(target)
+        if conversation is not None:
+            self.__conversations.move_to_end(target)
+            self.hits += 1
+            return conversation
+        self.misses += 1
+        rows = self.__db.execute("SELECT id, sender, text, timestamp FROM messages WHERE conversation = ? "
+                                 "ORDER BY id DESC LIMIT ?", (target, self.__max_messages)).fetchall()
+        conversation = self.__conversations[target] = Conversation(rows[::-1])
+        while len(self.__conversations) > self.__max_conversations:
+            self.__conversations.popitem(last=False)
+        return conversation
+
+    def older(self, target: str, before_id: int, limit: int) -> list:
+        """
+        Saved messages before an id
+        :param target:
+        :param before_id:
+        :param limit:
+        :return: (id, sender, text, timestamp) tuples, oldest first
+        """
+        rows = self.__db.execute("SELECT id, sender, text, timestamp FROM messages WHERE conversation = ? AND id < ? "
+                                 "ORDER BY id DESC LIMIT ?", (target, before_id, limit)).fetchall()
+        return rows[::-1]
+
+    def add_pending(self, target: str, sender: str, text: str):
+        """
+        Keep a message received or sent, until a delta from the server holds it
+        :param target:
+        :param sender:
+        :param text:
+        :return:
+        """
+        self.open(target).pending.append((sender, text))
+
+    def add_history(self, target: str, messages: list) -> list:
+        """
+        Save a page of the history, it becomes the latest messages of a conversation that had none
+        :param target:
+        :param messages: [id, sender, text, timestamp] lists of a HISTORY reply, newest first
+        :return: (id, sender, text, timestamp) tuples, oldest first
+        """
+        conversation = self.open(target)
+        rows = self.__save(target, messages[::-1])
+        if not conversation.rows:
+            conversation.rows = rows[-self.__max_messages:]
+            self.__match_pending(conversation, rows)
+        return rows
+
+    def add_since(self, target: str, messages: list) -> list:
+        """
+        Save the messages following the last id of a conversation, the pending messages they hold are dropped
+        :param target:
+        :param messages: [id, sender, text, timestamp] lists of a SINCE reply, oldest first
+        :return: (id, sender, text, timestamp) tuples, oldest first
+        """
+        # opened first, the messages saved are not read back as the latest ones
+        conversation = self.open(target)
+        rows = self.__save(target, messages)
+        last_id = conversation.last_id or 0
+        rows = [row for row in rows if row[0] > last_id]
+        conversation.rows = (conversation.rows + rows)[-self.__max_messages:]
+        self.__match_pending(conversation, rows)
+        return rows
+
+    def __save(self, target, messages) -> list:
+        rows = [tuple(message) for message in messages]
+        with self.__db:
+            self.__db.executemany("INSERT OR IGNORE INTO messages VALUES (?, ?, ?, ?, ?)",
+                                  [(target, *row) for row in rows])
+        return rows
+
+    @staticmethod
+    def __match_pending(conversation, rows):
+        """
+        Drop the pending messages found in rows, the server may have saved the messages sent and the ones received
+        in another order, the others are still to come
+        """
+        for _, sender, text, _ in rows:
+            try:
+                conversation.pending.remove((sender, text))
+            except ValueError:
+                pass
@@ -0,0 +1,74 @@
+from PyQt5.QtCore import QStringListModel
+
+
+class TranscriptModel(QStringListModel):
+    """
+    Lines of the selected conversation, bounded: the oldest ones are dropped past the capacity and the view only asks
+    for the lines it shows. Older pages of the history are put in front while there is room left.
+    The rows stay in the C++ model, the view lays them out without calling Python for each row.
+    """
+    CAPACITY = 10_000
+
+    def __init__(self, capacity=CAPACITY, parent=None):
+        super().__init__(parent)
+        self.__capacity = capacity
+        # before_id of the next older page, 0 for the latest one, None once there is nothing older to show
+        self.before_id = 0
+
+    @property
+    def capacity(self) -> int:
+        return self.__capacity
+
+    def __set_lines(self, row: int, lines: list):
+        self.insertRows(row, len(lines))
+        for row, line in enumerate(lines, row):
+            self.setData(self.index(row), line)
+
+    def append(self, lines: list):
+        """
+        Add lines after the last one, drop the oldest ones past the capacity
+        :param lines:
+        :return:
+        """
+        lines = lines[-self.__capacity:]
+        if not lines:
+            return
+        overflow = self.rowCount() + len(lines) - self.__capacity
+        if overflow > 0:
+            self.removeRows(0, overflow)
+            # the lines before the first one kept are out of reach
+            self.before_id = None
+        self.__set_lines(self.rowCount(), lines)
+
+    def prepend(self, lines: list, before_id=None) -> int:
+        """
+        Put an older page before the first line, as much of it as there is room for
+        :param lines: oldest first
+        :param before_id: before_id of the page after this one, None when there is none
+        :return: the lines put
+        """
+        room = self.__capacity - self.rowCount()
+        if len(lines) > room:
+            lines, before_id = lines[len(lines) - room:], None
+        self.before_id = before_id
+        if lines:
+            self.__set_lines(0, lines)
+        return len(lines)
+
+    def remove_last(self, count: int):
+        """
+        Drop the last lines
+        :param count:
+        :return:
+        """
+        count = min(count, self.rowCount())
+        if count:
+            self.removeRows(self.rowCount() - count, count)
+
+    def clear(self):
+        """
+        Drop all the lines, the next page to load is the latest one
+        :return:
+        """
+        self.setStringList([])
+        self.before_id = 0
@@ -1,18 +1,34 @@
-from PyQt5.QtCore import Qt
-from PyQt5.QtWidgets import QApplication, QWidget, QListWidget, QTextEdit, QLineEdit, QPushButton, QVBoxLayout, \
-    QLabel
+import json
 
-from services.client_side import ChatClient
+from PyQt5.QtCore import Qt, QTimer
+from PyQt5.QtWidgets import QApplication, QWidget, QListWidget, QListView, QLineEdit, QPushButton, QVBoxLayout, \
+    QLabel, QAbstractItemView
+
+from services.client_side import ClientChatGui
+from .conversation_cache import ConversationCache, transcript_lines
+from .transcript import TranscriptModel
 
 
 class ChatWindow(QWidget):
     MESSAGE_CMDS = {"active_users": "/u",
-                    "message_user": "@%s %s"}
+                    "presence": "/presence",
+                    "message_user": "@%s %s",
+                    "history": "/history %s %s %s",
+                    "since": "/since %s %s %s"}
+    # messages by history page loaded when scrolling up, and by page of messages following the cached ones
+    HISTORY_PAGE = 100
 
-    def __init__(self, chat_client: ChatClient):
+    def __init__(self, chat_client: ClientChatGui, scrollback=TranscriptModel.CAPACITY):
         super().__init__()
 
         self.__current_user = None
+        # user logged in and the cache of its conversations, opened after the login
+        self.__username = None
+        self.cache = None
+        # lines received during the current Qt event turn, added to the transcript at once
+        self.__queued_lines = []
+        # a history page was asked for and did not arrive yet
+        self.__loading_history = False
         self.usernameLabel = None
         self.rightLayout = None
         self.mainLayout = None
@@ -20,7 +36,8 @@ class ChatWindow(QWidget):
         self.sendButton = None
         self.userList = QListWidget()
         self.messageInput = None
-        self.messageDisplay = QTextEdit()
+        self.transcript = TranscriptModel(scrollback)
+        self.messageDisplay = QListView()
         self.chatArea = None
         self.setWindowTitle('Chat App')
 
@@ -78,7 +95,13 @@ class ChatWindow(QWidget):
         self.usernameLabel = QLabel("")
         chatLayout.addWidget(self.usernameLabel)
 
-        self.messageDisplay.setReadOnly(True)
+        # the view lays out and paints the visible lines only, one line height for all of them
+        self.messageDisplay.setModel(self.transcript)
+        self.messageDisplay.setUniformItemSizes(True)
+        self.messageDisplay.setEditTriggers(QAbstractItemView.NoEditTriggers)
+        self.messageDisplay.setSelectionMode(QAbstractItemView.NoSelection)
+        self.messageDisplay.setVerticalScrollMode(QAbstractItemView.ScrollPerPixel)
+        self.messageDisplay.verticalScrollBar().valueChanged.connect(self.on_transcript_scrolled)
         chatLayout.addWidget(self.messageDisplay)
 
         self.messageInput = QLineEdit()
@@ -90,28 +113,218 @@ class ChatWindow(QWidget):
 
     def on_user_clicked(self, item):
         # Update the username label with the selected user
-        self.messageDisplay.clear()
-        self.usernameLabel.setText(f"Selected User: {item.text()}")
         self.__current_user = item.text()
+        self.__loading_history = False
+        self.__queued_lines.clear()
+        self.transcript.clear()
+        self.usernameLabel.setText(f"Selected User: {item.text()}")
         self.chatArea.show()
+        conversation = self.cache.open(self.__current_user) if self.cache is not None else None
+        if conversation is None or not conversation.rows:
+            # nothing saved yet, the latest page comes from the server
+            if conversation:
+                self.transcript.append(conversation.lines(self.__username))
+            self.load_history()
+            return
+        # shown from the cache, then only the messages following the last one saved are asked for
+        self.__show_conversation(conversation)
+        self.__sync(self.__current_user, conversation.last_id)
 
     def on_send_clicked(self):
         message = self.messageInput.text()
         if message:
             # Update the chat display
-            current_text = self.messageDisplay.toPlainText()
-            new_text = f"{current_text}\nMe: {message}" if current_text else f"Me: {message}"
-
-            self.messageDisplay.setText(new_text)
+            self.__add_message(self.__current_user, self.__username, message)
             # TODO send message to a user
-            self.__chat_client.send_message(self.MESSAGE_CMDS["message_user"] % (self.__current_user,
-                                                                                 message))
+            self.__chat_client.request(self.MESSAGE_CMDS["message_user"] % (self.__current_user, message),
+                                       self.__message_sent)
             # Clear the input field
             self.messageInput.clear()
 
+    def open_cache(self, username: str):
+        """
+        Open the cache of the conversations of the user logged in
+        :param username:
+        :return:
+        """
+        self.__username = username
+        self.cache = ConversationCache.for_user(username)
+
+    def close_cache(self):
+        if self.cache is not None:
+            self.cache.close()
+            self.cache = None
+
+    def receive_message(self, sender: str, text: str):
+        """
+        Keep a direct message received, shown if its conversation is selected
+        :param sender:
+        :param text:
+        :return:
+        """
+        self.__add_message(sender, sender, text)
+
+    def __add_message(self, target, sender, text):
+        if self.cache is not None:
+            self.cache.add_pending(target, sender, text)
+        if target == self.__current_user:
+            self.append_messages(transcript_lines([(sender, text)], self.__username))
+
+    def __show_conversation(self, conversation):
+        self.transcript.clear()
+        self.transcript.append(conversation.lines(self.__username))
+        self.transcript.before_id = conversation.rows[0][0] if conversation.rows else None
+        self.messageDisplay.scrollToBottom()
+
+    def __sync(self, target, after_id):
+        self.__chat_client.request(self.MESSAGE_CMDS["since"] % (target, after_id, self.HISTORY_PAGE),
+                                   self.__since_received)
+
+    @staticmethod
+    def __message_sent(reply: str):
+        if reply != 'OK':
+            print(f"[WARNING] Message not sent: {reply}")
+
+    def __history_received(self, reply: str):
+        status, _, page = reply.partition(':')
+        if status == 'HISTORY':
+            self.show_history(json.loads(page))
+            return
+        # asked for again on the next scroll
+        self.__loading_history = False
+        print(f"[WARNING] Cannot load the history: {reply}")
+
+    def __since_received(self, reply: str):
+        status, _, page = reply.partition(':')
+        if status == 'SINCE':
+            self.show_since(json.loads(page))
+        else:
+            print(f"[WARNING] Cannot load the new messages: {reply}")
+
+    def append_messages(self, lines: list):
+        """
+        Add lines after the last one once the pending Qt events are processed, the lines of a burst of messages
+        are inserted and laid out together
+        :param lines:
+        :return:
+        """
+        if not self.__queued_lines:
+            QTimer.singleShot(0, self.__flush_lines)
+        self.__queued_lines.extend(lines)
+
+    def __flush_lines(self):
+        """
+        Add the queued lines, the view follows them if it showed the last line
+        :return:
+        """
+        lines, self.__queued_lines = self.__queued_lines, []
+        scrollbar = self.messageDisplay.verticalScrollBar()
+        follow = scrollbar.value() == scrollbar.maximum()
+        self.transcript.append(lines)
+        if follow:
+            self.messageDisplay.scrollToBottom()
+
+    def on_transcript_scrolled(self, value):
+        if value == self.messageDisplay.verticalScrollBar().minimum():
+            self.load_history()
+
+    def load_history(self):
+        """
+        Show the page of the conversation before the first line shown, read from the cache or asked for to the
+        server, one page at a time
+        :return:
+        """
+        before_id = self.transcript.before_id
+        if self.__current_user is None or self.__loading_history or before_id is None:
+            return
+        if before_id and self.cache is not None:
+            rows = self.cache.older(self.__current_user, before_id, self.HISTORY_PAGE)
+            if rows:
+                self.__prepend(rows, rows[0][0])
+                return
+        self.__loading_history = True
+        self.__chat_client.request(self.MESSAGE_CMDS["history"] % (self.__current_user, before_id, self.HISTORY_PAGE),
+                                   self.__history_received)
+
+    def show_history(self, page: dict):
+        """
+        Save a page of the history and put it before the first line, the lines shown stay in place
+        :param page: HISTORY reply, its messages newest first
+        :return:
+        """
+        target = page['target']
+        if self.cache is not None:
+            rows = self.cache.add_history(target, page['messages'])
+        else:
+            rows = [tuple(message) for message in reversed(page['messages'])]
+        if target != self.__current_user:
+            return
+        self.__loading_history = False
+        if self.transcript.before_id == 0 and self.cache is not None:
+            # the latest page, the messages received meanwhile it holds are shown once
+            self.__queued_lines.clear()
+            self.__show_conversation(self.cache.open(target))
+            return
+        latest = self.transcript.before_id == 0
+        self.__prepend(rows, page['before_id'])
+        if latest:
+            self.messageDisplay.scrollToBottom()
+
+    def show_since(self, page: dict):
+        """
+        Save the messages following the last one of a conversation cache, and show them in place of the messages
+        received or sent meanwhile
+        :param page: SINCE reply, its messages oldest first
+        :return:
+        """
+        if self.cache is None:
+            return
+        target = page['target']
+        conversation = self.cache.open(target)
+        shown = len(conversation.pending)
+        rows = self.cache.add_since(target, page['messages'])
+        if target == self.__current_user and (rows or shown != len(conversation.pending)):
+            self.__flush_lines()
+            self.transcript.remove_last(shown)
+            self.append_messages(transcript_lines([row[1:3] for row in rows] + conversation.pending,
+                                                  self.__username))
+        if len(page['messages']) >= self.HISTORY_PAGE:
+            self.__sync(target, page['after_id'])
+
+    def __prepend(self, rows, before_id):
+        """
+        Put older lines before the first one, the lines shown stay in place
+        :param rows: (id, sender, text, timestamp) tuples, oldest first
+        :param before_id: before_id of the next older page
+        :return:
+        """
+        added = self.transcript.prepend(transcript_lines([row[1:3] for row in rows], self.__username), before_id)
+        if added:
+            self.messageDisplay.scrollTo(self.transcript.index(added), QAbstractItemView.PositionAtTop)
+
     def get_active_users(self):
         self.__chat_client.send_message(self.MESSAGE_CMDS["active_users"])
 
+    def subscribe_presence(self, handler):
+        self.__chat_client.request(self.MESSAGE_CMDS["presence"], handler)
+
+    def set_users(self, users):
+        """
+        Replace the online users, from a presence snapshot
+        :param users:
+        :return:
+        """
+        self.userList.clear()
+        self.userList.addItems(users)
+
+    def add_user(self, username):
+        if not self.userList.findItems(username, Qt.MatchExactly):
+            self.userList.addItem(username)
+
+    def remove_user(self, username):
+        for item in self.userList.findItems(username, Qt.MatchExactly):
+            self.userList.takeItem(self.userList.row(item))
+
 
 if __name__ == "__main__":
     import sys
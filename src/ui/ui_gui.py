@@ -1,7 +1,7 @@
 import asyncio
+import json
 import sys
 
-from PyQt5.QtCore import QTimer
 from PyQt5.QtWidgets import QApplication
 
 from services.client_side import ClientChatGui
@@ -16,30 +16,28 @@ class ChatApp(QApplication):
         # TODO close connection
         # TODO Add logout button
         super().__init__(argv)
-        self.__users_list_obj = []
-        self.timer = QTimer(self)
-        self.__client = ClientChatGui()
-        self.__client_chat = self.__client.chat_client
+        self.__users_list_obj = set()
+        # Start the asyncio event loop in a separate thread, it runs the client connection
+        self.loop = asyncio.new_event_loop()
+        self.thread = AsyncioThread(self.loop)
+        self.thread.start()
+
+        self.__client = ClientChatGui(self.loop)
         # Connect to client
-        self.__loginWindow = LoginWindow(self.__client_chat)
-        self.__chatWindow = ChatWindow(self.__client_chat)
+        self.__loginWindow = LoginWindow(self.__client)
+        self.__chatWindow = ChatWindow(self.__client)
         self.__setup_ui()
 
         # Connect aboutToQuit signal to a method
         self.aboutToQuit.connect(self.on_about_to_quit)
 
-        # Start the asyncio event loop in a separate thread
-        self.loop = asyncio.new_event_loop()
-        self.thread = AsyncioThread(self.loop)
-        self.thread.start()
-
     def __setup_ui(self):
         """
 
         :return:
         """
         try:
-            self.__client_chat.connect()
+            self.__client.connect()
         except ConnectionRefusedError:
             print("[WARNING] Server is unreachable")
             sys.exit(1)
@@ -51,34 +49,48 @@ class ChatApp(QApplication):
 
     def __get_online_users(self):
         """
-
+        Get the online users, their changes are pushed by the server afterward
         :return:
         """
-        self.__chatWindow.get_active_users()
+        self.__chatWindow.subscribe_presence(self.__presence_received)
 
-    def chat_message_received(self):
+    def __presence_received(self, reply: str):
+        """
+        Show the online users snapshot
+        :param reply:
+        :return:
         """
+        status, _, users = reply.partition(":")
+        if status != "PRESENCE":
+            print(f"[WARNING] Cannot get the online users: {reply}")
+            return
+        self.__users_list_obj = set(json.loads(users))
+        self.__chatWindow.set_users(sorted(self.__users_list_obj))
 
+    def chat_message_received(self, response: str):
+        """
+        Handle a message pushed by the server, the replies to the requests go to their handler
+        :param response:
         :return:
         """
-        print(f"MESSAGE {self.__client.current_message}")
         try:
-            rcv, message = self.__client.current_message.split(":")
+            rcv, message = response.split(":", 1)
         except ValueError:
             return
-        if rcv == "ACTIVE_USERS":
-            from ast import literal_eval
-            users_list_str = message
-            try:
-                self.__users_list_obj = literal_eval(users_list_str)
-                # FIXME no need to update view when same users
-                self.__chatWindow.userList.clear()
-                self.__chatWindow.userList.addItems(self.__users_list_obj)
-            except Exception as err:
-                self.__chatWindow.userList.addItem("No available users")
-                print(err)
-        elif rcv in self.__users_list_obj:
-            self.__chatWindow.messageDisplay.append(self.__client.current_message)
+        if rcv == "PRESENCE_JOIN":
+            self.__users_list_obj.add(message)
+            self.__chatWindow.add_user(message)
+        elif rcv == "PRESENCE_LEAVE":
+            self.__users_list_obj.discard(message)
+            self.__chatWindow.remove_user(message)
+        elif rcv == "OFFLINE":
+            # Messages received while logged out
+            for _, text in json.loads(message)['messages']:
+                sender, _, text = text.partition(': ')
+                self.__chatWindow.receive_message(sender, text)
+        elif message.startswith(' ') and not rcv.startswith('#'):
+            # "<sender>: <text>", the room posts are "#<room> <sender>: <text>"
+            self.__chatWindow.receive_message(rcv, message[1:])
 
     def show_chat_window(self):
         """
@@ -86,23 +98,24 @@ class ChatApp(QApplication):
         :return:
         """
         self.__loginWindow.hide()
+        self.__chatWindow.open_cache(self.__client.chat_client.username)
         self.__chatWindow.show()
         # Schedule the reception task
         asyncio.run_coroutine_threadsafe(self.__client.rcv_message(), self.loop)
-        # Get the user list before updating
+        # Get the user list, then its changes
         self.__get_online_users()
-        # Connect timeout signal to get_active_users
-        self.timer.timeout.connect(self.__get_online_users)
-        # Set the interval to 3000 milliseconds (3 seconds)
-        self.timer.setInterval(3000)
-        # Start the timer
-        self.timer.start()
 
     def on_about_to_quit(self):
         """
         Graceful application shutdown
         :return:
         """
+        # Logout a user and close the client connection
+        try:
+            self.__client.close()
+        except Exception as e:
+            print(f"[WARNING] Cannot close the connection: {e}")
+        self.__chatWindow.close_cache()
         # Cancel all the current tasks
         self.thread.stop()
         # stop the event loop
@@ -110,9 +123,6 @@ class ChatApp(QApplication):
         # Stop the thread
         self.thread.quit()
         self.thread.wait()
-        # Logout a user and close client socket
-        self.__client_chat.logout()
-        self.__client_chat.close()
 
 
 if __name__ == "__main__":
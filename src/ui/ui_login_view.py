@@ -5,14 +5,14 @@ from PyQt5.QtCore import pyqtSignal
 from PyQt5.QtWidgets import QLineEdit, QPushButton, QVBoxLayout, QLabel
 from PyQt5.QtWidgets import QWidget
 
-from services.client_side import ChatClient
+from services.client_side import ClientChatGui
 from utils.exceptions import ClientAuthenticationError
 
 
 class LoginWindow(QWidget):
     login_successful = pyqtSignal()
 
-    def __init__(self, chat_client: ChatClient):
+    def __init__(self, chat_client: ClientChatGui):
         super().__init__()
         self.errorLabel = None
         self.__client = chat_client
@@ -1,4 +1,5 @@
 import asyncio
+import json
 import os
 import re
 import sys
@@ -6,8 +7,18 @@ from abc import ABC
 
 from PyQt5.QtCore import QThread
 
-from .network_socket import NetworkSocket
+from .connection import ClientConnection, OutboundConfig, SpillFile, DROP, DISCONNECT, SPILL
+from .network_socket import NetworkSocket, FrameBuffer, encode_frame, read_frame
+from .protocol import TextCodec, BinaryCodec, UserIds, encode_correlated, decode_correlated, encode_reply, \
+    decode_reply
 from .redis_manager import RedisServerManager, hash_password
+from .session_cache import SessionCache
+from .rooms import RoomIndex, is_room_name
+from .metrics import MetricsRegistry, MetricsServer
+from .logger import get_logger, setup_logging
+from .credentials import CredentialVerifier, hash_credential, check_credential
+from .timer_wheel import TimerWheel
+from .rate_limit import RateLimiter, RedisRateLimiter
 
 
 class AsyncioThread(QThread):
@@ -24,21 +35,8 @@ class AsyncioThread(QThread):
             task.cancel()
 
 
-async def __async_func(conn_type, **kwargs):
-    loop = asyncio.get_running_loop()
-    data = kwargs.get("data")
-    return await loop.run_in_executor(None, conn_type, data)
-
-
-async def async_send_data(conn, **kwargs):
-    await __async_func(conn.send_data, **kwargs)
-
-
-async def async_receive_data(conn, **kwargs):
-    return await __async_func(conn.receive_data, **kwargs)
-
-
-async def ainput() -> str:
+async def ainput(prompt='') -> str:
+    print(prompt, end='', flush=True)
     return (await asyncio.to_thread(sys.stdin.readline)).rstrip('\n')
 
 
@@ -77,22 +75,180 @@ class Command(ABC):
 
     @staticmethod
     def _socket_sendall(conn, message: str):
-        conn.sendall(message.encode())
+        conn.sendall(encode_frame(message))
 
 
 class MessageCommand(Command):
-    def execute(self, sender: str, receiver: str, conn_clients: dict, msg: str):
+    def execute(self, sender: str, receiver: str, conn_clients: dict, msg: str, route=None):
+        """
+        Deliver a message to a local client, or through route when the receiver is connected to another node
+        :param sender:
+        :param receiver:
+        :param conn_clients: local clients connections
+        :param msg:
+        :param route: callable(receiver, message) returning True when the message was routed
+        :return: True when delivered or routed, False when the receiver was not found
+        """
         conn_receiver = conn_clients.get(receiver)
-        if conn_receiver:
+        # a closing connection is not connected any more, the message is routed or kept for the next login
+        if conn_receiver and not getattr(conn_receiver, 'closed', False):
             self._socket_sendall(conn_receiver, f"{sender}: {msg}")
-        else:
-            self._socket_sendall(conn_clients.get(sender), f"NOT_FOUND: No user found !")
+        elif not (route and route(receiver, f"{sender}: {msg}")):
+            return False
+        return True
 
 
 class ActiveUsersCommand(Command):
+    """
+    Page of the active users, /u [cursor] [prefix] [limit], or their number, /u count
+    The first page is read with the cursor 0, the reply gives the cursor of the next one, 0 after the last page.
+    The prefix may end with *, the prefix * lists every user.
+    """
+    DEFAULT_LIMIT = 100
+    MAX_LIMIT = 500
+
     def execute(self, **kwargs) -> str:
         redis_client = kwargs.get("redis")
-        return f"ACTIVE_USERS:{list(map(lambda x: x.decode(), redis_client.get_active_users()))}"
+        args = kwargs.get("args", "").split()
+        if args == ['count']:
+            return f"ACTIVE_USERS_COUNT:{redis_client.count_active_users()}"
+        if len(args) > 3:
+            return "WRONG_ENTRY:Usage /u [cursor] [prefix] [limit] or /u count"
+        cursor, prefix, limit = args + ['0', '', str(self.DEFAULT_LIMIT)][len(args):]
+        if not (cursor == '0' or cursor.startswith('(')) or not limit.isdigit():
+            return "WRONG_ENTRY:Usage /u [cursor] [prefix] [limit] or /u count"
+        users, cursor = redis_client.scan_active_users(cursor, prefix.rstrip('*'),
+                                                       max(1, min(int(limit), self.MAX_LIMIT)))
+        return "ACTIVE_USERS:" + json.dumps({'users': users, 'cursor': cursor})
+
+
+class RoomCommand(Command):
+    """
+    Command on a chat room, /<command> <room> [text]
+    """
+
+    def execute(self, **kwargs):
+        room, _, text = kwargs.get("args", "").partition(' ')
+        if not is_room_name(room):
+            return "WRONG_ENTRY:Invalid room name."
+        return self._execute(kwargs.get("server_chat_obj"), kwargs.get("username"), room, text.strip())
+
+    def _execute(self, server_chat_obj, username: str, room: str, text: str):
+        raise NotImplementedError
+
+
+class CreateRoomCommand(RoomCommand):
+    def _execute(self, server_chat_obj, username: str, room: str, text: str) -> str:
+        if server_chat_obj.create_room(username, room):
+            return f"ROOM_CREATED:{room}"
+        return f"ROOM_EXISTS:{room}"
+
+
+class JoinRoomCommand(RoomCommand):
+    def _execute(self, server_chat_obj, username: str, room: str, text: str) -> str:
+        if server_chat_obj.join_room(username, room):
+            return f"ROOM_JOINED:{room}"
+        return f"ROOM_NOT_FOUND:{room}"
+
+
+class LeaveRoomCommand(RoomCommand):
+    def _execute(self, server_chat_obj, username: str, room: str, text: str) -> str:
+        server_chat_obj.leave_room(username, room)
+        return f"ROOM_LEFT:{room}"
+
+
+class PostRoomCommand(RoomCommand):
+    def _execute(self, server_chat_obj, username: str, room: str, text: str):
+        if not text:
+            return "WRONG_ENTRY:No message to send."
+        if not server_chat_obj.post_room(username, room, text):
+            return f"ROOM_NOT_JOINED:{room}"
+        # Nothing to answer, the post is delivered to the other members
+        return None
+
+
+class HistoryCommand(Command):
+    """
+    Page of the history of a conversation or of a room, /history <user|#room> [before_id] [limit]
+    A before_id of 0 pages from the latest message.
+    """
+
+    def execute(self, **kwargs) -> str:
+        server_chat_obj, username = kwargs.get("server_chat_obj"), kwargs.get("username")
+        target, *page = kwargs.get("args", "").split() or ('',)
+        try:
+            before_id, limit = (list(map(int, page)) + [0, server_chat_obj.HISTORY_LIMIT])[:2]
+        except ValueError:
+            return "WRONG_ENTRY:Usage /history <user|#room> [before_id] [limit]"
+        if len(page) > 2 or not is_room_name(target.removeprefix('#')):
+            return "WRONG_ENTRY:Usage /history <user|#room> [before_id] [limit]"
+        if target.startswith('#'):
+            messages = server_chat_obj.room_history(username, target[1:], before_id or None, limit)
+            if messages is None:
+                return f"ROOM_NOT_JOINED:{target[1:]}"
+        else:
+            messages = server_chat_obj.conversation_history(username, target, before_id or None, limit)
+        return "HISTORY:" + json.dumps({
+            'target': target,
+            'messages': _history_messages(messages),
+            # before_id of the next page, None once the whole history was sent
+            'before_id': messages[-1][0] if messages else None,
+        })
+
+
+class SinceCommand(Command):
+    """
+    Messages of a conversation or of a room following the last one a client has, oldest first,
+    /since <user|#room> <after_id> [limit]
+    """
+
+    def execute(self, **kwargs) -> str:
+        server_chat_obj, username = kwargs.get("server_chat_obj"), kwargs.get("username")
+        target, *page = kwargs.get("args", "").split() or ('',)
+        if len(page) not in (1, 2) or not is_room_name(target.removeprefix('#')):
+            return "WRONG_ENTRY:Usage /since <user|#room> <after_id> [limit]"
+        try:
+            after_id, limit = (list(map(int, page)) + [server_chat_obj.HISTORY_LIMIT])[:2]
+        except ValueError:
+            return "WRONG_ENTRY:Usage /since <user|#room> <after_id> [limit]"
+        if target.startswith('#'):
+            messages = server_chat_obj.room_history(username, target[1:], limit=limit, after_id=after_id)
+            if messages is None:
+                return f"ROOM_NOT_JOINED:{target[1:]}"
+        else:
+            messages = server_chat_obj.conversation_history(username, target, limit=limit, after_id=after_id)
+        return "SINCE:" + json.dumps({
+            'target': target,
+            'messages': _history_messages(messages),
+            # after_id of the next page, None once the client is up to date
+            'after_id': messages[-1][0] if messages else None,
+        })
+
+
+def _history_messages(messages) -> list:
+    return [[message_id, sender, text, timestamp.isoformat()] for message_id, sender, text, timestamp in messages]
+
+
+class PresenceCommand(Command):
+    """
+    Snapshot of the active users, their changes are pushed afterward as PRESENCE_JOIN and PRESENCE_LEAVE
+    """
+
+    def execute(self, **kwargs) -> str:
+        server_chat_obj = kwargs.get("server_chat_obj")
+        return "PRESENCE:" + json.dumps(server_chat_obj.subscribe_presence(kwargs.get("username")))
+
+
+class StatsCommand(Command):
+    """
+    Server metrics, for the admins only
+    """
+
+    def execute(self, **kwargs) -> str:
+        stats = kwargs.get("server_chat_obj").stats(kwargs.get("username"))
+        if stats is None:
+            return "FORBIDDEN:Admins only."
+        return "STATS:" + json.dumps(stats)
 
 
 class UserLogOut(Command):
@@ -102,10 +258,18 @@ class UserLogOut(Command):
 
 
 class SlashMessage:
-    __COMMANDS = {'/u': ActiveUsersCommand()}
+    __COMMANDS = {'/u': ActiveUsersCommand(),
+                  '/create': CreateRoomCommand(),
+                  '/join': JoinRoomCommand(),
+                  '/leave': LeaveRoomCommand(),
+                  '/post': PostRoomCommand(),
+                  '/history': HistoryCommand(),
+                  '/since': SinceCommand(),
+                  '/presence': PresenceCommand(),
+                  '/stats': StatsCommand()}
 
     def __init__(self, message):
-        self.cmd = message
+        self.cmd, _, self.args = message.partition(' ')
 
     def get_command(self):
         return self.__COMMANDS.get(self.cmd)
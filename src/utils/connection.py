@@ -0,0 +1,201 @@
+"""
+Module to queue the data sent to client connections
+
+A message for a client is queued on its connection and written by a writer of its own, so a slow reader never
+blocks the sender. When the queued bytes go over the high watermark the connection is a slow consumer until they
+go under the low watermark, the outbound policy decides what happens to the data sent meanwhile:
+ - drop: the data is discarded
+ - disconnect: the connection is closed
+ - spill: the data is written to a temporary file and sent, in order, once the queue is drained
+"""
+import socket
+import tempfile
+import threading
+from collections import deque
+
+from .logger import get_logger
+
+log = get_logger('connection')
+
+DROP = 'drop'
+DISCONNECT = 'disconnect'
+SPILL = 'spill'
+
+
+class OutboundConfig:
+    """
+    Watermarks in bytes and slow consumer policy of the connections outbound queues
+    """
+    POLICIES = (DROP, DISCONNECT, SPILL)
+
+    def __init__(self, high_watermark=256 * 1024, low_watermark=64 * 1024, policy=DROP):
+        if policy not in self.POLICIES:
+            raise ValueError(f"Unknown outbound policy {policy}, expected one of {self.POLICIES}")
+        if low_watermark > high_watermark:
+            raise ValueError("The low watermark is above the high watermark")
+        self.high_watermark = high_watermark
+        self.low_watermark = low_watermark
+        self.policy = policy
+
+
+class SpillFile:
+    """
+    Data spilled to a temporary file, read back in the same order
+    """
+
+    def __init__(self):
+        self.__file = None
+        self.__read_offset = 0
+        self.__write_offset = 0
+
+    def __len__(self):
+        return self.__write_offset - self.__read_offset
+
+    def append(self, data: bytes):
+        if self.__file is None:
+            self.__file = tempfile.TemporaryFile()
+        self.__file.seek(self.__write_offset)
+        self.__file.write(data)
+        self.__write_offset += len(data)
+
+    def read(self, size=64 * 1024) -> bytes:
+        self.__file.seek(self.__read_offset)
+        data = self.__file.read(min(size, len(self)))
+        self.__read_offset += len(data)
+        if not len(self):
+            # Everything was sent, reuse the file from the start
+            self.__file.truncate(0)
+            self.__read_offset = self.__write_offset = 0
+        return data
+
+    def close(self):
+        if self.__file is not None:
+            self.__file.close()
+            self.__file = None
+
+
+class ClientConnection:
+    """
+    Accepted client socket of the threaded server. sendall queues the data, a writer thread sends it.
+    """
+    # data joined in one send call
+    WRITE_CHUNK_SIZE = 64 * 1024
+
+    def __init__(self, sock: socket.socket, address, config: OutboundConfig = None):
+        self.sock = sock
+        self.address = address
+        self.__config = config or OutboundConfig()
+        self.__queue = deque()
+        self.__queued = 0
+        # size of the chunk being sent by the writer
+        self.__in_flight = 0
+        self.__spill = SpillFile()
+        self.__slow = False
+        self.__closed = False
+        self.__condition = threading.Condition()
+        self.dropped = 0
+        # user logged in on this connection, its session ends when the connection closes
+        self.username = None
+        self.__writer = threading.Thread(target=self.__write_queue, daemon=True)
+        self.__writer.start()
+
+    def __repr__(self):
+        return f"<ClientConnection {self.address}>"
+
+    @property
+    def depth(self) -> int:
+        """
+        Bytes waiting to be sent
+        """
+        return self.__queued + self.__in_flight + len(self.__spill)
+
+    @property
+    def closed(self) -> bool:
+        """
+        Closed by the server, the data sent is dropped
+        """
+        return self.__closed
+
+    def recv_into(self, buffer) -> int:
+        return self.sock.recv_into(buffer)
+
+    def sendall(self, data: bytes):
+        """
+        Queue data for the writer thread, never blocks on the client socket
+        :param data:
+        :return:
+        """
+        with self.__condition:
+            if self.__closed:
+                return
+            pending = self.__queued + self.__in_flight
+            if pending > self.__config.high_watermark:
+                self.__slow = True
+            elif self.__slow and pending <= self.__config.low_watermark and not len(self.__spill):
+                self.__slow = False
+            if self.__slow:
+                if self.__config.policy == DISCONNECT:
+                    log.warning("disconnecting slow consumer addr=%s", self.address)
+                    self.__close()
+                    return
+                if self.__config.policy == DROP:
+                    self.dropped += 1
+                    return
+                self.__spill.append(data)
+            else:
+                self.__queue.append(data)
+                self.__queued += len(data)
+            self.__condition.notify()
+
+    def close(self):
+        with self.__condition:
+            self.__close()
+        self.sock.close()
+
+    def __close(self):
+        if not self.__closed:
+            self.__closed = True
+            self.__spill.close()
+            self.__condition.notify()
+            try:
+                # Wake up the thread reading the socket
+                self.sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def __next_chunk(self) -> bytes:
+        """
+        Join queued data up to WRITE_CHUNK_SIZE, refilled from the spill file once drained under the low watermark
+        """
+        if self.__slow and self.__queued + self.__in_flight <= self.__config.low_watermark:
+            if len(self.__spill):
+                data = self.__spill.read(self.WRITE_CHUNK_SIZE)
+                self.__queue.append(data)
+                self.__queued += len(data)
+            else:
+                self.__slow = False
+        chunk = []
+        size = 0
+        while self.__queue and size < self.WRITE_CHUNK_SIZE:
+            data = self.__queue.popleft()
+            chunk.append(data)
+            size += len(data)
+        self.__queued -= size
+        return b''.join(chunk)
+
+    def __write_queue(self):
+        while True:
+            with self.__condition:
+                while not self.__closed and not self.__queue and not len(self.__spill):
+                    self.__condition.wait()
+                if self.__closed:
+                    return
+                chunk = self.__next_chunk()
+                self.__in_flight = len(chunk)
+            try:
+                self.sock.sendall(chunk)
+            except OSError:
+                with self.__condition:
+                    self.__close()
+                return
+            self.__in_flight = 0
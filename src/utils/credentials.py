@@ -0,0 +1,126 @@
+"""
+Module to verify the user credentials out of the request loop
+
+The clients send the sha256 of their password, stored salted with bcrypt. A bcrypt check is deliberately slow, it
+runs in a bounded pool of worker processes: a login storm takes the CPU of the workers, not the request loop, and
+logins beyond the pending limit are refused instead of queued without bound. Hashes stored by the previous sha256
+scheme are compared in place, the check costs less than handing it to a worker.
+"""
+import hmac
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import Future, ProcessPoolExecutor
+
+import bcrypt
+
+BCRYPT_PREFIX = '$2'
+
+
+def hash_credential(password_hash: str, rounds=12) -> str:
+    """
+    Salt and hash the password hash sent by the clients, to be stored
+    :param password_hash: sha256 of the password, as sent by the clients
+    :param rounds: bcrypt cost, 0 stores the sha256 as is
+    :return:
+    """
+    if not rounds:
+        return password_hash
+    return bcrypt.hashpw(password_hash.encode(), bcrypt.gensalt(rounds)).decode()
+
+
+def check_credential(password_hash: str, stored_hash: str) -> bool:
+    """
+    Check a password hash sent by a client against the stored one, bcrypt or sha256
+    :param password_hash:
+    :param stored_hash:
+    :return:
+    """
+    if stored_hash.startswith(BCRYPT_PREFIX):
+        return bcrypt.checkpw(password_hash.encode(), stored_hash.encode())
+    return hmac.compare_digest(password_hash, stored_hash)
+
+
+def _check_in_worker(password_hash, stored_hash):
+    # monotonic is the same clock in all the processes, it dates the end of the queue wait
+    started = time.monotonic()
+    return check_credential(password_hash, stored_hash), started
+
+
+class CredentialVerifier:
+    """
+    Verify the credentials in worker processes, at most max_pending checks at once, queued ones included.
+    Without workers, until started or after stopped, the checks run in the calling thread.
+    """
+
+    def __init__(self, workers=None, max_pending=256, queue_seconds=None):
+        """
+        :param workers: worker processes, all the CPUs but one by default, 0 checks in the calling thread
+        :param max_pending: checks submitted and not completed over which verify refuses
+        :param queue_seconds: histogram observing the seconds a check waited for a worker
+        """
+        self.workers = workers if workers is not None else max(1, (os.cpu_count() or 1) - 1)
+        self.max_pending = max_pending
+        self.__queue_seconds = queue_seconds
+        self.__pool = None
+        self.__pending = 0
+        self.__lock = threading.Lock()
+        self.checked = 0
+        self.refused = 0
+
+    @property
+    def pending(self) -> int:
+        return self.__pending
+
+    def start(self):
+        if not self.workers:
+            return
+        # spawn, the server has threads and sockets the workers must not inherit
+        self.__pool = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context('spawn'))
+        # start the workers now, not on the first logins
+        for future in [self.__pool.submit(check_credential, '', '') for _ in range(self.workers)]:
+            future.result()
+
+    def stop(self):
+        pool, self.__pool = self.__pool, None
+        if pool:
+            pool.shutdown(wait=True, cancel_futures=True)
+
+    def verify(self, password_hash: str, stored_hash: str):
+        """
+        Check a password hash against the stored one
+        :param password_hash:
+        :param stored_hash:
+        :return: future of the check result, None when max_pending checks are pending
+        """
+        result = Future()
+        if self.__pool is None or not stored_hash.startswith(BCRYPT_PREFIX):
+            self.checked += 1
+            result.set_result(check_credential(password_hash, stored_hash))
+            return result
+        with self.__lock:
+            if self.__pending >= self.max_pending:
+                self.refused += 1
+                return None
+            self.__pending += 1
+        submitted = time.monotonic()
+        self.__pool.submit(_check_in_worker, password_hash, stored_hash).add_done_callback(
+            lambda future: self.__completed(future, submitted, result))
+        return result
+
+    def __completed(self, future, submitted, result):
+        with self.__lock:
+            self.__pending -= 1
+            self.checked += 1
+        if future.cancelled():
+            result.cancel()
+            return
+        error = future.exception()
+        if error is not None:
+            result.set_exception(error)
+            return
+        valid, started = future.result()
+        if self.__queue_seconds is not None:
+            self.__queue_seconds.observe(started - submitted)
+        result.set_result(valid)
@@ -1,12 +1,23 @@
+from .logger import get_logger
+
+log = get_logger('client')
+
+
 class ClientAuthenticationError(Exception):
 
     def __init__(self, message=None):
         super().__init__()
         self.message = message if message else "Auth Failed"
-        print(f"[WARNING] {self.message}")
+        log.warning("authentication error message=%s", self.message)
 
 
 class RedisConnectionError(Exception):
     def __init__(self, message=None):
         super().__init__()
         self.message = message
+
+
+class MessageFrameError(Exception):
+    def __init__(self, message=None):
+        super().__init__(message)
+        self.message = message
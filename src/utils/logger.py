@@ -0,0 +1,66 @@
+"""
+Module of the structured logger: the callers put the records on a queue, a background thread formats and writes
+them, so a slow terminal never blocks a request.
+
+Messages are key=value pairs with %-style arguments, formatted only when the record is written: a call under the
+enabled level costs a level check. Work done only to be logged is guarded with isEnabledFor.
+"""
+import atexit
+import logging
+import os
+import queue
+import sys
+from logging.handlers import QueueHandler, QueueListener
+
+# parent of the package loggers
+ROOT_LOGGER = 'chat'
+# level when not given to setup_logging, overridden by the CHAT_LOG_LEVEL environment variable
+DEFAULT_LEVEL = 'INFO'
+LOG_FORMAT = '%(asctime)s level=%(levelname)s logger=%(name)s %(message)s'
+
+
+class _QueueHandler(QueueHandler):
+    """
+    Enqueue the records as they are, their message is formatted by the listener thread
+    """
+
+    def __init__(self, records, listener: QueueListener):
+        super().__init__(records)
+        self.listener = listener
+
+    def prepare(self, record):
+        return record
+
+
+def get_logger(name: str) -> logging.Logger:
+    """
+    Logger of a module, "chat.<name>"
+    :param name:
+    :return:
+    """
+    return logging.getLogger(f"{ROOT_LOGGER}.{name}")
+
+
+def setup_logging(level: str = None, stream=None) -> QueueListener:
+    """
+    Write the records of the package loggers from a background thread, the listener is started once by process
+    :param level: level name, CHAT_LOG_LEVEL or DEFAULT_LEVEL when not given
+    :param stream: stderr when not given
+    :return: the listener, stopped at exit after writing the queued records
+    """
+    root = logging.getLogger(ROOT_LOGGER)
+    root.setLevel((level or os.environ.get('CHAT_LOG_LEVEL', DEFAULT_LEVEL)).upper())
+    for handler in root.handlers:
+        # the module may be imported as utils.logger and src.utils.logger, the handler class is not shared
+        if isinstance(handler, QueueHandler) and hasattr(handler, 'listener'):
+            return handler.listener
+
+    records = queue.SimpleQueue()
+    writer = logging.StreamHandler(stream or sys.stderr)
+    writer.setFormatter(logging.Formatter(LOG_FORMAT))
+    listener = QueueListener(records, writer)
+    listener.start()
+    atexit.register(listener.stop)
+    root.addHandler(_QueueHandler(records, listener))
+    root.propagate = False
+    return listener
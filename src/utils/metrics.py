@@ -0,0 +1,311 @@
+"""
+Module to collect the server metrics and expose them in the Prometheus text format
+"""
+import bisect
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable
+
+# upper bounds in seconds of the latency histograms buckets
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+
+def _format_labels(labels: dict) -> str:
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{value}"' for name, value in labels.items()) + '}'
+
+
+class _Metric:
+    """
+    Metric family, with one child by label values
+    """
+    type_name = None
+
+    def __init__(self, name: str, documentation: str, label_names: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self.__children = {}
+        self.__lock = threading.Lock()
+
+    def labels(self, *values: str):
+        child = self.__children.get(values)
+        if child is None:
+            with self.__lock:
+                child = self.__children.setdefault(values, self._new_child())
+        return child
+
+    def children(self):
+        if not self.label_names:
+            return [({}, self.labels())]
+        return [(dict(zip(self.label_names, values)), child) for values, child in sorted(self.__children.items())]
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type_name}"]
+        for labels, child in self.children():
+            lines.extend(child.render(self.name, labels))
+        return lines
+
+
+class _CounterChild:
+    def __init__(self):
+        self.value = 0
+        self.__lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self.__lock:
+            self.value += amount
+
+    def render(self, name, labels):
+        return [f"{name}{_format_labels(labels)} {self.value}"]
+
+
+class Counter(_Metric):
+    """
+    Counter incremented by inc, or read from a function when scraped, a count kept by another object
+    """
+    type_name = 'counter'
+
+    def __init__(self, name: str, documentation: str, label_names: tuple = (), function: Callable[[], float] = None):
+        super().__init__(name, documentation, label_names)
+        self.__function = function
+
+    def _new_child(self):
+        return _CounterChild()
+
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+    @property
+    def value(self):
+        return self.__function() if self.__function else self.labels().value
+
+    def render(self) -> list:
+        if self.__function is None:
+            return super().render()
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type_name}",
+                f"{self.name} {self.value}"]
+
+
+class _GaugeChild(_CounterChild):
+    def dec(self, amount=1):
+        self.inc(-amount)
+
+
+class Gauge(_Metric):
+    """
+    Gauge set by inc and dec, or read from a function when scraped
+    """
+    type_name = 'gauge'
+
+    def __init__(self, name: str, documentation: str, function: Callable[[], float] = None):
+        super().__init__(name, documentation)
+        self.__function = function
+
+    def _new_child(self):
+        return _GaugeChild()
+
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+    def dec(self, amount=1):
+        self.labels().dec(amount)
+
+    @property
+    def value(self):
+        return self.__function() if self.__function else self.labels().value
+
+    def render(self) -> list:
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type_name}",
+                f"{self.name} {self.value}"]
+
+
+class _HistogramChild:
+    """
+    Observations are appended to a pending list, without lock nor bucket search on the request path, and counted
+    in the buckets by batches: once FOLD_SIZE of them are pending, and when the histogram is read. Appending to a
+    list and deleting its head are atomic, a batch never loses the observations appended meanwhile.
+    An observation of a sampled histogram stands for sample of them.
+    """
+    FOLD_SIZE = 1024
+
+    def __init__(self, buckets, sample=1):
+        self.buckets = buckets
+        self.__sample = sample
+        # observations by bucket, the last one is +Inf
+        self.__counts = [0] * (len(buckets) + 1)
+        self.__sum = 0.0
+        self.__count = 0
+        self.__pending = []
+        self.__lock = threading.Lock()
+
+    def observe(self, value: float):
+        self.__pending.append(value)
+        if len(self.__pending) >= self.FOLD_SIZE:
+            self.__fold()
+
+    def __fold(self):
+        with self.__lock:
+            pending = self.__pending
+            values = pending[:len(pending)]
+            del pending[:len(values)]
+            values.sort()
+            start = 0
+            for index, bound in enumerate(self.buckets):
+                end = bisect.bisect_right(values, bound, start)
+                self.__counts[index] += (end - start) * self.__sample
+                start = end
+            self.__counts[-1] += (len(values) - start) * self.__sample
+            self.__sum += sum(values) * self.__sample
+            self.__count += len(values) * self.__sample
+
+    @property
+    def counts(self) -> list:
+        self.__fold()
+        return list(self.__counts)
+
+    @property
+    def sum(self) -> float:
+        self.__fold()
+        return self.__sum
+
+    @property
+    def count(self) -> int:
+        self.__fold()
+        return self.__count
+
+    def quantile(self, q: float) -> float:
+        """
+        Upper bound of the bucket holding the quantile q
+        """
+        counts = self.counts
+        rank = q * sum(counts)
+        cumulative = 0
+        for bound, count in zip(self.buckets, counts):
+            cumulative += count
+            if cumulative >= rank:
+                return bound
+        return float('inf')
+
+    def render(self, name, labels):
+        self.__fold()
+        with self.__lock:
+            counts, total = list(self.__counts), self.__sum
+        lines = []
+        cumulative = 0
+        for bound, count in zip((*self.buckets, '+Inf'), counts):
+            cumulative += count
+            lines.append(f"{name}_bucket{_format_labels({**labels, 'le': bound})} {cumulative}")
+        lines.append(f"{name}_sum{_format_labels(labels)} {total}")
+        lines.append(f"{name}_count{_format_labels(labels)} {cumulative}")
+        return lines
+
+
+class Histogram(_Metric):
+    """
+    Histogram of observations, or of one out of sample of them: its count and sum still estimate all of them
+    """
+    type_name = 'histogram'
+
+    def __init__(self, name: str, documentation: str, label_names: tuple = (), buckets=LATENCY_BUCKETS, sample=1):
+        super().__init__(name, documentation, label_names)
+        self.buckets = tuple(buckets)
+        self.sample = sample
+
+    def _new_child(self):
+        return _HistogramChild(self.buckets, self.sample)
+
+    def observe(self, value: float):
+        self.labels().observe(value)
+
+
+class MetricsRegistry:
+    """
+    Metrics of a server, rendered together in the Prometheus text format
+    """
+
+    def __init__(self, prefix='chat_'):
+        self.__prefix = prefix
+        self.__metrics = []
+
+    def counter(self, name: str, documentation: str, label_names: tuple = (),
+                function: Callable[[], float] = None) -> Counter:
+        return self.__register(Counter(self.__prefix + name, documentation, label_names, function))
+
+    def gauge(self, name: str, documentation: str, function: Callable[[], float] = None) -> Gauge:
+        return self.__register(Gauge(self.__prefix + name, documentation, function))
+
+    def histogram(self, name: str, documentation: str, label_names: tuple = (),
+                  buckets=LATENCY_BUCKETS, sample=1) -> Histogram:
+        return self.__register(Histogram(self.__prefix + name, documentation, label_names, buckets, sample))
+
+    def __register(self, metric):
+        self.__metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.__metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+    def snapshot(self) -> dict:
+        """
+        Values of the metrics, the histograms summarized by count, mean and p50/p99 bucket bounds
+        """
+        values = {}
+        for metric in self.__metrics:
+            name = metric.name[len(self.__prefix):]
+            if isinstance(metric, Gauge) or (isinstance(metric, Counter) and not metric.label_names):
+                values[name] = metric.value
+                continue
+            for labels, child in metric.children():
+                key = f"{name}{_format_labels(labels)}"
+                if isinstance(child, _HistogramChild):
+                    values[key] = {'count': child.count, 'mean': child.sum / child.count if child.count else 0.0,
+                                   'p50': child.quantile(0.5), 'p99': child.quantile(0.99)}
+                else:
+                    values[key] = child.value
+        return values
+
+
+class MetricsServer:
+    """
+    HTTP server answering GET /metrics with the metrics of a registry, from a background thread
+    """
+
+    def __init__(self, registry: MetricsRegistry, host='localhost', port=9100):
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != '/metrics':
+                    self.send_error(404)
+                    return
+                body = registry.render().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.__server = ThreadingHTTPServer((host, port), Handler)
+        self.__server.daemon_threads = True
+        self.__thread = None
+
+    @property
+    def port(self):
+        return self.__server.server_address[1]
+
+    def start(self):
+        self.__thread = threading.Thread(target=self.__server.serve_forever, daemon=True)
+        self.__thread.start()
+
+    def stop(self):
+        self.__server.shutdown()
+        self.__server.server_close()
@@ -1,7 +1,139 @@
 """
 Module to init socket
+
+Messages are framed on the wire with a 4 bytes big-endian length header, so a message is never merged with
+or cut by the next one whatever the TCP segmentation is.
 """
 import socket
+import struct
+
+from .exceptions import MessageFrameError
+
+FRAME_HEADER = struct.Struct('!I')
+MAX_MESSAGE_SIZE = 1024 * 1024
+
+
+def encode_frame(data) -> bytes:
+    """
+    Prefix a message with its length header
+    :param data: str or bytes message
+    :return:
+    """
+    payload = data.encode() if isinstance(data, str) else data
+    return FRAME_HEADER.pack(len(payload)) + payload
+
+
+async def read_frame(reader) -> bytes:
+    """
+    Read the next message from an asyncio stream
+    :param reader: asyncio.StreamReader
+    :return: message bytes
+    """
+    size, = FRAME_HEADER.unpack(await reader.readexactly(FRAME_HEADER.size))
+    if size > MAX_MESSAGE_SIZE:
+        raise MessageFrameError(f"Message of {size} bytes exceeds {MAX_MESSAGE_SIZE} bytes")
+    return await reader.readexactly(size)
+
+
+class FrameBuffer:
+    """
+    Reusable receive buffer splitting a byte stream into length-prefixed messages.
+
+    Data is received straight into the buffer (recv_into or asyncio.BufferedProtocol), many messages can be
+    extracted from one read and a partial message is kept until the rest arrives.
+
+    The buffer is allocated on the first read with size bytes, an idle connection holds none. It doubles when full,
+    as the bytes of a large message arrive rather than when its header is read, and goes back to size bytes once
+    the large message is consumed.
+    """
+
+    def __init__(self, size=4 * 1024, max_message_size=MAX_MESSAGE_SIZE):
+        self.__size = size
+        self.__buffer = bytearray()
+        self.__view = memoryview(self.__buffer)
+        self.__max_message_size = max_message_size
+        # unread data is self.__buffer[self.__start:self.__end]
+        self.__start = 0
+        self.__end = 0
+
+    def __len__(self):
+        """
+        Bytes allocated
+        """
+        return len(self.__buffer)
+
+    def get_buffer(self, size_hint=-1) -> memoryview:
+        """
+        Writable memory right after the received data, the buffer is compacted, grown or shrunk when needed
+        :param size_hint: minimum wanted size, -1 for any
+        :return:
+        """
+        pending = self.__end - self.__start
+        if pending == 0:
+            self.__start = self.__end = 0
+        # a read of a few bytes at the end of the buffer is not worth a recv call
+        wanted = max(size_hint, self.__size // 4)
+        if len(self.__buffer) > self.__size and pending + wanted <= self.__size:
+            self.__resize(self.__size, pending)
+        elif len(self.__buffer) - self.__end < wanted:
+            if len(self.__buffer) - pending >= wanted:
+                self.__view[:pending] = self.__view[self.__start:self.__end]
+                self.__start, self.__end = 0, pending
+            else:
+                self.__resize(max(self.__size, 2 * len(self.__buffer), pending + wanted), pending)
+        return self.__view[self.__end:]
+
+    def __resize(self, capacity, pending):
+        buffer = bytearray(capacity)
+        buffer[:pending] = self.__view[self.__start:self.__end]
+        self.__buffer = buffer
+        self.__view = memoryview(buffer)
+        self.__start, self.__end = 0, pending
+
+    def buffer_updated(self, nbytes: int):
+        """
+        Mark nbytes written in the memory returned by get_buffer as received
+        :param nbytes:
+        :return:
+        """
+        self.__end += nbytes
+
+    def recv_from(self, conn) -> int:
+        """
+        Receive available data from a socket into the buffer
+        :param conn:
+        :return: number of bytes received, 0 when the connection is closed
+        """
+        nbytes = conn.recv_into(self.get_buffer())
+        self.buffer_updated(nbytes)
+        return nbytes
+
+    def next_message(self):
+        """
+        Pop the next complete message
+        :return: message bytes, None when not completely received yet
+        """
+        pending = self.__end - self.__start
+        if pending < FRAME_HEADER.size:
+            return None
+        size, = FRAME_HEADER.unpack_from(self.__buffer, self.__start)
+        if size > self.__max_message_size:
+            raise MessageFrameError(f"Message of {size} bytes exceeds {self.__max_message_size} bytes")
+        if pending < FRAME_HEADER.size + size:
+            return None
+        begin = self.__start + FRAME_HEADER.size
+        self.__start = begin + size
+        return bytes(self.__view[begin:self.__start])
+
+    def messages(self):
+        """
+        Yield all the complete messages received
+        :return:
+        """
+        message = self.next_message()
+        while message is not None:
+            yield message
+            message = self.next_message()
 
 
 class NetworkSocket:
@@ -9,13 +141,23 @@ class NetworkSocket:
         self.host = host
         self.port = port
         self._socket = socket.socket(socket.AF_INET, socket_type)
+        # receive buffers by connection, self._socket included
+        self.__frames = {}
+
+    @property
+    def sock(self):
+        return self._socket
 
-    def bind_and_listen(self):
+    def bind_and_listen(self, reuse_port=False):
+        # Allow restarting the server while previous connections are in TIME_WAIT
+        self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if reuse_port:
+            # Processes listening on the same port, the kernel spreads the new connections between them
+            self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         self._socket.bind((self.host, self.port))
         self._socket.listen()
 
     def accept_connection(self):
-        print("[INFO] Waiting for connection ... ")
         connection, address = self._socket.accept()
         return connection, address
 
@@ -24,18 +166,44 @@ class NetworkSocket:
 
     def send_data(self, data, conn=None):
         if conn:
-            conn.sendall(data.encode())
+            conn.sendall(encode_frame(data))
         else:
-            self._socket.sendall(data.encode())
+            self._socket.sendall(encode_frame(data))
 
-    def receive_data(self, conn=None, buffer_size=1024):
-        if conn:
-            return conn.recv(buffer_size).decode()
-        else:
-            return self._socket.recv(buffer_size).decode()
+    def receive_data(self, conn=None):
+        """
+        Receive one whole message
+        :param conn: connection to read from, own socket if None
+        :return: the message, empty string when the connection is closed
+        """
+        conn = conn or self._socket
+        frames = self.__frames.setdefault(conn, FrameBuffer())
+        message = frames.next_message()
+        while message is None:
+            if not frames.recv_from(conn):
+                return ''
+            message = frames.next_message()
+        return message.decode()
+
+    def receive_messages(self, conn=None, raw=False):
+        """
+        Yield the messages received on a connection until it is closed, one recv call may yield many messages
+        :param conn: connection to read from, own socket if None
+        :param raw: yield bytes instead of decoded strings
+        :return:
+        """
+        conn = conn or self._socket
+        frames = self.__frames.setdefault(conn, FrameBuffer())
+        while True:
+            for message in frames.messages():
+                yield message if raw else message.decode()
+            if not frames.recv_from(conn):
+                return
 
     def close(self, conn=None):
         if conn:
+            self.__frames.pop(conn, None)
             conn.close()
         else:
+            self.__frames.pop(self._socket, None)
             self._socket.close()
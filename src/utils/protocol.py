@@ -0,0 +1,184 @@
+"""
+Module to encode and decode client requests
+
+Both codecs decode a request into the same list, [command, *args], so the server request handlers do not depend
+on the wire format:
+ - TextCodec, the historical colon-joined UTF-8 format, e.g. MESSAGE:user:token:@bob hi
+ - BinaryCodec, an opcode byte followed by a struct packed header (interned user id, raw session token) and the
+   UTF-8 payload
+
+A client asks for the binary codec by sending a HELLO:binary text request right after connecting, the server
+answers HELLO:binary when it accepts it, the text codec stays the fallback. Binary requests start with an opcode
+lower than 0x20, a byte text requests never start with, so the server decodes each frame without any
+per-connection state.
+
+A request of either codec may be put in a REQUEST:<correlation id>:<request> envelope, the server then sends its
+reply as REPLY:<correlation id>:<reply>, so a client can have many requests in flight and match their replies, in
+any order, apart from the messages pushed to it. A correlated request with nothing to answer gets REPLY:<id>:OK,
+one with a correlation id that is not a number gets WRONG_ENTRY without envelope.
+"""
+import struct
+import threading
+
+REQUEST_PREFIX = b'REQUEST:'
+REPLY_PREFIX = 'REPLY:'
+
+OP_LOGIN = 0x01
+OP_MESSAGE = 0x02
+OP_LOGOUT = 0x03
+
+# opcode, password sha256 digest + username
+LOGIN_HEADER = struct.Struct('!B32s')
+# opcode, user id, session token + message
+SESSION_HEADER = struct.Struct('!BI16s')
+
+
+def encode_correlated(correlation_id: int, request: bytes) -> bytes:
+    return b'%s%d:%s' % (REQUEST_PREFIX, correlation_id, request)
+
+
+def decode_correlated(data: bytes):
+    """
+    Take a request out of its envelope, ValueError is raised when its correlation id is not a number
+    :param data:
+    :return: correlation id, None for a request without envelope, and the request
+    """
+    if not data.startswith(REQUEST_PREFIX):
+        return None, data
+    correlation_id, _, request = data[len(REQUEST_PREFIX):].partition(b':')
+    if not correlation_id.isdigit():
+        raise ValueError(f"Malformed correlation id {correlation_id[:32]!r}")
+    return int(correlation_id), request
+
+
+def encode_reply(correlation_id: int, reply: str) -> str:
+    return f"{REPLY_PREFIX}{correlation_id}:{reply}"
+
+
+def decode_reply(message: str):
+    """
+    Take a reply out of its envelope
+    :param message:
+    :return: correlation id, None for a pushed message, and the reply
+    """
+    if not message.startswith(REPLY_PREFIX):
+        return None, message
+    correlation_id, _, reply = message[len(REPLY_PREFIX):].partition(':')
+    if not correlation_id.isdigit():
+        # a direct message from a user named REPLY
+        return None, message
+    return int(correlation_id), reply
+
+
+class UserIds:
+    """
+    Intern table giving each username a small integer id, sent instead of the username by the binary codec
+    """
+
+    def __init__(self):
+        self.__ids = {}
+        self.__usernames = {}
+        self.__lock = threading.Lock()
+
+    def intern(self, username: str) -> int:
+        """
+        Get the id of a username, a new one is assigned the first time
+        :param username:
+        :return:
+        """
+        uid = self.__ids.get(username)
+        if uid is None:
+            with self.__lock:
+                uid = self.__ids.setdefault(username, len(self.__ids) + 1)
+                self.__usernames[uid] = username
+        return uid
+
+    def register(self, username: str, uid: int):
+        """
+        Record an id assigned by the server
+        :param username:
+        :param uid:
+        :return:
+        """
+        self.__ids[username] = uid
+        self.__usernames[uid] = username
+
+    def get_id(self, username: str) -> int:
+        return self.__ids.get(username, 0)
+
+    def get_username(self, uid: int) -> str:
+        return self.__usernames.get(uid, '')
+
+
+class TextCodec:
+    name = 'text'
+    # number of arguments by command, the last one may contain ':'
+    ARGS_COUNT = {'LOGIN': 2, 'MESSAGE': 3, 'LOGOUT': 2, 'HELLO': 1}
+
+    def __init__(self, user_ids: UserIds = None):
+        self.user_ids = user_ids or UserIds()
+
+    def encode_request(self, command: str, *args: str) -> bytes:
+        return ':'.join((command, *args)).encode()
+
+    def decode_request(self, data: bytes) -> list:
+        command, separator, args = data.decode().partition(':')
+        if not separator:
+            return [command]
+        args_count = self.ARGS_COUNT.get(command)
+        return [command, *args.split(':', args_count - 1 if args_count else -1)]
+
+
+class BinaryCodec(TextCodec):
+    name = 'binary'
+    OPCODES = {'LOGIN': OP_LOGIN, 'MESSAGE': OP_MESSAGE, 'LOGOUT': OP_LOGOUT}
+    MAX_CACHED_HEADERS = 1024
+
+    def __init__(self, user_ids: UserIds = None):
+        super().__init__(user_ids)
+        # packed session headers, a client sends the same one for a whole session
+        self.__headers = {}
+
+    @staticmethod
+    def is_binary(data) -> bool:
+        return bool(data) and data[0] < 0x20
+
+    def encode_request(self, command: str, *args: str) -> bytes:
+        opcode = self.OPCODES.get(command)
+        if opcode == OP_LOGIN:
+            username, password_hash = args
+            return LOGIN_HEADER.pack(opcode, bytes.fromhex(password_hash)) + username.encode()
+        if opcode is None:
+            # Commands without opcode are sent as text
+            return super().encode_request(command, *args)
+        username, session_token, *message = args
+        header = self.__headers.get((opcode, username, session_token))
+        if header is None:
+            if len(self.__headers) >= self.MAX_CACHED_HEADERS:
+                self.__headers.clear()
+            header = SESSION_HEADER.pack(opcode, self.user_ids.get_id(username), bytes.fromhex(session_token))
+            self.__headers[(opcode, username, session_token)] = header
+        return header + message[0].encode() if message else header
+
+    def decode_request(self, data: bytes) -> list:
+        """
+        Decode a binary or text request, ValueError is raised when it is truncated or its text is not UTF-8
+        :param data:
+        :return:
+        """
+        opcode = data[0] if data else 0x20
+        if opcode >= 0x20:
+            return super().decode_request(data)
+        header = LOGIN_HEADER if opcode == OP_LOGIN else SESSION_HEADER
+        if len(data) < header.size:
+            raise ValueError(f"Truncated request of {len(data)} bytes, opcode {opcode}")
+        if opcode == OP_LOGIN:
+            _, password_hash = LOGIN_HEADER.unpack_from(data)
+            return ['LOGIN', data[LOGIN_HEADER.size:].decode(), password_hash.hex()]
+        _, uid, session_token = SESSION_HEADER.unpack_from(data)
+        username = self.user_ids.get_username(uid)
+        if opcode == OP_MESSAGE:
+            return ['MESSAGE', username, session_token.hex(), data[SESSION_HEADER.size:].decode()]
+        if opcode == OP_LOGOUT:
+            return ['LOGOUT', username, session_token.hex()]
+        return [f'OPCODE_{opcode}']
@@ -0,0 +1,86 @@
+"""
+Module to rate limit the requests with token buckets
+
+A bucket holds up to burst tokens and refills at rate tokens per second, a request takes one token or waits for
+it. The buckets are kept by key (a user or a connection) and by request type, in process or in Redis to share the
+limits between the nodes.
+"""
+import threading
+import time
+from typing import Hashable
+
+
+class RateLimiter:
+    """
+    Token buckets in process, a few floats by key and request type: forget a key when it leaves
+    """
+
+    def __init__(self, limits: dict, clock=time.monotonic):
+        """
+        :param limits: (rate per second, burst) by request type, the types missing are not limited
+        :param clock:
+        """
+        self.limits = dict(limits)
+        self.__clock = clock
+        # [tokens, last refill] by request type, by key
+        self.__buckets = {}
+        self.__lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.__buckets)
+
+    def acquire(self, key: Hashable, kind: str) -> float:
+        """
+        Take a token from the bucket of a key for a request type
+        :param key:
+        :param kind: request type
+        :return: 0 when taken, the seconds to wait for the next token otherwise
+        """
+        limit = self.limits.get(kind)
+        if limit is None:
+            return 0.0
+        rate, burst = limit
+        now = self.__clock()
+        with self.__lock:
+            buckets = self.__buckets.get(key)
+            if buckets is None:
+                buckets = self.__buckets[key] = {}
+            bucket = buckets.get(kind)
+            if bucket is None:
+                buckets[kind] = [burst - 1, now]
+                return 0.0
+            tokens = min(burst, bucket[0] + (now - bucket[1]) * rate)
+            bucket[1] = now
+            if tokens >= 1:
+                bucket[0] = tokens - 1
+                return 0.0
+            bucket[0] = tokens
+            return (1 - tokens) / rate
+
+    def forget(self, key: Hashable):
+        with self.__lock:
+            self.__buckets.pop(key, None)
+
+
+class RedisRateLimiter(RateLimiter):
+    """
+    Token buckets in Redis, taken by an atomic script: the limits apply to a user whatever the node serving it, for
+    one round-trip by request. The idle buckets expire by themselves.
+    """
+
+    def __init__(self, redis_manager, limits: dict):
+        """
+        :param redis_manager: RedisServerManager
+        :param limits: (rate per second, burst) by request type, the types missing are not limited
+        """
+        super().__init__(limits)
+        self.__redis = redis_manager
+
+    def acquire(self, key: Hashable, kind: str) -> float:
+        limit = self.limits.get(kind)
+        if limit is None:
+            return 0.0
+        return self.__redis.take_token(f"rate_limit:{kind}:{key}", *limit)
+
+    def forget(self, key: Hashable):
+        pass
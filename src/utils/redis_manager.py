@@ -1,9 +1,14 @@
 import hashlib
 import json
+import time
 
 import redis
 
+from utils.credentials import hash_credential, check_credential
 from utils.exceptions import RedisConnectionError
+from utils.logger import get_logger
+
+log = get_logger('redis')
 
 
 def hash_password(password):
@@ -16,9 +21,25 @@ def hash_password(password):
     return hashlib.sha256(password.encode()).hexdigest()
 
 
+# connection pools shared by all the managers of the process, by (host, port, db)
+_connection_pools = {}
+
+
+def get_connection_pool(host='localhost', port=6379, db=0, max_connections=64, timeout=5):
+    """
+    Get the connection pool shared by all the managers connected to a Redis database.
+    When all its connections are in use, callers wait up to timeout seconds for one to be released.
+    """
+    pool = _connection_pools.get((host, port, db))
+    if pool is None:
+        pool = _connection_pools.setdefault((host, port, db), redis.BlockingConnectionPool(
+            host=host, port=port, db=db, max_connections=max_connections, timeout=timeout))
+    return pool
+
+
 class RedisManager:
     def __init__(self, host='localhost', port=6379, db=0):
-        self.__redis_client = redis.Redis(host=host, port=port, db=db)
+        self._redis_client = redis.Redis(connection_pool=get_connection_pool(host, port, db))
         # check redis connection
         self.check_connection()
 
@@ -27,10 +48,10 @@ class RedisManager:
         Check if a connection can be established to Redis.
         """
         try:
-            self.__redis_client.ping()
-            print("Successfully connected to Redis.")
+            self._redis_client.ping()
+            log.debug("connected to Redis")
         except (redis.exceptions.ConnectionError, redis.exceptions.BusyLoadingError) as e:
-            print(f"Failed to connect to Redis: {e}")
+            log.error("cannot connect to Redis reason=%s", e)
             raise RedisConnectionError()
 
     def set_data(self, key, data, expiry=None):
@@ -39,43 +60,265 @@ class RedisManager:
         Data is stored in JSON format.
         """
         json_data = json.dumps(data)
-        self.__redis_client.set(key, json_data, ex=expiry)
+        self._redis_client.set(key, json_data, ex=expiry)
 
     def get_data(self, key):
         """
         Retrieve data from Redis. Data is returned in Python dictionary format.
         """
-        data = self.__redis_client.get(key)
+        data = self._redis_client.get(key)
         return json.loads(json.loads(data)) if data else None
 
+    def get_data_ttl(self, key):
+        """
+        Retrieve data from Redis with its remaining time to live in seconds, in one round-trip.
+        The time to live is negative when the key has no expiry.
+        """
+        pipeline = self._redis_client.pipeline(transaction=False)
+        pipeline.get(key)
+        pipeline.ttl(key)
+        data, ttl = pipeline.execute()
+        return (json.loads(json.loads(data)) if data else None), ttl
+
     def delete_data(self, key):
         """
         Delete data associated with a key in Redis.
         """
-        self.__redis_client.delete(key)
+        self._redis_client.delete(key)
 
     def update_expiry(self, key, expiry):
         """
         Update the expiry time of a key in Redis.
         """
-        self.__redis_client.expire(key, expiry)
+        self._redis_client.expire(key, expiry)
+
+    def update_expiries(self, keys, expiry) -> list:
+        """
+        Update the expiry time of keys in Redis, in one round-trip
+        :param keys:
+        :param expiry: seconds
+        :return: the keys updated, the ones gone are left out
+        """
+        pipeline = self._redis_client.pipeline(transaction=False)
+        for key in keys:
+            pipeline.expire(key, expiry)
+        return [key for key, updated in zip(keys, pipeline.execute()) if updated]
+
+    def round_trip_time(self) -> float:
+        """
+        Seconds of a PING round-trip
+        """
+        start = time.perf_counter()
+        self._redis_client.ping()
+        return time.perf_counter() - start
+
+    def publish(self, channel, message):
+        """
+        Publish a message on a pub/sub channel
+        """
+        self._redis_client.publish(channel, message)
+
+    def subscribe(self, handlers):
+        """
+        Call the handler of a channel with each message published on it, from one background thread.
+        handlers maps channel names to handlers. Return the thread, stop it to unsubscribe.
+        """
+        pubsub = self._redis_client.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(**{channel: self.__message_handler(handler) for channel, handler in handlers.items()})
+        return pubsub.run_in_thread(sleep_time=1, daemon=True)
+
+    @staticmethod
+    def __message_handler(handler):
+        return lambda message: handler(message['data'].decode())
 
     def get_all_keys(self):
-        print(self.__redis_client.keys('*'))
+        print(self._redis_client.keys('*'))
 
 
 class RedisServerManager(RedisManager):
+    # hash of the node holding the connection of each user
+    USER_NODES = "user_nodes"
+    # pub/sub channel prefix of the messages routed to a node
+    NODE_CHANNEL_PREFIX = "node:"
+    # list of the messages kept for an offline user, "<sequence>:<message>" entries oldest first. The user hash
+    # holds the last sequence given, offline_sequence, and the last one delivered, offline_cursor
+    OFFLINE_PREFIX = "offline:"
+    # route_message results
+    ROUTED, STORED = 1, 2
+
+    # set of the chat rooms
+    ROOMS = "chatrooms"
+
+    # active users in a sorted set of equal scores, ordered by name for the paginated listing
+    ACTIVE_USERS_INDEX = "active_users_index"
+
+    # bcrypt cost of the stored password hashes, 0 stores the sha256 sent by the clients as is
+    BCRYPT_ROUNDS = 12
+
+    # Authenticate a user, add it to active users, store its session data and its node, return its rooms
+    # KEYS: user hash, active users set, session key, user nodes hash, user rooms set, active users index
+    # ARGV: username, password hash, session data, session expiry, node id, presence channel[, channel, message to
+    #       publish]
+    START_SESSION_SCRIPT = """
+    if redis.call('HGET', KEYS[1], 'password_hash') ~= ARGV[2] then
+        return {0, {}}
+    end
+    redis.call('ZADD', KEYS[6], 0, ARGV[1])
+    if redis.call('SADD', KEYS[2], ARGV[1]) == 1 and ARGV[6] ~= '' then
+        redis.call('PUBLISH', ARGV[6], '+' .. ARGV[1])
+    end
+    if ARGV[3] ~= '' then
+        redis.call('SET', KEYS[3], ARGV[3], 'EX', ARGV[4])
+    end
+    if ARGV[5] ~= '' then
+        redis.call('HSET', KEYS[4], ARGV[1], ARGV[5])
+    end
+    if ARGV[7] then
+        redis.call('PUBLISH', ARGV[7], ARGV[8])
+    end
+    return {1, redis.call('SMEMBERS', KEYS[5])}
+    """
+
+    # Delete the session data of a user, remove it from active users and from its node if still there
+    # KEYS: session key, active users set, user nodes hash, active users index
+    # ARGV: username, node id, presence channel[, channel, message to publish]
+    END_SESSION_SCRIPT = """
+    redis.call('DEL', KEYS[1])
+    redis.call('ZREM', KEYS[4], ARGV[1])
+    if redis.call('SREM', KEYS[2], ARGV[1]) == 1 and ARGV[3] ~= '' then
+        redis.call('PUBLISH', ARGV[3], '-' .. ARGV[1])
+    end
+    if ARGV[2] ~= '' and redis.call('HGET', KEYS[3], ARGV[1]) == ARGV[2] then
+        redis.call('HDEL', KEYS[3], ARGV[1])
+    end
+    if ARGV[4] then
+        redis.call('PUBLISH', ARGV[4], ARGV[5])
+    end
+    return 1
+    """
+
+    # Remove a user from active users and from its node once its session key expired, atomically with the check so
+    # a session started meanwhile is kept
+    # KEYS: session key, active users set, user nodes hash, active users index
+    # ARGV: username, node id, presence channel[, channel, message to publish]
+    # Returns the milliseconds to live of the session still there (-1 without expiry), -2 when removed
+    EXPIRE_SESSION_SCRIPT = """
+    local ttl = redis.call('PTTL', KEYS[1])
+    if ttl ~= -2 then
+        return ttl
+    end
+    redis.call('ZREM', KEYS[4], ARGV[1])
+    if redis.call('SREM', KEYS[2], ARGV[1]) == 1 and ARGV[3] ~= '' then
+        redis.call('PUBLISH', ARGV[3], '-' .. ARGV[1])
+    end
+    if ARGV[2] ~= '' and redis.call('HGET', KEYS[3], ARGV[1]) == ARGV[2] then
+        redis.call('HDEL', KEYS[3], ARGV[1])
+    end
+    if ARGV[4] then
+        redis.call('PUBLISH', ARGV[4], ARGV[5])
+    end
+    return -2
+    """
+
+    # Add a user to the members of a room if it exists
+    # KEYS: rooms set, room members set, user rooms set
+    # ARGV: room, username
+    JOIN_ROOM_SCRIPT = """
+    if redis.call('SISMEMBER', KEYS[1], ARGV[1]) == 0 then
+        return 0
+    end
+    redis.call('SADD', KEYS[2], ARGV[2])
+    redis.call('SADD', KEYS[3], ARGV[1])
+    return 1
+    """
+
+    # Publish a message to the node holding the connection of a user, or keep it in the user offline messages when
+    # no other node holds it
+    # KEYS: user nodes hash, user hash, user offline messages list
+    # ARGV: username, channel prefix, message, node id of the sender, offline messages kept (0 keeps none)
+    # Returns 1 when published, 2 when kept, 0 for an unknown user
+    ROUTE_MESSAGE_SCRIPT = """
+    local node = redis.call('HGET', KEYS[1], ARGV[1])
+    if node and node ~= ARGV[4] and redis.call('PUBLISH', ARGV[2] .. node, ARGV[1] .. ':' .. ARGV[3]) > 0 then
+        return 1
+    end
+    local limit = tonumber(ARGV[5])
+    if limit == 0 or redis.call('EXISTS', KEYS[2]) == 0 then
+        return 0
+    end
+    local sequence = redis.call('HINCRBY', KEYS[2], 'offline_sequence', 1)
+    -- formatted as an integer, some Lua versions concatenate numbers as floats, 1.0
+    redis.call('RPUSH', KEYS[3], string.format('%d:%s', sequence, ARGV[3]))
+    redis.call('LTRIM', KEYS[3], -limit, -1)
+    return 2
+    """
+
+    # Move the delivery cursor of a user up to a sequence and drop its offline messages up to the cursor, found
+    # in the first ones
+    # KEYS: user offline messages list, user hash
+    # ARGV: sequence delivered, messages delivered
+    # Returns the cursor
+    ACK_OFFLINE_SCRIPT = """
+    local cursor = math.max(tonumber(redis.call('HGET', KEYS[2], 'offline_cursor') or '0'), tonumber(ARGV[1]))
+    if redis.call('EXISTS', KEYS[2]) == 1 then
+        redis.call('HSET', KEYS[2], 'offline_cursor', string.format('%d', cursor))
+    end
+    local delivered = 0
+    for index, entry in ipairs(redis.call('LRANGE', KEYS[1], 0, tonumber(ARGV[2]) - 1)) do
+        if tonumber(string.match(entry, '^(%d+)')) > cursor then
+            break
+        end
+        delivered = index
+    end
+    if delivered > 0 then
+        redis.call('LTRIM', KEYS[1], delivered, -1)
+    end
+    return cursor
+    """
+
+    # Take a token from a rate limit bucket, refilled by the time elapsed since the last one taken. An idle bucket
+    # expires once it would be full again.
+    # KEYS: bucket hash
+    # ARGV: tokens by second, burst, now in milliseconds
+    # Returns 0 when taken, the milliseconds before the next token otherwise
+    TAKE_TOKEN_SCRIPT = """
+    local rate, burst, now = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3])
+    local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'ms')
+    local tokens, last = tonumber(bucket[1]), tonumber(bucket[2])
+    if not tokens then
+        tokens, last = burst, now
+    end
+    tokens = math.min(burst, tokens + math.max(0, now - last) * rate / 1000)
+    local wait = 0
+    if tokens >= 1 then
+        tokens = tokens - 1
+    else
+        wait = math.ceil((1 - tokens) * 1000 / rate)
+    end
+    redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'ms', tostring(math.max(now, last)))
+    redis.call('PEXPIRE', KEYS[1], math.ceil(burst * 1000 / rate))
+    return wait
+    """
+
     def __init__(self, host='localhost', port=6379, db=0):
         super().__init__(host, port, db)
-
-    def add_user(self, *args):
+        self.__take_token = self._redis_client.register_script(self.TAKE_TOKEN_SCRIPT)
+        self.__start_session = self._redis_client.register_script(self.START_SESSION_SCRIPT)
+        self.__end_session = self._redis_client.register_script(self.END_SESSION_SCRIPT)
+        self.__expire_session = self._redis_client.register_script(self.EXPIRE_SESSION_SCRIPT)
+        self.__route_message = self._redis_client.register_script(self.ROUTE_MESSAGE_SCRIPT)
+        self.__join_room = self._redis_client.register_script(self.JOIN_ROOM_SCRIPT)
+        self.__ack_offline = self._redis_client.register_script(self.ACK_OFFLINE_SCRIPT)
+
+    def add_user(self, *args, rounds=None):
         """
 
         :param args:
+        :param rounds: bcrypt cost, BCRYPT_ROUNDS when not given
         :return:
         """
         username, password = args
-        self.__save_user(username, password)
+        self.__save_user(username, password, self.BCRYPT_ROUNDS if rounds is None else rounds)
 
     def delete_user(self, username):
         """
@@ -93,12 +336,11 @@ class RedisServerManager(RedisManager):
         :return:
         """
         username, password = args
-        if self.__authenticate_user(username, password, hashed):
-            print(f"[INFO] Auth success for user {username}!")
-            self.__add_active_user(username)
-            return True
-        print(f"[WARNING] tentative auth for {username}, wrong username or password !")
-        return False
+        password_hash = password if hashed else hash_password(password)
+        stored_hash = self.get_password_hash(username)
+        if stored_hash is None or not check_credential(password_hash, stored_hash):
+            return False
+        return self.start_session(username, stored_hash) is not None
 
     def logout(self, username):
         """
@@ -108,12 +350,180 @@ class RedisServerManager(RedisManager):
         """
         self.__remove_active_user(username)
 
+    def start_session(self, username, password_hash, data=None, expiry=None, node_id='', notify=None,
+                      presence=''):
+        """
+        Authenticate a user, add it to active users and store its session data, in one round-trip
+        :param username:
+        :param password_hash: stored password hash, as checked against the one sent by the client, the session
+                              is not started if it changed meanwhile
+        :param data: session data, stored in JSON format under the username key like set_data
+        :param expiry: session data expiry in seconds
+        :param node_id: node holding the user connection, messages routed to the user are published to it
+        :param notify: (channel, message) published on success
+        :param presence: channel receiving "+<username>" when the user was not active yet
+        :return: the rooms of the user when authenticated, None otherwise
+        """
+        args = [username, password_hash, json.dumps(data) if data is not None else '', expiry or 0, node_id,
+                presence]
+        if notify:
+            args.extend(notify)
+        keys = [f"user:{username}", "active_users", username, self.USER_NODES, f"user_rooms:{username}",
+                self.ACTIVE_USERS_INDEX]
+        authenticated, rooms = self.__start_session(keys=keys, args=args)
+        if authenticated:
+            log.info("auth success user=%s", username)
+            return [room.decode() for room in rooms]
+        log.warning("auth failed user=%s, wrong username or password", username)
+        return None
+
+    def end_session(self, username, node_id='', notify=None, presence=''):
+        """
+        Delete the session data of a user and remove it from active users, in one round-trip
+        :param username:
+        :param node_id: node holding the user connection, forgotten unless the user reconnected elsewhere
+        :param notify: (channel, message) to publish
+        :param presence: channel receiving "-<username>" when the user was active
+        :return:
+        """
+        args = [username, node_id, presence]
+        if notify:
+            args.extend(notify)
+        self.__end_session(keys=[username, "active_users", self.USER_NODES, self.ACTIVE_USERS_INDEX], args=args)
+
+    def expire_sessions(self, usernames, node_id='', notify=None, presence=''):
+        """
+        Remove the users whose session expired from active users, in one round-trip
+        :param usernames:
+        :param node_id: node holding the users connections
+        :param notify: function of a username returning the (channel, message) published when removed
+        :param presence: channel receiving "-<username>" when removed
+        :return: seconds to live by username of the sessions still there, renewed or started again, -1 for the
+                 sessions without expiry
+        """
+        pipeline = self._redis_client.pipeline(transaction=False)
+        for username in usernames:
+            args = [username, node_id, presence]
+            if notify:
+                args.extend(notify(username))
+            self.__expire_session(keys=[username, "active_users", self.USER_NODES, self.ACTIVE_USERS_INDEX],
+                                  args=args, client=pipeline)
+        return {username: ttl / 1000 if ttl >= 0 else ttl
+                for username, ttl in zip(usernames, pipeline.execute()) if ttl != -2}
+
+    def route_message(self, username, message, node_id, offline_limit=0) -> int:
+        """
+        Publish a message to the node holding the connection of a user, or keep it until the user logs in, in one
+        round-trip. The node receives "<username>:<message>" on its channel.
+        :param username: recipient
+        :param message:
+        :param node_id: sender node, nothing is published when the recipient is registered on it
+        :param offline_limit: offline messages kept by user, the oldest are dropped, 0 keeps none
+        :return: ROUTED when a node received the message, STORED when kept, 0 otherwise
+        """
+        return self.__route_message(keys=[self.USER_NODES, f"user:{username}", f"{self.OFFLINE_PREFIX}{username}"],
+                                    args=[username, self.NODE_CHANNEL_PREFIX, message, node_id, offline_limit])
+
+    def offline_messages(self, username, count) -> list:
+        """
+        Oldest offline messages of a user not delivered yet, in one round-trip. They are kept until acknowledged.
+        :param username:
+        :param count:
+        :return: (sequence, message) tuples
+        """
+        pipeline = self._redis_client.pipeline(transaction=False)
+        pipeline.hget(f"user:{username}", "offline_cursor")
+        pipeline.lrange(f"{self.OFFLINE_PREFIX}{username}", 0, count - 1)
+        cursor, entries = pipeline.execute()
+        # int(float()) reads the 1.0 sequences written before they were formatted as integers
+        cursor = int(float(cursor or 0))
+        messages = []
+        for entry in entries:
+            sequence, _, message = entry.decode().partition(':')
+            sequence = int(float(sequence))
+            if sequence > cursor:
+                messages.append((sequence, message))
+        return messages
+
+    def ack_offline_messages(self, username, sequence, count) -> int:
+        """
+        Mark the offline messages of a user delivered up to a sequence, they are not sent again
+        :param username:
+        :param sequence:
+        :param count: messages read with offline_messages, the ones delivered are among them
+        :return: the delivery cursor of the user
+        """
+        return self.__ack_offline(keys=[f"{self.OFFLINE_PREFIX}{username}", f"user:{username}"],
+                                  args=[sequence, count])
+
+    def take_token(self, key, rate, burst) -> float:
+        """
+        Take a token from a rate limit bucket shared by all the nodes, in one round-trip
+        :param key: bucket key
+        :param rate: tokens by second
+        :param burst: tokens of a full bucket
+        :return: 0 when taken, the seconds before the next token otherwise
+        """
+        return self.__take_token(keys=[key], args=[rate, burst, int(time.time() * 1000)]) / 1000
+
+    def create_room(self, room) -> bool:
+        """
+        :param room:
+        :return: False when the room already exists
+        """
+        return self._redis_client.sadd(self.ROOMS, room) == 1
+
+    def join_room(self, room, username) -> bool:
+        """
+        Add a user to the members of a room, in one round-trip
+        :param room:
+        :param username:
+        :return: False when the room does not exist
+        """
+        return self.__join_room(keys=[self.ROOMS, f"room:{room}", f"user_rooms:{username}"],
+                                args=[room, username]) == 1
+
+    def leave_room(self, room, username):
+        """
+        Remove a user from the members of a room, in one round-trip
+        :param room:
+        :param username:
+        :return:
+        """
+        pipeline = self._redis_client.pipeline(transaction=False)
+        pipeline.srem(f"room:{room}", username)
+        pipeline.srem(f"user_rooms:{username}", room)
+        pipeline.execute()
+
     def get_active_users(self) -> set:
         """
 
         :return:
         """
-        return self.__redis_client.smembers("active_users")
+        return self._redis_client.smembers("active_users")
+
+    def scan_active_users(self, cursor='0', prefix='', limit=100):
+        """
+        Page of the active users in name order, read from the index in one round-trip
+        :param cursor: '0' for the first page, then the cursor returned with the previous page
+        :param prefix: only the usernames starting with it
+        :param limit:
+        :return: the usernames and the cursor of the next page, '0' after the last page
+        """
+        prefix = prefix.encode()
+        start = b'[' + prefix
+        if cursor != '0' and cursor[1:].encode() >= prefix:
+            # "(<last username of the previous page>", the usernames strictly after it
+            start = cursor.encode()
+        users = self._redis_client.zrangebylex(self.ACTIVE_USERS_INDEX, start, b'[' + prefix + b'\xff',
+                                               start=0, num=limit + 1)
+        users = [user.decode() for user in users]
+        if len(users) > limit:
+            return users[:limit], f"({users[limit - 1]}"
+        return users, '0'
+
+    def count_active_users(self) -> int:
+        return self._redis_client.zcard(self.ACTIVE_USERS_INDEX)
 
     def get_all_user(self, username):
         """
@@ -121,34 +531,30 @@ class RedisServerManager(RedisManager):
         :param username:
         :return:
         """
-        return self.__redis_client.hgetall(f"user:{username}")
+        return self._redis_client.hgetall(f"user:{username}")
+
+    def get_password_hash(self, username):
+        """
+        Stored password hash of a user, to be checked before starting its session
+        :param username:
+        :return: None for an unknown user
+        """
+        password_hash = self._redis_client.hget(f"user:{username}", "password_hash")
+        return password_hash.decode() if password_hash is not None else None
 
-    def __save_user(self, username, password):
+    def __save_user(self, username, password, rounds):
         # TODO what if user already exists
-        password_hash = hash_password(password)
-        self.__redis_client.hset(f"user:{username}", mapping={"password_hash": password_hash})
+        password_hash = hash_credential(hash_password(password), rounds)
+        self._redis_client.hset(f"user:{username}", mapping={"password_hash": password_hash})
 
     def __delete_user(self, username):
-        self.__redis_client.delete(f"user:{username}")
-
-    def __authenticate_user(self, username, password, hashed=True):
-        stored_password = self.__redis_client.hget(f"user:{username}", "password_hash")
-        if not stored_password:
-            return False
-
-        match hashed:
-            case True:
-                return stored_password.decode() == password
-            case False:
-                return stored_password.decode() == hash_password(password)
-
-    def __add_active_user(self, username):
-        if username not in self.get_active_users():
-            self.__redis_client.sadd("active_users", username)
-            print(f"[INFO] User {username} added to active users !")
+        self._redis_client.delete(f"user:{username}", f"{self.OFFLINE_PREFIX}{username}")
 
     def __remove_active_user(self, username):
-        self.__redis_client.srem("active_users", username)
+        pipeline = self._redis_client.pipeline(transaction=False)
+        pipeline.srem("active_users", username)
+        pipeline.zrem(self.ACTIVE_USERS_INDEX, username)
+        pipeline.execute()
 
 
 if __name__ == "__main__":
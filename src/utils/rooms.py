@@ -0,0 +1,66 @@
+"""
+Module to index the members of the chat rooms connected to this node
+"""
+import re
+import threading
+
+ROOM_NAME_PATTERN = re.compile(r"^\w{1,64}$")
+
+
+def is_room_name(name: str) -> bool:
+    return bool(ROOM_NAME_PATTERN.match(name))
+
+
+class RoomIndex:
+    """
+    Local members of each room and rooms of each local user. Rooms membership is kept in Redis, a user is indexed
+    here while connected to this node, so a post is fanned out without looking up the members.
+    """
+
+    def __init__(self):
+        self.__members = {}
+        self.__rooms = {}
+        self.__lock = threading.Lock()
+
+    def add(self, room: str, username: str):
+        with self.__lock:
+            self.__members.setdefault(room, set()).add(username)
+            self.__rooms.setdefault(username, set()).add(room)
+
+    def remove(self, room: str, username: str):
+        with self.__lock:
+            self.__discard(room, username)
+            rooms = self.__rooms.get(username)
+            if rooms is not None:
+                rooms.discard(room)
+                if not rooms:
+                    del self.__rooms[username]
+
+    def remove_user(self, username: str):
+        """
+        Forget a user disconnected from this node
+        :param username:
+        :return: the rooms the user was indexed in
+        """
+        with self.__lock:
+            rooms = self.__rooms.pop(username, set())
+            for room in rooms:
+                self.__discard(room, username)
+        return rooms
+
+    def members(self, room: str) -> tuple:
+        """
+        Snapshot of the local members of a room
+        """
+        with self.__lock:
+            return tuple(self.__members.get(room, ()))
+
+    def is_member(self, room: str, username: str) -> bool:
+        return username in self.__members.get(room, ())
+
+    def __discard(self, room, username):
+        members = self.__members.get(room)
+        if members is not None:
+            members.discard(username)
+            if not members:
+                del self.__members[room]
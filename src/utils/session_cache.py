@@ -0,0 +1,79 @@
+"""
+Module to cache session tokens in process, in front of Redis
+"""
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Optional, Tuple
+
+
+class SessionCache:
+    """
+    Session tokens by username, bounded by a TTL and a maximum size (least recently used entries are evicted).
+
+    An entry never outlives its Redis key: it expires at the session expiry when known, at the cache TTL otherwise.
+    Missing or expired entries are loaded through the loader, which returns (session_token, seconds_to_live).
+    """
+
+    def __init__(self, loader: Callable[[str], Tuple[Optional[str], int]], ttl=300, max_size=100_000,
+                 clock=time.monotonic):
+        self.__loader = loader
+        self.__ttl = ttl
+        self.__max_size = max_size
+        self.__clock = clock
+        self.__sessions = OrderedDict()
+        self.__lock = threading.Lock()
+        # incremented by invalidations, a token loaded meanwhile may be stale and is not cached
+        self.__generation = 0
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.__sessions)
+
+    def get(self, username: str) -> Optional[str]:
+        """
+        Get the session token of a user, loaded on a miss
+        :param username:
+        :return: the session token, None when the user has no session
+        """
+        with self.__lock:
+            entry = self.__sessions.get(username)
+            if entry and entry[1] > self.__clock():
+                self.__sessions.move_to_end(username)
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+            generation = self.__generation
+        session_token, ttl = self.__loader(username)
+        if session_token and generation == self.__generation:
+            self.put(username, session_token, ttl)
+        return session_token
+
+    def put(self, username: str, session_token: str, ttl: int = None):
+        """
+        Cache a session token
+        :param username:
+        :param session_token:
+        :param ttl: seconds before the session expires, the cache TTL bounds it
+        :return:
+        """
+        ttl = self.__ttl if ttl is None or ttl < 0 else min(ttl, self.__ttl)
+        with self.__lock:
+            self.__sessions[username] = (session_token, self.__clock() + ttl)
+            self.__sessions.move_to_end(username)
+            while len(self.__sessions) > self.__max_size:
+                self.__sessions.popitem(last=False)
+
+    def invalidate(self, username: str):
+        """
+        Drop a cached session token
+        :param username:
+        :return:
+        """
+        with self.__lock:
+            self.__generation += 1
+            self.__sessions.pop(username, None)
+
+    def stats(self) -> dict:
+        return {'size': len(self.__sessions), 'hits': self.hits, 'misses': self.misses}
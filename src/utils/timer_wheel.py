@@ -0,0 +1,83 @@
+"""
+Module to expire keys at their deadline with a hashed timer wheel
+"""
+import math
+import threading
+import time
+from typing import Hashable
+
+
+class TimerWheel:
+    """
+    Deadlines by key, hashed into a ring of slots of one tick each. Scheduling and cancelling are O(1), a tick only
+    visits its own slot. A key is scheduled again by overwriting its deadline, cancelled by dropping it: the entries
+    left in the slots are skipped when their slot comes, instead of being searched and removed.
+
+    Deadlines further than a round of the ring are kept in their slot until the round they fall in.
+    """
+
+    def __init__(self, tick=1.0, slots=4096, clock=time.monotonic):
+        """
+        :param tick: seconds of a slot, the precision of the deadlines
+        :param slots: slots of the ring, deadlines within slots * tick seconds are visited once
+        :param clock:
+        """
+        self.__tick = tick
+        self.__slots = [[] for _ in range(slots)]
+        self.__clock = clock
+        # current deadline by key, in ticks
+        self.__deadlines = {}
+        # last tick visited
+        self.__current = int(clock() // tick)
+        self.__lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.__deadlines)
+
+    def __contains__(self, key: Hashable):
+        return key in self.__deadlines
+
+    def schedule(self, key: Hashable, delay: float):
+        """
+        Set the deadline of a key, replacing the previous one
+        :param key:
+        :param delay: seconds before the key expires
+        :return:
+        """
+        # rounded up, a key never expires early
+        deadline = max(math.ceil((self.__clock() + delay) / self.__tick), self.__current + 1)
+        with self.__lock:
+            self.__deadlines[key] = deadline
+            self.__slots[deadline % len(self.__slots)].append((key, deadline))
+
+    def cancel(self, key: Hashable):
+        with self.__lock:
+            self.__deadlines.pop(key, None)
+
+    def expired(self) -> list:
+        """
+        Visit the slots of the ticks elapsed since the last call and drop the keys past their deadline
+        :return: the expired keys
+        """
+        now = int(self.__clock() // self.__tick)
+        expired = []
+        with self.__lock:
+            # a slot is visited once even after a pause longer than a round
+            start = max(self.__current + 1, now - len(self.__slots) + 1)
+            for tick in range(start, now + 1):
+                slot = self.__slots[tick % len(self.__slots)]
+                if not slot:
+                    continue
+                later = []
+                for key, deadline in slot:
+                    if self.__deadlines.get(key) != deadline:
+                        # cancelled or scheduled again
+                        continue
+                    if deadline <= now:
+                        del self.__deadlines[key]
+                        expired.append(key)
+                    else:
+                        later.append((key, deadline))
+                self.__slots[tick % len(self.__slots)] = later
+            self.__current = max(self.__current, now)
+        return expired
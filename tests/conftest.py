@@ -0,0 +1,24 @@
+import functools
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# the server modules import src.utils, the client and model modules import utils
+sys.path[:0] = [ROOT, os.path.join(ROOT, 'src')]
+
+
+@pytest.fixture
+def memory_redis(monkeypatch):
+    """
+    Make the Redis connection pools created by the test use a new in-memory server
+    """
+    fakeredis = pytest.importorskip('fakeredis')
+    pytest.importorskip('lupa')
+    import redis
+    from src.utils import redis_manager
+
+    monkeypatch.setattr(redis_manager, '_connection_pools', {})
+    monkeypatch.setattr(redis, 'BlockingConnectionPool', functools.partial(
+        redis.BlockingConnectionPool, connection_class=fakeredis.FakeConnection, server=fakeredis.FakeServer()))
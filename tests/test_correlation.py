@@ -0,0 +1,28 @@
+import pytest
+
+from src.services.server import ChatServer
+from src.utils import decode_correlated, encode_correlated
+
+
+class RecordingConnection:
+    def __init__(self):
+        self.frames = []
+
+    def sendall(self, data: bytes):
+        self.frames.append(data[4:].decode())
+
+
+def test_decode_correlated():
+    assert decode_correlated(encode_correlated(12, b'HELLO:binary')) == (12, b'HELLO:binary')
+    assert decode_correlated(b'HELLO:binary') == (None, b'HELLO:binary')
+    for data in (b'REQUEST:x1:HELLO', b'REQUEST: 1:HELLO', b'REQUEST:-1:HELLO', b'REQUEST:'):
+        with pytest.raises(ValueError):
+            decode_correlated(data)
+
+
+def test_malformed_correlation_id_is_a_wrong_entry(memory_redis):
+    server = ChatServer('localhost', 0, rate_limits={}, auth_workers=0)
+    conn = RecordingConnection()
+    server._handle_request(conn, b'REQUEST:\xff:HELLO:binary')
+    server._handle_request(conn, encode_correlated(7, b'HELLO:binary'))
+    assert conn.frames == ['WRONG_ENTRY:Malformed correlation id.', 'REPLY:7:HELLO:binary']
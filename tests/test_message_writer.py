@@ -0,0 +1,22 @@
+import sqlite3
+
+from src.models import MessageWriter
+
+
+def test_ids_of_a_rolled_back_batch_are_not_cached(tmp_path):
+    path = tmp_path / 'chat.db'
+    writer = MessageWriter(f"sqlite:///{path}", flush_interval=60)
+    writer.start()
+    # the NULL text fails the batch after its users are inserted, they are rolled back with it
+    writer.write('alice', None, receiver='bob')
+    writer.stop()
+    assert (writer.written, writer.dropped) == (0, 1)
+
+    writer.start()
+    writer.write('alice', 'hello', receiver='bob')
+    writer.stop()
+    assert writer.written == 1
+    db = sqlite3.connect(path)
+    assert db.execute("SELECT sender.username, receiver.username, text FROM messages "
+                      "JOIN users sender ON sender.id = sender_user_id "
+                      "JOIN users receiver ON receiver.id = receiver_user_id").fetchall() == [('alice', 'bob', 'hello')]
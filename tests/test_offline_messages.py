@@ -0,0 +1,95 @@
+import json
+
+import pytest
+
+from src.services.async_server import AsyncChatServer
+from src.services.server import ChatServer
+from src.utils import TextCodec, RedisServerManager, hash_password
+
+PASSWORD = 'password'
+codec = TextCodec()
+
+
+class RecordingConnection:
+    def __init__(self):
+        self.frames = []
+        self.closed = False
+
+    def sendall(self, data: bytes):
+        self.frames.append(data[4:].decode())
+
+    def close(self):
+        pass
+
+
+def login(server, username):
+    conn = RecordingConnection()
+    server._open_connections.inc()
+    server._handle_request(conn, codec.encode_request('LOGIN', username, hash_password(PASSWORD)))
+    assert conn.frames[0].startswith('SESSION_START:')
+    return conn, conn.frames[0].split(':')[1]
+
+
+def add_users(*usernames):
+    manager = RedisServerManager()
+    for username in usernames:
+        manager.add_user(username, PASSWORD, rounds=0)
+    return manager
+
+
+@pytest.mark.parametrize('server_cls', (ChatServer, AsyncChatServer))
+def test_message_to_user_dropped_without_logout_is_delivered_on_relogin(memory_redis, server_cls):
+    manager = add_users('alice', 'bob')
+    server = server_cls('localhost', 0, rate_limits={}, auth_workers=0)
+
+    bob, _ = login(server, 'bob')
+    # the connection closes without LOGOUT, as both engines report a lost connection
+    server._connection_closed(bob)
+    assert b'bob' not in manager.get_active_users()
+
+    alice, token = login(server, 'alice')
+    server._handle_request(alice, codec.encode_request('MESSAGE', 'alice', token, '@bob hi'))
+    assert not any(frame.startswith('NOT_FOUND') for frame in alice.frames)
+    assert bob.frames == [bob.frames[0]]
+
+    bob, _ = login(server, 'bob')
+    offline = [frame for frame in bob.frames if frame.startswith('OFFLINE:')]
+    assert [message for frame in offline for _, message in json.loads(frame[8:])['messages']] == ['alice: hi']
+
+
+@pytest.mark.parametrize('server_cls', (ChatServer, AsyncChatServer))
+def test_message_to_user_dropped_during_login_is_kept(memory_redis, server_cls):
+    manager = add_users('alice', 'bob')
+    server = server_cls('localhost', 0, rate_limits={}, auth_workers=0)
+
+    # closed before its password check completes, the session is not opened
+    bob = RecordingConnection()
+    bob.closed = True
+    server._open_connections.inc()
+    server._handle_request(bob, codec.encode_request('LOGIN', 'bob', hash_password(PASSWORD)))
+    server._connection_closed(bob)
+    assert b'bob' not in manager.get_active_users()
+
+    alice, token = login(server, 'alice')
+    server._handle_request(alice, codec.encode_request('MESSAGE', 'alice', token, '@bob hi'))
+    assert bob.frames == []
+
+    bob, _ = login(server, 'bob')
+    assert any(frame.startswith('OFFLINE:') and 'alice: hi' in frame for frame in bob.frames)
+
+
+@pytest.mark.parametrize('server_cls', (ChatServer, AsyncChatServer))
+def test_message_to_closing_connection_is_kept(memory_redis, server_cls):
+    add_users('alice', 'bob')
+    server = server_cls('localhost', 0, rate_limits={}, auth_workers=0)
+    bob, _ = login(server, 'bob')
+    # closing, not reported closed by the engine yet
+    bob.closed = True
+
+    alice, token = login(server, 'alice')
+    server._handle_request(alice, codec.encode_request('MESSAGE', 'alice', token, '@bob hi'))
+    assert bob.frames == [bob.frames[0]]
+
+    server._connection_closed(bob)
+    bob, _ = login(server, 'bob')
+    assert any(frame.startswith('OFFLINE:') and 'alice: hi' in frame for frame in bob.frames)
@@ -0,0 +1,53 @@
+import pytest
+
+from src.services.server import ChatServer
+from src.utils import BinaryCodec, TextCodec, UserIds, encode_correlated
+from src.utils.protocol import LOGIN_HEADER, SESSION_HEADER
+
+TOKEN = '00112233445566778899aabbccddeeff'
+
+
+class RecordingConnection:
+    def __init__(self):
+        self.frames = []
+
+    def sendall(self, data: bytes):
+        self.frames.append(data[4:].decode())
+
+
+def test_binary_codec_round_trip():
+    user_ids = UserIds()
+    user_ids.intern('alice')
+    codec = BinaryCodec(user_ids)
+    assert codec.decode_request(codec.encode_request('LOGIN', 'alice', 'ab' * 32)) == ['LOGIN', 'alice', 'ab' * 32]
+    assert codec.decode_request(codec.encode_request('MESSAGE', 'alice', TOKEN, '@bob hi')) == \
+        ['MESSAGE', 'alice', TOKEN, '@bob hi']
+
+
+@pytest.mark.parametrize('command, args, header', (('LOGIN', ('alice', 'ab' * 32), LOGIN_HEADER),
+                                                   ('MESSAGE', ('alice', TOKEN, 'hi'), SESSION_HEADER),
+                                                   ('LOGOUT', ('alice', TOKEN), SESSION_HEADER)))
+def test_truncated_binary_request(command, args, header):
+    user_ids = UserIds()
+    user_ids.intern('alice')
+    data = BinaryCodec(user_ids).encode_request(command, *args)
+    for size in range(1, header.size):
+        with pytest.raises(ValueError):
+            BinaryCodec(user_ids).decode_request(data[:size])
+
+
+def test_binary_request_text_not_utf8():
+    codec = BinaryCodec(UserIds())
+    with pytest.raises(ValueError):
+        codec.decode_request(codec.encode_request('LOGIN', 'alice', 'ab' * 32) + b'\xff')
+
+
+def test_malformed_binary_request_is_a_wrong_entry(memory_redis):
+    server = ChatServer('localhost', 0, rate_limits={}, auth_workers=0)
+    conn = RecordingConnection()
+    login = BinaryCodec().encode_request('LOGIN', 'alice', 'ab' * 32)
+    server._handle_request(conn, login[:10])
+    server._handle_request(conn, encode_correlated(3, login + b'\xff'))
+    server._handle_request(conn, TextCodec().encode_request('HELLO', 'binary'))
+    assert conn.frames == ['WRONG_ENTRY:Malformed request.', 'REPLY:3:WRONG_ENTRY:Malformed request.',
+                           'HELLO:binary']